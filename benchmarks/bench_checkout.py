@@ -0,0 +1,75 @@
+"""
+benchmark: checkout of a dependency with a large history from its git database,
+disk use and time of each enzi.git.CHECKOUT_MODES.
+
+usage: python benchmarks/bench_checkout.py [NUM_COMMITS]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import enzi.project_manager
+from enzi.git import Git, GitRepo, CHECKOUT_MODES
+
+# the helpers shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from conftest import ENZI_TOML, git
+
+
+def make_upstream(path, ncommits):
+    """a package whose history is much larger than its working files"""
+    os.makedirs(os.path.join(path, 'src'))
+    git(path, 'init', '-q')
+    with open(os.path.join(path, 'Enzi.toml'), 'w') as f:
+        f.write(ENZI_TOML.format(name='pkg', version='0.1.0', deps=''))
+    for i in range(ncommits):
+        with open(os.path.join(path, 'src', 'pkg.sv'), 'w') as f:
+            f.write('module pkg; // {}\nendmodule\n'.format(i))
+        # incompressible netlists rewritten by every commit
+        with open(os.path.join(path, 'netlist.v'), 'wb') as f:
+            f.write(os.urandom(1 << 16))
+        git(path, 'add', '-A')
+        git(path, 'commit', '-q', '-m', str(i))
+    git(path, 'tag', 'v0.1.0')
+
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def main():
+    ncommits = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as base:
+        upstream = os.path.join(base, 'upstream')
+        make_upstream(upstream, ncommits)
+        db_path = os.path.join(base, 'db')
+        os.makedirs(db_path)
+        db = Git(db_path)
+        db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+        db.spawn_with(lambda x: x.arg('remote').arg('add').arg('origin').arg(upstream))
+        db.fetch('origin')
+        revision = db.spawn_with(lambda x: x.arg('rev-parse').arg('v0.1.0^{commit}')).strip()
+
+        print('{} commits, database {:.1f} MiB'.format(
+            ncommits, disk_usage(db_path) / (1 << 20)))
+        for mode in CHECKOUT_MODES:
+            deps = os.path.join(base, 'deps')
+            repo_git = Git(os.path.join(deps, 'pkg'))
+            repo = GitRepo('pkg', base, repo_git, db_path, revision, checkout_mode=mode)
+            start = time.perf_counter()
+            repo.fetch()
+            elapsed = time.perf_counter() - start
+            fmt = '{:>10}: checkout {:>8.1f} ms, disk {:>8.1f} MiB'
+            print(fmt.format(mode, elapsed * 1e3, disk_usage(deps) / (1 << 20)))
+            shutil.rmtree(deps)
+
+
+if __name__ == '__main__':
+    main()
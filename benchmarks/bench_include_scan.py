@@ -0,0 +1,66 @@
+"""
+benchmark: include scan of generated netlists without any include and of
+small sources with includes, the previous decode + splitlines extractor
+against IncDirsResolver.scan_include_files.
+
+usage: python benchmarks/bench_include_scan.py [NETLIST_MIB]
+"""
+
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+import enzi.project_manager
+from enzi.file_manager import IncDirsResolver
+
+RE = re.compile(r'`include\s*"(.*)"')
+
+
+def decode_extractor(file):
+    """the extractor before the byte-level one"""
+    with open(file, 'rb') as f:
+        data = f.read().decode('utf-8')
+        lines = data.splitlines()
+        m = map(str.strip, lines)
+        ft = filter(lambda x: x.startswith('`include'), m)
+        return list(map(lambda x: RE.search(x).group(1), ft))
+
+
+def make_sources(base, netlist_mib):
+    files = []
+    line = 'assign n{0} = n{1} & ~n{2}; // generated\n'
+    for i in range(4):
+        path = os.path.join(base, 'netlist{}.v'.format(i))
+        with open(path, 'w') as f:
+            n = 0
+            while f.tell() < netlist_mib << 20:
+                f.write(''.join(line.format(n + j, n + j + 1, n + j + 2) for j in range(1000)))
+                n += 1000
+        files.append(path)
+    for i in range(200):
+        path = os.path.join(base, 'm{}.sv'.format(i))
+        with open(path, 'w') as f:
+            f.write('`include "defs.svh"\n`include "../inc/bus{}.svh"\n'.format(i))
+            f.write('module m{};\n  logic a;\nendmodule\n'.format(i) * 20)
+        files.append(path)
+    return files
+
+
+def main():
+    netlist_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    resolver = IncDirsResolver('')
+    with tempfile.TemporaryDirectory() as base:
+        files = make_sources(base, netlist_mib)
+        for file in files:
+            assert decode_extractor(file) == resolver.scan_include_files(file)
+        print('4 netlists of {} MiB, 200 small sources'.format(netlist_mib))
+        for name, scan in [('decode', decode_extractor),
+                           ('bytes', resolver.scan_include_files)]:
+            elapsed = min(timeit.repeat(lambda: list(map(scan, files)), number=1, repeat=3))
+            print('{:>8}: {:>8.1f} ms'.format(name, elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
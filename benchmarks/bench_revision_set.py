@@ -0,0 +1,61 @@
+"""
+micro-benchmark: resolver candidate sets of a 100k-commit history,
+python set of revision indices vs enzi.deps_resolver.RevisionSet.
+
+usage: python benchmarks/bench_revision_set.py [NUM_COMMITS]
+"""
+
+import random
+import sys
+import timeit
+import tracemalloc
+
+import enzi.project_manager
+from enzi.deps_resolver import RevisionSet
+
+
+def bench(name, init, narrow, repeat=10):
+    # memory of one candidate set
+    tracemalloc.start()
+    ids = init()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    t_init = min(timeit.repeat(init, number=1, repeat=repeat))
+    t_narrow = min(timeit.repeat(lambda: narrow(ids), number=1, repeat=repeat))
+    fmt = '{:>12}: memory {:>10.1f} KiB, init {:>8.3f} ms, impose+pick {:>8.3f} ms'
+    print(fmt.format(name, size / 1024, t_init * 1e3, t_narrow * 1e3))
+
+
+def main():
+    ncommits = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rand = random.Random(0)
+    # the indices matched by a few constraints, e.g. version tags
+    matched = [sorted(rand.sample(range(ncommits), ncommits // 100))
+               for _ in range(4)]
+    # a constraint matching the whole history, e.g. a version range in an old major
+    matched.append(range(ncommits // 2, ncommits))
+
+    print('{} commits, {} constraints'.format(ncommits, len(matched)))
+
+    set_cons = list(map(set, matched))
+
+    def set_narrow(ids):
+        for con in set_cons:
+            ids = ids.intersection(con)
+        return min(ids) if ids else None
+
+    bench('set', lambda: set(range(ncommits)), set_narrow)
+
+    bit_cons = list(map(RevisionSet.from_indices, matched))
+
+    def bit_narrow(ids):
+        for con in bit_cons:
+            ids = ids.intersection(con)
+        return ids.min() if ids else None
+
+    bench('RevisionSet', lambda: RevisionSet.full(ncommits), bit_narrow)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+benchmark: startup of a project, Enzi(...) + init() with an up-to-date lock,
+with and without the build/enzi-sidecar.pickle of the last run.
+
+usage: python benchmarks/bench_startup.py [NUM_DEPS]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+import enzi.project_manager
+from enzi.config import SIDECAR
+from enzi.frontend import Enzi
+
+# the helpers shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from conftest import make_package, make_root
+
+
+def make_project(base, ndeps):
+    deps = []
+    for i in range(ndeps):
+        name = 'dep{}'.format(i)
+        path = os.path.join(base, name)
+        make_package(path, name, ['0.1.0'])
+        deps.append((name, path, '0.1.0'))
+    return make_root(os.path.join(base, 'root'), deps)
+
+
+def startup(root):
+    enzi = Enzi(root)
+    enzi.init()
+
+
+def main():
+    ndeps = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    with tempfile.TemporaryDirectory() as base:
+        root = make_project(base, ndeps)
+        startup(root)
+        sidecar = os.path.join(root, 'build', SIDECAR)
+
+        def without_sidecar():
+            os.remove(sidecar)
+            startup(root)
+
+        print('{} dependencies'.format(ndeps))
+        t_cold = min(timeit.repeat(without_sidecar, number=1, repeat=5))
+        t_warm = min(timeit.repeat(lambda: startup(root), number=1, repeat=5))
+        print('{:>16}: {:>8.2f} ms'.format('without sidecar', t_cold * 1e3))
+        print('{:>16}: {:>8.2f} ms'.format('with sidecar', t_warm * 1e3))
+
+
+if __name__ == '__main__':
+    main()
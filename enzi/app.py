@@ -16,11 +16,11 @@ from colorama import Fore, Style
 
 from enzi.validator import EnziConfigValidator, VersionValidator
 from enzi.config import validate_git_repo, RawConfig
-from enzi.git import Git
-from enzi.file_manager import IncDirsResolver
+from enzi.git import Git, CHECKOUT_MODES
+from enzi.file_manager import IncDirsResolver, SYNC_MODES, LINK_MODES
 from enzi.project_manager import ProjectFiles
 from enzi.utils import rmtree_onerror, OptionalAction, BASE_ESTRING
-from enzi.frontend import Enzi
+from enzi.frontend import Enzi, RESOLVERS
 
 # **************** LOGGING CONFIGURATION **************** #
 try:
@@ -153,6 +153,20 @@ class EnziApp(object):
         if not args.root:
             raise RuntimeError('No root directory specified.')
 
+        # the options of Enzi, the same with or without a config file name
+        kwargs = {
+            'non_lazy': self.args.non_lazy,
+            'jobs': self.args.jobs,
+            'partial_clone': self.args.partial_clone,
+            'resolver': self.args.resolver,
+            'offline': self.args.offline,
+            'fetch_ttl': self.args.fetch_ttl,
+            'shared_cache': self.args.shared_cache,
+            'checkout_mode': self.args.checkout,
+            'sparse_checkout': self.args.sparse_checkout,
+            'sync_mode': self.args.sync_files,
+            'link_mode': self.args.link_files,
+        }
         # if update, root must be specified
         if args.config:
             if os.path.dirname(args.config):
@@ -160,12 +174,9 @@ class EnziApp(object):
                 msg = fmt.format(args.config)
                 self.error(msg)
                 raise SystemExit(1)
-            self.enzi = Enzi(
-                args.root[0],
-                args.config,
-                non_lazy=self.args.non_lazy)
+            self.enzi = Enzi(args.root[0], args.config, **kwargs)
         else:
-            self.enzi = Enzi(args.root[0], non_lazy=self.args.non_lazy)
+            self.enzi = Enzi(args.root[0], **kwargs)
 
         if is_task and args.task == 'update':
             if args.version:  # --version
@@ -543,8 +554,9 @@ class EnziApp(object):
         enzi = kwargs.get('enzi', self.enzi)
         if not isinstance(enzi, Enzi):
             return
+        deps = kwargs.get('deps', self.args.deps)
         self.info('start updating')
-        enzi.init(update=True)
+        enzi.init(update=True, deps=deps)
         self.info('updating finished')
 
     def clean(self, **kwargs):
@@ -629,6 +641,58 @@ class EnziApp(object):
             '--non-lazy',
             help='Force Enzi to (re)generated corresponding backend configuration when running target',
             action='store_true')
+        parser.add_argument(
+            '--jobs', '-j',
+            help='Number of git databases to create/fetch and source files to scan concurrently, \
+                default is min(8, cpu count)',
+            type=int)
+        parser.add_argument(
+            '--partial-clone',
+            help='Create new dependency git databases as blob-less partial clones, \
+                blobs are fetched on demand',
+            action='store_true')
+        parser.add_argument(
+            '--resolver',
+            help='Dependency resolver engine, backtracking learns from conflicts \
+                and tries older revisions instead of failing, default is fixpoint',
+            choices=RESOLVERS)
+        parser.add_argument(
+            '--offline',
+            help='Never access the remotes of dependencies, \
+                fail if a git database or a revision is missing',
+            action='store_true')
+        parser.add_argument(
+            '--fetch-ttl',
+            help='Do not fetch a git database again within the given seconds \
+                since its last fetch, unless updating it explicitly',
+            type=float, metavar='SECONDS')
+        parser.add_argument(
+            '--checkout',
+            help='How to check out new dependencies from their git databases, \
+                shared borrows the objects of the database through alternates, \
+                worktree adds a worktree of the database, export extracts the files \
+                of the locked revision without a working tree, default is clone',
+            choices=CHECKOUT_MODES)
+        parser.add_argument(
+            '--sparse-checkout',
+            help='Only check out the directories of the files in the filesets of dependencies \
+                and their include files, fall back to a full checkout if an include file is missing',
+            action='store_true')
+        parser.add_argument(
+            '--sync-files',
+            help='How to find the changed files of this project to write into the build directory, \
+                stat compares their sizes and mtimes, hash compares their contents, default is stat',
+            choices=SYNC_MODES)
+        parser.add_argument(
+            '--link-files',
+            help='How to materialize the files of this project in the build directory, \
+                hardlink falls back to copy across file systems, default is copy',
+            choices=LINK_MODES)
+        parser.add_argument(
+            '--shared-cache',
+            help='Directory of the git databases shared by all projects on this machine, \
+                default is $ENZI_SHARED_CACHE, or build/database of the project if unset',
+            metavar='DIR')
         parser.add_argument('--enzi-config-help',
                             help='Output an Enzi.toml file\'s key-values hints. \
                                 If no output file is specified, Enzi will print to stdout.',
@@ -664,6 +728,9 @@ class EnziApp(object):
             '--message', '-m',
             help='Commit message for update git repository, if no message is specified, the message will be: "auto commit by Enzi"',
             action=OptionalAction, default=AUTO_COMMIT_MESSAGE)
+        update_parser.add_argument(
+            'deps', nargs='*', metavar='DEP',
+            help='Only update the given dependencies, the others keep their locked revisions')
         update_parser.set_defaults(task='update')
 
         # init task
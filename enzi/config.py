@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import io
+import json
 import logging
 import os
+import pickle
 import platform
 import pprint
+import threading
 import toml
 import typing
 import copy as py_copy
 
 from ordered_set import OrderedSet
 from collections import OrderedDict
+from hashlib import blake2b
 from itertools import chain
 from semver import VersionInfo as Version
 
-from enzi.utils import Launcher
+from enzi import __version__
+from enzi.utils import FileLock, Launcher
 from enzi.utils import realpath, toml_load, toml_loads
 from enzi.validator import EnziConfigValidator, tools_section_line
 from enzi.ver import VersionReq
@@ -25,7 +30,7 @@ __all__ = [
     'Dependency', 'RawDependency',
     'DependencyEntry', 'DependencyRef', 'DependencyTable',
     'LockedSource', 'LockedDependency', 'Locked',
-    'PartialConfig', 'Config', 'RawConfig'
+    'PartialConfig', 'Config', 'RawConfig', 'ConfigCache', 'Sidecar'
 ]
 
 
@@ -288,11 +293,14 @@ class Locked(object):
     A Lock, contains all the resolved dependencies
     """
 
-    def __init__(self, *, dependencies: typing.MutableMapping[str, LockedDependency], config_path=None, config_mtime=None):
+    def __init__(self, *, dependencies: typing.MutableMapping[str, LockedDependency], config_path=None, config_mtime=None, config_hash=None, deps_hash=None):
         self.dependencies = dependencies
         # the last modified time of Enzi.toml
         self.config_path: typing.Optional[str] = config_path
         self.config_mtime: typing.Optional[int] = config_mtime
+        # content hashes of Enzi.toml, see Config.digest and Config.deps_digest
+        self.config_hash: typing.Optional[str] = config_hash
+        self.deps_hash: typing.Optional[str] = deps_hash
         self.cache = {}
 
     def __str__(self):
@@ -361,6 +369,10 @@ class Locked(object):
             'path': self.config_path,
             'mtime': self.config_mtime,
         }
+        if self.config_hash:
+            config['hash'] = self.config_hash
+        if self.deps_hash:
+            config['deps_hash'] = self.deps_hash
         d['metadata'] = {}
         d['metadata']['config'] = config
 
@@ -384,6 +396,9 @@ class Locked(object):
         meta_config = metadata['config']
         locked.config_path = meta_config['path']
         locked.config_mtime = int(meta_config['mtime'])
+        # lock files generated by older Enzi have no hashes
+        locked.config_hash = meta_config.get('hash')
+        locked.deps_hash = meta_config.get('deps_hash')
         deps = config.get('dependencies')
         if deps:
             for dep_name, dep in deps.items():
@@ -497,7 +512,7 @@ class Config(object):
     A completed configuration file
     """
 
-    def __init__(self, config, config_path, is_local=True, *, from_str=False):
+    def __init__(self, config, config_path, is_local=True, *, from_str=False, check_deps=True):
         self.path = config_path
         self.version = config.get('enzi_version')
         self.package = config.get('package')
@@ -531,15 +546,16 @@ class Config(object):
         if 'dependencies' in config:
             for dep, dep_conf in config.get('dependencies').items():
                 # TODO: add function to resolve abs dependency's path
-                dep_path = dep_conf['path']
-                if 'path' in dep_conf and not os.path.isabs(dep_path):
+                dep_path = dep_conf.get('path')
+                if dep_path and not os.path.isabs(dep_path):
                     dep_conf['path'] = validate_dep_path(dep, dep_path)
                 validated = RawDependency.from_config(dep_conf).validate()
                 self.dependencies[dep] = validated
 
         # validate dependencies
-        for dep_name, dep in self.dependencies.items():
-            validate_git_repo(dep_name, dep.git_url)
+        if check_deps:
+            for dep_name, dep in self.dependencies.items():
+                validate_git_repo(dep_name, dep.git_url)
 
         # targets configs
         self.targets = {}
@@ -565,6 +581,32 @@ class Config(object):
         else:
             self.tools = tools_config
 
+    def deps_digest(self):
+        """
+        a normalized hash of the dependencies, which decides the resolved lock
+        """
+        deps = map(lambda x: [x[0], x[1].git_url, x[1].use_version, str(x[1].rev_ver)],
+                   sorted(self.dependencies.items()))
+        data = json.dumps(list(deps))
+        return blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+    def digest(self):
+        """
+        a normalized hash of the whole config, key order and formatting
+        in Enzi.toml do not matter
+        """
+        d = {
+            'enzi_version': self.version,
+            'package': self.package,
+            'filesets': self.filesets,
+            'minimal': list(self.minimal_filesets.keys()),
+            'targets': self.targets,
+            'tools': self.tools,
+            'dependencies': self.deps_digest()
+        }
+        data = json.dumps(d, sort_keys=True, default=str)
+        return blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
     def debug_str(self):
         str_buf = ['Config: {']
         m = vars(self)
@@ -679,9 +721,9 @@ class RawConfig(object):
         self.validator = EnziConfigValidator(
             conf, self.config_path, git_url=git_url)
 
-    def validate(self):
+    def validated(self) -> dict:
         """
-        validate this raw config, return PartialConfig/Config
+        validate this raw config, return the validated config dict
         """
         validated = self.validator.validate()
 
@@ -693,8 +735,232 @@ class RawConfig(object):
             logger.debug('Use targets.program_device as targets.program_device.')
             tpgm = validated['targets']['program_device']
             validated['targets']['build'] = py_copy.deepcopy(tpgm)
+        return validated
+
+    def validate(self):
+        """
+        validate this raw config, return PartialConfig/Config
+        """
+        validated = self.validated()
         if self.fileset_only:
             # TODO: In future version, make use of include_tools
             return PartialConfig(validated, self.config_path, self.is_local, from_str=self.from_str, include_tools=False)
         else:
             return Config(validated, self.config_path, self.is_local, from_str=self.from_str)
+
+
+# config cache file inside the database directory
+CONFIG_CACHE = 'enzi-configs.json'
+CONFIG_CACHE_SCHEMA = 1
+
+
+class ConfigCache(object):
+    """
+    An in-memory and on-disk cache of the validated Enzi.toml of git dependencies,
+    keyed by git url and revision. The content of a commit never changes,
+    so the entries are only invalidated by CONFIG_CACHE_SCHEMA.
+    """
+
+    def __init__(self, cache_path, check_deps=True):
+        self.path = cache_path
+        # whether to check the git urls of the dependencies of new entries,
+        # unchecked configs are not cached
+        self.check_deps = check_deps
+        # <K=git url, V=<K=revision, V=validated config dict>>, loaded lazily
+        self.entries: typing.Optional[typing.MutableMapping[str, dict]] = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load_file(self) -> dict:
+        """load the entries from the cache file, empty if there is no valid cache"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('schema') == CONFIG_CACHE_SCHEMA:
+                return data['configs']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            fmt = 'ConfigCache: ignore invalid cache {}: {}'
+            logger.debug(fmt.format(self.path, e))
+        return {}
+
+    def get(self, git_url, revision) -> typing.Optional[dict]:
+        """get a copy of the cached validated config dict, None if missing"""
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load_file()
+            validated = self.entries.get(git_url, {}).get(revision)
+            if validated is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Config takes the ownership of the dict
+            return py_copy.deepcopy(validated)
+
+    def put(self, git_url, revision, validated: dict):
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load_file()
+            self.entries.setdefault(git_url, {})[revision] = validated
+            self.dirty = True
+
+    def load(self, git_url, revision, read, base_path, *, is_local=True, fileset_only=False):
+        """
+        load the PartialConfig/Config of a git dependency at the given revision.
+        read() returns the content of Enzi.toml, it is only called on cache miss.
+        """
+        config_path = os.path.join(base_path, 'Enzi.toml')
+        validated = self.get(git_url, revision)
+        if validated is not None:
+            logger.debug('ConfigCache: hit {} at {}'.format(git_url, revision))
+            if fileset_only:
+                return PartialConfig(validated, config_path, is_local, from_str=True)
+            # the dependencies were checked before the entry was added
+            return Config(validated, config_path, is_local, from_str=True, check_deps=False)
+
+        raw = RawConfig(read(), from_str=True, base_path=base_path,
+                        is_local=is_local, git_url=git_url, fileset_only=fileset_only)
+        validated = raw.validated()
+        if fileset_only:
+            # the dependencies of a PartialConfig are not checked, not cacheable
+            return PartialConfig(validated, config_path, is_local, from_str=True)
+        entry = py_copy.deepcopy(validated)
+        config = Config(validated, config_path, is_local,
+                        from_str=True, check_deps=self.check_deps)
+        if self.check_deps:
+            self.put(git_url, revision, entry)
+        return config
+
+    def dump(self):
+        """write the cache file if there are new entries, merged with the existing file"""
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # the cache file may be shared by other enzi processes
+            with FileLock(self.path + '.lock'):
+                configs = self.load_file()
+                for git_url, entries in self.entries.items():
+                    configs.setdefault(git_url, {}).update(entries)
+                data = {'schema': CONFIG_CACHE_SCHEMA, 'configs': configs}
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            self.dirty = False
+            fmt = 'ConfigCache: {} hits, {} misses, dumped to {}'
+            logger.debug(fmt.format(self.hits, self.misses, self.path))
+
+
+# startup sidecar file inside the build directory
+SIDECAR = 'enzi-sidecar.pickle'
+SIDECAR_SCHEMA = 1
+
+
+def content_key(data: bytes):
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+class Sidecar(object):
+    """
+    A pickled copy of the validated Enzi.toml and the loaded Enzi.lock of
+    a project, keyed by their paths and content hashes, so that unchanged
+    files are neither parsed nor validated again at startup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # <K=config|locked, V=((path, content key), pickled object)>, loaded lazily
+        self.entries: typing.Optional[dict] = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load_file(self) -> dict:
+        """load the entries from the sidecar file, empty if there is no valid sidecar"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('schema') == SIDECAR_SCHEMA and data.get('version') == __version__:
+                return data['entries']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.debug('Sidecar: ignore invalid sidecar {}: {}'.format(self.path, e))
+        return {}
+
+    def get(self, name, path, key):
+        """get a new copy of the entry, None if missing or outdated"""
+        if self.entries is None:
+            self.entries = self.load_file()
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != (path, key):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(entry[1])
+
+    def put(self, name, path, key, obj):
+        if self.entries is None:
+            self.entries = self.load_file()
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        self.entries[name] = ((path, key), data)
+        self.dirty = True
+
+    def config(self, config_path, check_deps=True) -> Config:
+        """
+        load the Config of the given Enzi.toml,
+        it is not recorded if its dependencies are not checked.
+        """
+        with open(config_path, 'rb') as f:
+            key = content_key(f.read())
+        validated = self.get('config', config_path, key)
+        if validated is not None:
+            logger.debug('Sidecar: hit {}'.format(config_path))
+            # the dependencies were checked before the entry was added
+            return Config(validated, config_path, check_deps=False)
+
+        raw = RawConfig(config_path)
+        validated = raw.validated()
+        entry = py_copy.deepcopy(validated)
+        config = Config(validated, raw.config_path, raw.is_local, check_deps=check_deps)
+        if check_deps:
+            self.put('config', config_path, key, entry)
+        return config
+
+    def locked(self, lock_file) -> Locked:
+        """load the Locked of the given lock file"""
+        with open(lock_file, 'rb') as f:
+            data = f.read()
+        locked = self.get('locked', lock_file, content_key(data))
+        if locked is not None:
+            logger.debug('Sidecar: hit {}'.format(lock_file))
+            return locked
+        return self.put_locked(lock_file, data)
+
+    def put_locked(self, lock_file, data: bytes) -> Locked:
+        """
+        record the content of a lock file, which is parsed like Locked.load,
+        so that a hit always equals a fresh load.
+        """
+        locked = Locked.loads(toml_loads(data.decode('utf-8')))
+        self.put('locked', lock_file, content_key(data), locked)
+        return locked
+
+    def dump(self):
+        """write the sidecar file if there are new entries"""
+        if not self.dirty:
+            return
+        data = {'schema': SIDECAR_SCHEMA, 'version': __version__,
+                'entries': self.entries}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        fmt = 'Sidecar: {} hits, {} misses, dumped to {}'
+        logger.debug(fmt.format(self.hits, self.misses, self.path))
@@ -76,6 +76,72 @@ class DependencyConstraint(object):
         return self.cons == 'Revision'
 
 
+class RevisionSet(object):
+    """
+    A compact set of revision indices, backed by an integer bitmask.
+    Bit i is set if the revision with index i is in this set.
+    """
+    __slots__ = ('mask', )
+
+    def __init__(self, mask=0):
+        self.mask: int = mask
+
+    @staticmethod
+    def full(size: int):
+        """a RevisionSet contains all indices in range(size)"""
+        return RevisionSet((1 << size) - 1)
+
+    @staticmethod
+    def from_indices(indices: typing.Iterable[int]):
+        mask = 0
+        for idx in indices:
+            mask |= 1 << idx
+        return RevisionSet(mask)
+
+    def intersection(self, other):
+        return RevisionSet(self.mask & other.mask)
+
+    __and__ = intersection
+
+    def min(self) -> int:
+        """return the minimal index in this set"""
+        if not self.mask:
+            raise ValueError('min() of an empty RevisionSet')
+        return (self.mask & -self.mask).bit_length() - 1
+
+    def __contains__(self, idx):
+        return idx >= 0 and bool(self.mask >> idx & 1)
+
+    def __len__(self):
+        # popcount
+        return bin(self.mask).count('1')
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __eq__(self, other):
+        if isinstance(other, RevisionSet):
+            return self.mask == other.mask
+        return False
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __repr__(self):
+        # only list a few indices, the set may have 100k+ revisions
+        if len(self) <= 16:
+            return 'RevisionSet({})'.format(list(self))
+        else:
+            return 'RevisionSet({} revisions, min {})'.format(len(self), self.min())
+
+
 class State(object):
     # TODO: rewrite in more python way
     __allow_states__ = ('Open', 'Locked', 'Constrained', 'Pick')
@@ -84,7 +150,7 @@ class State(object):
         if not state in self.__allow_states__:
             raise ValueError('state must in {}'.format(self.__allow_states__))
         self.state: str = state
-        self.value: typing.Union[int, set, typing.Tuple[int, set], None] = val
+        self.value: typing.Union[int, RevisionSet, typing.Tuple[int, RevisionSet], None] = val
 
     @staticmethod
     def Open():
@@ -95,11 +161,11 @@ class State(object):
         return State('Locked', lock_id)
 
     @staticmethod
-    def Constrained(versions: set):
+    def Constrained(versions: RevisionSet):
         return State('Constrained', versions)
 
     @staticmethod
-    def Pick(pick_id, versions: set):
+    def Pick(pick_id, versions: RevisionSet):
         return State('Pick', (pick_id, versions))
 
     def is_open(self):
@@ -140,7 +206,7 @@ class State(object):
                 'INTERNAL ERROR: try to set lock_id for a State::{}'.format(self.state))
 
     @property
-    def ids(self) -> set:
+    def ids(self) -> RevisionSet:
         if self.is_constrained():
             return self.value
         elif self.is_pick():
@@ -151,8 +217,8 @@ class State(object):
 
     @ids.setter
     def ids(self, ids):
-        if not type(ids) == set:
-            raise ValueError('ids must be a set')
+        if not isinstance(ids, RevisionSet):
+            raise ValueError('ids must be a RevisionSet')
 
         if self.is_constrained():
             self.value = ids
@@ -183,8 +249,11 @@ class DependencySource(object):
         self.id: DependencyRef = dep_id
         self.versions: GitVersions = versions
         self.pick: typing.Optional[int] = pick
-        self.options: typing.Optional[typing.MutableSet[int]] = options
+        self.options: typing.Optional[RevisionSet] = options
         self.state: State = state
+        # whether the versions are listed from a database which was not
+        # updated because it had the locked revision
+        self.outdated = False
 
     def current_pick(self) -> Optional[DependencyVersion]:
         if self.state.is_open() or self.state.is_constrained():
@@ -230,43 +299,43 @@ class DepTableDumper(object):
     __repr__ = __str__
 
 
-def find_version(versions: typing.List[typing.Tuple[Version, str]], rev: str):
-    rev_filter = filter(lambda x: x[1] == rev, versions)
-    rev_map = map(lambda x: x[0], rev_filter)
-    try:
-        return max(rev_map)
-    except ValueError:
-        return None
+def find_version(versions: GitVersions, rev: str):
+    return versions.find_version(rev)
 
 
 class DependencyResolver(object):
-    def __init__(self, enzi: Enzi):
+    # whether the databases having the locked revisions are not updated,
+    # their versions are updated once a locked revision is dropped
+    skip_locked_fetch = True
+
+    def __init__(self, enzi: Enzi, locked: Optional[Locked] = None, unlock=()):
         self.table: typing.MutableMapping[str,
                                           Dependency] = {}  # <K=str, Dependency>
         # self.decisions: typing.MutableMapping[str, int] = {}  # <K=str, int>
         # a cache for dep name <-> dep git url, use for name/git url conflicts
         self.git_urls: typing.MutableMapping[str, str] = {}
         self.enzi = enzi
+        # the EnziIO shared by the whole resolve run,
+        # so that each git database keeps a single object reader.
+        self.enzi_io = EnziIO(enzi)
+        # the locked dependencies reused as the initial picks <K=str, V=LockedDependency>
+        self.locked_deps: typing.MutableMapping[str, config.LockedDependency] = {}
+        if locked is not None:
+            self.locked_deps = {
+                k: v for k, v in locked.dependencies.items() if not k in unlock}
 
     def resolve(self) -> Locked:
-        self.register_dep_in_config(
-            self.enzi.config.dependencies, self.enzi.config)
-
-        iteration = 0
-        any_change = True
-        while any_change:
-            logger.debug('resolve: iteration {}, table {}'.format(
-                iteration, DepTableDumper(self.table)))
-            iteration += 1
-            self.init()
-            self.mark()
-            any_change = self.pick()
-            self.close()
+        with self.enzi_io:
+            iteration = self.resolve_table()
 
         logger.debug('resolve: resolved after {} iterations'.format(iteration))
         logger.debug('resolve: resolved table {}'.format(
             DepTableDumper(self.table)))
 
+        return self.locked()
+
+    def locked(self) -> Locked:
+        """build the Locked of the picks in the resolved table"""
         enzi = self.enzi
         locked = {}
 
@@ -286,7 +355,7 @@ class DependencyResolver(object):
                 logger.error('resolver: pick is none')
                 raise ValueError('pick is none')
             rev = src.versions.revisions[pick]
-            version = find_version(src.versions.versions, rev)
+            version = find_version(src.versions, rev)
             lock_dep = config.LockedDependency(
                 revision=rev,
                 version=version,
@@ -298,7 +367,27 @@ class DependencyResolver(object):
         return config.Locked(
             dependencies=locked,
             config_path=self.enzi.config_path,
-            config_mtime=self.enzi.config_mtime)
+            config_mtime=self.enzi.config_mtime,
+            config_hash=self.enzi.config_hash,
+            deps_hash=self.enzi.deps_hash)
+
+    def resolve_table(self):
+        """resolve the dependency table, return the number of iterations"""
+        self.register_dep_in_config(
+            self.enzi.config.dependencies, self.enzi.config)
+
+        iteration = 0
+        any_change = True
+        while any_change:
+            logger.debug('resolve: iteration {}, table {}'.format(
+                iteration, DepTableDumper(self.table)))
+            iteration += 1
+            self.init()
+            self.mark()
+            any_change = self.pick()
+            self.close()
+
+        return iteration
 
     def init(self):
         for dep in self.table.values():
@@ -307,7 +396,7 @@ class DependencyResolver(object):
                     continue
                 logger.debug('resolve init {}[{}]'.format(dep.name, src.id))
 
-                ids = set(range(len(src.versions.revisions)))
+                ids = RevisionSet.full(len(src.versions.revisions))
                 src.state = State.Constrained(ids)
 
     def mark(self):
@@ -358,7 +447,7 @@ class DependencyResolver(object):
                     any_change = True
                     logger.debug(
                         'resolve:pick: picking version for {}[{}]'.format(dep.name, src.id.id))
-                    pick_id = min(ids)
+                    pick_id = ids.min()
                     dep.sources[src_id].state = State.Pick(pick_id, ids)
                 elif state.is_pick():
                     pick_id, ids = state.value
@@ -368,25 +457,25 @@ class DependencyResolver(object):
                         if dep.config:
                             open_pending.update(dep.config.dependencies.keys())
                             any_change = True
-                            src.state = State.Open()
+                            self.reopen(dep.name, src)
 
         while open_pending:
             opens, open_pending = open_pending, set()
             for dep_name in opens:
                 logger.debug('resolve:pick: resetting {}'.format(dep_name))
                 dep = self.table[dep_name]
-                for src in dep.source.values():
+                for src in dep.sources.values():
                     if not src.state.is_open():
                         any_change = True
                         if dep.config:
                             open_pending.update(dep.config.dependencies.keys())
-                        src.state = State.Open()
+                        self.reopen(dep_name, src)
 
         return any_change
 
     def close(self):
         logger.debug('resolve:close: computing closure over dependencies')
-        enzi_io = EnziIO(self.enzi)
+        enzi_io = self.enzi_io
 
         econfigs: typing.List[typing.Tuple[str, EnziConfig]] = []
         for dep in self.table.values():
@@ -405,51 +494,37 @@ class DependencyResolver(object):
             self.table[name].config = econfig
 
     def req_indices(self, name: str, con: DependencyConstraint, src: DependencySource):
+        git_ver: GitVersions = src.versions
         if con.is_version():
-            git_ver = src.versions
-            con: GitVersions = con.value
-            ids = dict(map(lambda eitem: (eitem[1], eitem[0]),
-                           enumerate(git_ver.revisions)))
-
-            # logger.debug(ids)
-            def try_match_ver(item):
-                v, h = item
-                if con.matches(v):
-                    return ids[h]
-                else:
-                    return None
-
-            revs = set(filter(lambda x: (not x is None), map(
-                try_match_ver, git_ver.versions)))
-
-            return revs
+            con: VersionReq = con.value
+            matched = git_ver.matching_versions(con)
+            revs = map(lambda item: git_ver.index_of(item[1]), matched)
+            revs = filter(lambda x: not x is None, revs)
+            return RevisionSet.from_indices(revs)
         elif con.is_revision():
-            git_ver = src.versions
-            git_refs: dict = git_ver.refs
-            git_revs: list = git_ver.revisions
             con: str = con.value
 
-            revs = set()
-
-            ref = git_refs.get(con, None)
-            if ref:
-                idx = git_revs.index(ref)
-                revs.add(idx)
+            ref = git_ver.refs.get(con, None)
+            idx = git_ver.index_of(ref) if ref else None
+            if not idx is None:
+                return RevisionSet.from_indices([idx])
             else:
-                enum_revs = enumerate(git_revs)
-                revs_map = map(
-                    lambda item: item[0] if item[1].startswith(con) else None,
-                    enum_revs
-                )
-                revs_filter = filter(lambda x: x, revs_map)
-                revs = set(revs_filter)
-
-            return revs
+                # abbreviated or full revision hash
+                return RevisionSet.from_indices(git_ver.find_revisions(con))
         else:
             raise RuntimeError("INTERNAL ERROR")
 
     def impose(self, name: str, con: DependencyConstraint, src: DependencySource, all_cons: list):
         indices = self.req_indices(name, con, src)
+        if src.state.is_locked():
+            if src.state.lock_id in indices:
+                return
+            # solve this dependency again, under all its requirements
+            self.unlock(name, src)
+            for _, pkg_con in all_cons:
+                self.impose(name, pkg_con, src, all_cons)
+            return
+
         if not indices:
             raise RuntimeError(
                 'Dependency {} from {} cannot statisfy requirement {}'.format(
@@ -470,10 +545,10 @@ class DependencyResolver(object):
                     msg_buf = ["Requirement {} conflicts with other requirement on dependency {}"
                                .format(str(con), name), ]
                     cons = []
-                    for pkg_name, con in all_cons:
+                    for pkg_name, pkg_con in all_cons:
                         msg_buf.append(
-                            '\n- package {} requires {}'.format(pkg_name, con))
-                        cons.append(con)
+                            '\n- package {} requires {}'.format(pkg_name, pkg_con))
+                        cons.append(pkg_con)
                     cons = list(unique(cons))
                     msg = ''.join(msg_buf)
                     raise RuntimeError(msg)
@@ -493,6 +568,28 @@ class DependencyResolver(object):
         else:
             raise RuntimeError('INTERNAL ERROR: unreachable')
 
+    def unlock(self, name: str, src: DependencySource):
+        """
+        drop the locked pick of a dependency which no longer satisfies
+        its requirements, the versions are listed from the updated database.
+        """
+        logger.debug('resolve:unlock: locked revision of {} is outdated'.format(name))
+        self.update_versions(name, src)
+        src.state = State.Constrained(RevisionSet.full(len(src.versions.revisions)))
+
+    def reopen(self, name: str, src: DependencySource):
+        """reset a dependency to be solved again, from the updated database if it was locked"""
+        if src.outdated:
+            self.update_versions(name, src)
+        src.state = State.Open()
+
+    def update_versions(self, name: str, src: DependencySource):
+        """list the versions of a dependency from its updated database"""
+        logger.debug('resolve:update_versions: update the versions of {}'.format(name))
+        versions = self.enzi_io.dep_versions(src.id)
+        src.versions = py_copy.copy(versions)
+        src.outdated = False
+
     def cache_git_urls(self, name, dep: config.Dependency, parent=None):
         """
         cache git urls. Raise ValueError when name exists,
@@ -525,13 +622,24 @@ class DependencyResolver(object):
             raise SystemExit(BASE_ESTRING + msg)
         self.git_urls[name] = dep.git_url
 
-    def register_dep(self, name: str, dep: DependencyRef, versions: GitVersions):
+    def register_dep(self, name: str, dep: DependencyRef, versions: GitVersions, lock_id=None):
         logger.debug('resolver.register_dep: name {} {}'.format(name, dep))
         if not name in self.table:
             self.table[name] = Dependency(name)
         entry = self.table[name]
         if not dep in entry.sources:
-            entry.sources[dep] = DependencySource(dep, versions)
+            src = DependencySource(dep, versions)
+            if not lock_id is None:
+                src.state = State.Locked(lock_id)
+                src.outdated = self.skip_locked_fetch
+            entry.sources[dep] = src
+
+    def lock_revision(self, name: str, dep: config.Dependency) -> Optional[str]:
+        """the locked revision of a dependency, None if it is not locked"""
+        locked = self.locked_deps.get(name)
+        if locked is None or str(locked.source) != dep.git_url:
+            return None
+        return locked.revision
 
     def register_dep_in_config(self, deps: typing.MutableMapping[str, config.Dependency], enzi_config: EnziConfig):
         def fn(items):
@@ -540,7 +648,7 @@ class DependencyResolver(object):
             # by seperating it into EnziSession and Enzi
             return (name, self.enzi.load_dependency(name, dep, enzi_config))
 
-        enzi_io = EnziIO(self.enzi)
+        enzi_io = self.enzi_io
 
         # detect conflicts
         m = map(lambda x: self.cache_git_urls(*x, enzi_config), deps.items())
@@ -549,11 +657,37 @@ class DependencyResolver(object):
         names = dict(map(fn, deps.items()))
         dep_ids = set(map(lambda item: item[1], names.items()))
 
-        versions = map(
-            lambda dep_id: (dep_id, enzi_io.dep_versions(dep_id)), dep_ids
-        )
-        versions = dict(versions)
+        lock_revs = {}  # <K=DependencyRef, V=str>
+        for name, dep_id in names.items():
+            rev = self.lock_revision(name, deps[name])
+            if rev:
+                lock_revs[dep_id] = rev
+
+        # fetch the databases of this level concurrently
+        if self.skip_locked_fetch:
+            versions = enzi_io.deps_versions(dep_ids, revisions=lock_revs)
+        else:
+            versions = enzi_io.deps_versions(dep_ids)
 
         for name, dep_id in names.items():
             logger.debug('Registering {} {}'.format(name, dep_id.id))
-            self.register_dep(name, dep_id, py_copy.copy(versions[dep_id]))
+            dep_versions = versions[dep_id]
+            lock_id = None
+            if dep_id in lock_revs:
+                lock_id = dep_versions.index_of(lock_revs[dep_id])
+                if lock_id is None and self.skip_locked_fetch:
+                    # the locked revision is not in the refs any more
+                    dep_versions = enzi_io.dep_versions(dep_id)
+            self.register_dep(name, dep_id, py_copy.copy(dep_versions), lock_id)
+
+
+def new_resolver(enzi: Enzi, **kwargs) -> DependencyResolver:
+    """
+    create the dependency resolver engine selected by enzi.resolver
+    :param locked: the existing lock to keep the picks from
+    :param unlock: the names of the dependencies not to keep
+    """
+    if enzi.resolver == 'backtracking':
+        from enzi.deps_solver import BacktrackingResolver
+        return BacktrackingResolver(enzi, **kwargs)
+    return DependencyResolver(enzi, **kwargs)
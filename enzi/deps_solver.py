@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+"""
+A conflict-driven backtracking dependency resolver, following PubGrub:
+https://github.com/dart-lang/pub/blob/master/doc/solver.md
+
+Packages are dependency names and the versions of a package are the
+revision indices of its GitVersions, so a set of versions is a RevisionSet.
+"""
+
+import itertools
+import logging
+import typing
+from collections import OrderedDict
+
+from enzi.config import Config as EnziConfig
+from enzi.config import DependencyVersion
+from enzi.deps_resolver import DependencyResolver, DependencyConstraint
+from enzi.deps_resolver import RevisionSet, State
+
+logger = logging.getLogger(__name__)
+
+# the package name of the root project, never a valid dependency name
+ROOT = '$root'
+
+# revisions sharing an Enzi.toml are grouped into one dependency
+# incompatibility, if there are not too many candidates to inspect
+GROUP_LIMIT = 256
+
+# relations of a term to the partial solution
+SATISFIED = 'satisfied'
+CONTRADICTED = 'contradicted'
+INCONCLUSIVE = 'inconclusive'
+
+_CONFLICT = object()
+
+
+class Term(object):
+    """
+    A statement about a package: if positive, its pick is in ids,
+    otherwise its pick is not in ids or it is not selected at all.
+    full is the set of all revisions of this package.
+    """
+    __slots__ = ('package', 'ids', 'full', 'positive')
+
+    def __init__(self, package: str, ids: RevisionSet, full: RevisionSet, positive=True):
+        self.package = package
+        self.ids = ids & full
+        self.full = full
+        self.positive = positive
+
+    def inverse(self):
+        return Term(self.package, self.ids, self.full, not self.positive)
+
+    def complement(self) -> RevisionSet:
+        return RevisionSet(self.full.mask & ~self.ids.mask)
+
+    def intersect(self, other):
+        if self.positive and other.positive:
+            return Term(self.package, self.ids & other.ids, self.full)
+        elif self.positive:
+            return Term(self.package, self.ids & other.complement(), self.full)
+        elif other.positive:
+            return Term(self.package, other.ids & self.complement(), self.full)
+        else:
+            ids = RevisionSet(self.ids.mask | other.ids.mask)
+            return Term(self.package, ids, self.full, False)
+
+    def difference(self, other):
+        return self.intersect(other.inverse())
+
+    def is_any(self):
+        """whether this term allows everything"""
+        return not self.positive and not self.ids
+
+    def satisfies(self, other):
+        """whether this term implies the other term"""
+        if self.positive and other.positive:
+            return not self.ids.mask & ~other.ids.mask
+        elif self.positive:
+            return not self.ids.mask & other.ids.mask
+        elif other.positive:
+            return False
+        else:
+            return not other.ids.mask & ~self.ids.mask
+
+    def relation(self, other):
+        """the relation of the other term to this term"""
+        if self.satisfies(other):
+            return SATISFIED
+        if self.positive and other.positive:
+            disjoint = not self.ids.mask & other.ids.mask
+        elif self.positive:
+            disjoint = not self.ids.mask & ~other.ids.mask
+        elif other.positive:
+            disjoint = not other.ids.mask & ~self.ids.mask
+        else:
+            disjoint = False
+        return CONTRADICTED if disjoint else INCONCLUSIVE
+
+    def __repr__(self):
+        return '{}{} {}'.format(
+            '' if self.positive else 'not ', self.package, self.ids)
+
+
+class Incompatibility(object):
+    """
+    A set of terms that must not be all true.
+    kind is 'root', 'dependency', 'no_versions' or 'derived'.
+    A derived incompatibility records the two incompatibilities it comes from,
+    a dependency incompatibility records the (name, DependencyConstraint).
+    """
+
+    def __init__(self, terms: typing.Iterable[Term], kind, causes=None, dep=None):
+        merged = OrderedDict()
+        for term in terms:
+            pre = merged.get(term.package)
+            merged[term.package] = term if pre is None else pre.intersect(term)
+        # a term allows everything is always true, so it can be dropped
+        self.terms: typing.List[Term] = [
+            t for t in merged.values() if not t.is_any()]
+        self.kind = kind
+        self.causes: typing.Optional[typing.Tuple[Incompatibility,
+                                                  Incompatibility]] = causes
+        self.dep: typing.Optional[typing.Tuple[str, DependencyConstraint]] = dep
+
+    def is_failure(self):
+        if not self.terms:
+            return True
+        term = self.terms[0]
+        return len(self.terms) == 1 and term.positive and term.package == ROOT
+
+    def __repr__(self):
+        return 'Incompatibility({}, {})'.format(self.kind, self.terms)
+
+
+class Assignment(Term):
+    """
+    A term in the partial solution, either a decision or derived from cause.
+    """
+    __slots__ = ('level', 'index', 'cause')
+
+    def __init__(self, term: Term, level: int, index: int, cause=None):
+        super().__init__(term.package, term.ids, term.full, term.positive)
+        self.level = level
+        self.index = index
+        self.cause: typing.Optional[Incompatibility] = cause
+
+    def is_decision(self):
+        return self.cause is None
+
+
+class PartialSolution(object):
+    def __init__(self):
+        self.assignments: typing.List[Assignment] = []
+        # the picked revision of decided packages <K=str, V=int>
+        self.decisions: typing.MutableMapping[str, int] = OrderedDict()
+        # intersection of the assignments of each package <K=str, V=Term>
+        self.positive: typing.MutableMapping[str, Term] = OrderedDict()
+        self.negative: typing.MutableMapping[str, Term] = {}
+
+    @property
+    def level(self):
+        return len(self.decisions)
+
+    def decide(self, package, idx, full: RevisionSet):
+        self.decisions[package] = idx
+        term = Term(package, RevisionSet.from_indices([idx]), full)
+        self.assign(Assignment(term, self.level, len(self.assignments)))
+
+    def derive(self, term: Term, cause: Incompatibility):
+        self.assign(Assignment(term, self.level, len(self.assignments), cause))
+
+    def assign(self, assignment: Assignment):
+        self.assignments.append(assignment)
+        self.register(assignment)
+
+    def register(self, assignment: Assignment):
+        package = assignment.package
+        pre = self.positive.get(package)
+        if pre is not None:
+            self.positive[package] = pre.intersect(assignment)
+            return
+        pre = self.negative.get(package)
+        term = assignment if pre is None else pre.intersect(assignment)
+        if term.positive:
+            self.negative.pop(package, None)
+            self.positive[package] = term
+        else:
+            self.negative[package] = term
+
+    def backtrack(self, level):
+        """drop all the assignments made after the given decision level"""
+        assignments = self.assignments
+        while assignments and assignments[-1].level > level:
+            assignment = assignments.pop()
+            if assignment.is_decision():
+                del self.decisions[assignment.package]
+        self.positive, self.negative = OrderedDict(), {}
+        for assignment in assignments:
+            self.register(assignment)
+
+    def relation(self, term: Term):
+        package = term.package
+        pre = self.positive.get(package)
+        if pre is None:
+            pre = self.negative.get(package)
+        if pre is None:
+            return INCONCLUSIVE
+        return pre.relation(term)
+
+    def satisfier(self, term: Term) -> Assignment:
+        """the earliest assignment which makes the solution satisfy term"""
+        acc = None
+        for assignment in self.assignments:
+            if assignment.package != term.package:
+                continue
+            acc = assignment if acc is None else acc.intersect(assignment)
+            if acc.satisfies(term):
+                return assignment
+        raise RuntimeError(
+            'INTERNAL ERROR: {} is not satisfied'.format(term))
+
+    def undecided(self):
+        return [p for p in self.positive if not p in self.decisions]
+
+
+class BacktrackingResolver(DependencyResolver):
+    """
+    A DependencyResolver learns from conflicts and backtracks to older picks,
+    instead of failing on the first conflicting requirements.
+    Enzi.toml is loaded only for decided picks, and at most once for
+    all the revisions sharing the same Enzi.toml.
+    The locked revisions are preferred picks, the databases are always
+    updated, as the domains of the packages are fixed once listed.
+    """
+    skip_locked_fetch = False
+
+    def __init__(self, enzi, **kwargs):
+        super().__init__(enzi, **kwargs)
+        self.solution = PartialSolution()
+        # incompatibilities refer to each package <K=str, V=list[Incompatibility]>
+        self.incompats: typing.MutableMapping[str,
+                                              typing.List[Incompatibility]] = {}
+        # the order of registration, packages near the root are decided first
+        self.order: typing.MutableMapping[str, int] = {ROOT: -1}
+        # all revisions of each package <K=str, V=RevisionSet>
+        self.domains: typing.MutableMapping[str, RevisionSet] = {
+            ROOT: RevisionSet.full(1)}
+        # configs by (name, Enzi.toml hash) <K=(str, str), V=EnziConfig>
+        self.configs: typing.MutableMapping[typing.Tuple[str, str],
+                                            EnziConfig] = {}
+        # config and incompatibilities of visited picks <K=(str, int), V=...>
+        self.pick_configs: typing.MutableMapping[typing.Tuple[str, int],
+                                                 EnziConfig] = {}
+        self.pick_deps: typing.MutableMapping[typing.Tuple[str, int],
+                                              typing.List[Incompatibility]] = {}
+        self.config_loads = 0
+
+    def resolve_table(self):
+        """solve the dependency table, return the number of decisions"""
+        root = Term(ROOT, self.domains[ROOT], self.domains[ROOT], False)
+        self.add_incompat(Incompatibility([root], 'root'))
+
+        decisions = 0
+        package = ROOT
+        while package is not None:
+            self.propagate(package)
+            package = self.decide()
+            decisions += 1
+
+        logger.debug('resolve: {} config loads'.format(self.config_loads))
+        self.fill_table()
+        return decisions
+
+    def register_dep(self, name, dep, versions, lock_id=None):
+        super().register_dep(name, dep, versions, lock_id)
+        if not name in self.order:
+            self.order[name] = len(self.order)
+
+    def full(self, name) -> RevisionSet:
+        if not name in self.domains:
+            versions = self.table[name].source().versions
+            self.domains[name] = RevisionSet.full(len(versions.revisions))
+        return self.domains[name]
+
+    def add_incompat(self, incompat: Incompatibility):
+        for term in incompat.terms:
+            self.incompats.setdefault(term.package, []).append(incompat)
+
+    def propagate(self, package):
+        changed = [package]
+        while changed:
+            package = changed.pop()
+            for incompat in reversed(self.incompats.get(package, [])):
+                res = self.propagate_incompat(incompat)
+                if res is _CONFLICT:
+                    root_cause = self.resolve_conflict(incompat)
+                    changed = [self.propagate_incompat(root_cause)]
+                    break
+                elif res is not None:
+                    changed.append(res)
+
+    def propagate_incompat(self, incompat: Incompatibility):
+        """
+        derive the inverse of the only inconclusive term of incompat,
+        return the package of this term, or _CONFLICT if incompat is satisfied
+        """
+        unsatisfied = None
+        for term in incompat.terms:
+            relation = self.solution.relation(term)
+            if relation == CONTRADICTED:
+                return None
+            elif relation == INCONCLUSIVE:
+                if unsatisfied is not None:
+                    return None
+                unsatisfied = term
+        if unsatisfied is None:
+            return _CONFLICT
+        logger.debug('resolve:propagate: derive {} from {}'.format(
+            unsatisfied.inverse(), incompat))
+        self.solution.derive(unsatisfied.inverse(), incompat)
+        return unsatisfied.package
+
+    def resolve_conflict(self, incompat: Incompatibility):
+        """
+        learn the root cause of a satisfied incompat and backtrack,
+        so that the root cause is almost satisfied.
+        """
+        logger.debug('resolve:conflict: {}'.format(incompat))
+        solution = self.solution
+        new_incompat = False
+        while not incompat.is_failure():
+            satisfier = None
+            satisfier_term = None
+            difference = None
+            previous_level = 1
+            for term in incompat.terms:
+                term_satisfier = solution.satisfier(term)
+                if satisfier is None:
+                    satisfier, satisfier_term = term_satisfier, term
+                elif satisfier.index < term_satisfier.index:
+                    previous_level = max(previous_level, satisfier.level)
+                    satisfier, satisfier_term = term_satisfier, term
+                    difference = None
+                else:
+                    previous_level = max(previous_level, term_satisfier.level)
+
+                if satisfier_term is term:
+                    # the satisfier may be more than enough to satisfy term
+                    difference = satisfier.difference(term)
+                    if difference.positive and not difference.ids:
+                        difference = None
+                    else:
+                        level = solution.satisfier(difference.inverse()).level
+                        previous_level = max(previous_level, level)
+
+            if previous_level < satisfier.level or satisfier.is_decision():
+                solution.backtrack(previous_level)
+                if new_incompat:
+                    self.add_incompat(incompat)
+                return incompat
+
+            terms = [t for t in incompat.terms if not t is satisfier_term]
+            terms.extend(t for t in satisfier.cause.terms
+                         if t.package != satisfier.package)
+            if difference is not None:
+                terms.append(difference.inverse())
+            incompat = Incompatibility(
+                terms, 'derived', causes=(incompat, satisfier.cause))
+            new_incompat = True
+            logger.debug('resolve:conflict: derived {}'.format(incompat))
+
+        msg = self.explain(incompat)
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    def decide(self):
+        """pick a revision for an undecided package, return its name"""
+        solution = self.solution
+        undecided = solution.undecided()
+        if not undecided:
+            return None
+        name = self.next_package(undecided)
+        term = solution.positive[name]
+        if not term.ids:
+            self.add_incompat(Incompatibility([term], 'no_versions'))
+            return name
+
+        idx = self.preferred(name, term.ids)
+        conflict = False
+        for incompat in self.dependencies(name, idx, term.ids):
+            conflict = conflict or all(map(
+                lambda t: t.package == name or solution.relation(t) == SATISFIED,
+                incompat.terms))
+        if not conflict:
+            logger.debug('resolve:decide: pick #{} for {}'.format(idx, name))
+            solution.decide(name, idx, self.full(name))
+        return name
+
+    def next_package(self, undecided: typing.List[str]):
+        """
+        choose the package to decide, a package goes after the undecided
+        packages requiring it, so it is picked under the requirements of
+        all its parents, like DependencyResolver does.
+        """
+        undecided.sort(key=lambda x: self.order[x])
+        required = set()
+        for name in undecided:
+            ids = self.solution.positive[name].ids
+            if ids:
+                incompats = self.dependencies(name, self.preferred(name, ids), ids)
+                required.update(map(lambda x: x.dep[0], incompats))
+        for name in undecided:
+            if not name in required:
+                return name
+        # there is a dependency cycle
+        return undecided[0]
+
+    def preferred(self, name, ids: RevisionSet) -> int:
+        """
+        the revision to try first, the locked one if it is allowed,
+        otherwise the newest one like DependencyResolver.pick
+        """
+        if name in self.table:
+            state = self.table[name].source().state
+            if state.is_locked() and state.lock_id in ids:
+                return state.lock_id
+        return ids.min()
+
+    def dependencies(self, name, idx, allowed: RevisionSet):
+        """
+        add the dependency incompatibilities of the given pick,
+        covering all the revisions in allowed sharing its Enzi.toml.
+        """
+        key = (name, idx)
+        if key in self.pick_deps:
+            return self.pick_deps[key]
+
+        if name == ROOT:
+            econfig, ids = self.enzi.config, self.domains[ROOT]
+        else:
+            econfig, ids = self.dep_config(name, idx, allowed)
+        self.register_dep_in_config(econfig.dependencies, econfig)
+
+        incompats = []
+        for dep_name, dep in econfig.dependencies.items():
+            con = DependencyConstraint.From(dep)
+            src = self.table[dep_name].source()
+            dep_ids = self.req_indices(dep_name, con, src)
+            terms = [Term(name, ids, self.full(name)),
+                     Term(dep_name, dep_ids, self.full(dep_name), False)]
+            incompat = Incompatibility(
+                terms, 'dependency', dep=(dep_name, con))
+            self.add_incompat(incompat)
+            incompats.append(incompat)
+
+        for i in ids:
+            self.pick_configs[(name, i)] = econfig
+            self.pick_deps[(name, i)] = incompats
+        return incompats
+
+    def dep_config(self, name, idx, allowed: RevisionSet):
+        """
+        load the Enzi.toml of the given pick,
+        return it and the revisions in allowed sharing it.
+        """
+        src = self.table[name].source()
+        entry = self.enzi.dependecy(src.id)
+        git_db = self.enzi_io.git_database(entry.name, entry.source.git_url)
+        revisions = src.versions.revisions
+
+        ids = RevisionSet.from_indices([idx])
+        obj_hash = git_db.entry_hash(revisions[idx], 'Enzi.toml')
+        if obj_hash is not None and len(allowed) <= GROUP_LIMIT:
+            same = filter(lambda i: git_db.entry_hash(
+                revisions[i], 'Enzi.toml') == obj_hash, allowed)
+            ids = RevisionSet.from_indices(itertools.chain([idx], same))
+
+        econfig = self.configs.get((name, obj_hash))
+        if econfig is None:
+            version = DependencyVersion.Git(revisions[idx])
+            econfig = self.enzi_io.dep_config_version(src.id, version)
+            self.configs[(name, obj_hash)] = econfig
+            self.config_loads += 1
+        return econfig, ids
+
+    def fill_table(self):
+        """record the decisions in the dependency table"""
+        decisions = self.solution.decisions
+        for name in list(self.table.keys()):
+            if not name in decisions:
+                # registered by a pick which is not in the solution
+                del self.table[name]
+                continue
+            idx = decisions[name]
+            dep = self.table[name]
+            for src in dep.sources.values():
+                src.state = State.Pick(idx, RevisionSet.from_indices([idx]))
+            dep.config = self.pick_configs[(name, idx)]
+
+    def describe(self, name, ids: RevisionSet):
+        if name == ROOT:
+            return 'package {}'.format(self.enzi.name)
+        versions = self.table[name].source().versions
+        descs = []
+        for idx in itertools.islice(ids, 3):
+            rev = versions.revisions[idx]
+            version = versions.find_version(rev)
+            descs.append(str(version) if version else rev[:8])
+        if len(ids) > 3:
+            descs.append('...')
+        return '{} {}'.format(name, ', '.join(descs))
+
+    def explain(self, incompat: Incompatibility):
+        """explain the failure by the external incompatibilities it comes from"""
+        msg_buf = ['Dependency resolution failed, because:']
+        visited = set()
+
+        def walk(incompat: Incompatibility):
+            if incompat.causes:
+                for cause in incompat.causes:
+                    walk(cause)
+                return
+            if id(incompat) in visited or incompat.kind == 'root':
+                return
+            visited.add(id(incompat))
+            terms = incompat.terms
+            if incompat.kind == 'dependency':
+                dep_name, con = incompat.dep
+                msg = '{} requires {} {}'.format(
+                    self.describe(terms[0].package, terms[0].ids), dep_name, con)
+                if len(terms) == 1:
+                    msg += ', which matches no revision'
+            else:
+                msg = 'no revision of {} is available'.format(terms[0].package)
+            msg_buf.append('\n- ' + msg)
+
+        walk(incompat)
+        return ''.join(msg_buf)
@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import mmap
 import os
 import platform
 import pprint
 import re
 import shutil
+import threading
+import typing
 import copy as py_copy
 
 from collections.abc import Iterable
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from enum import Enum, unique
+from hashlib import blake2b
 
 from ordered_set import OrderedSet
-from enzi.utils import flat_map, rmtree_onerror
+from enzi.utils import flat_map, rmtree_onerror, FileLock
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +37,10 @@ class FileManagerStatus(Enum):
     EXIST = 4
 
 
-RE = re.compile(r'`include\s*"(.*)"')
+# `include lines of the raw bytes of a source file, matched without decoding
+INCLUDE_RE = re.compile(rb'^[ \t\f\v\r]*`include[ \t]*"([^"\r\n]*)"', re.M)
+# source files of at least this size are scanned through mmap
+MMAP_THRESHOLD = 1 << 20
 
 
 class Fileset(object):
@@ -49,12 +58,29 @@ class Fileset(object):
         self.files = files
         self.inc_dirs = OrderedDict()
         self.inc_files = OrderedSet()
+        # include graph, <K=file, V=OrderedSet of the files it includes>
+        self.inc_graph = OrderedDict()
 
     def get_flat_incdirs(self):
         """return a flat include directories *generator*, only return flat values of self.inc_dirs"""
         fm = flat_map(lambda x: x, self.inc_dirs.values())
         return fm
 
+    def get_includes(self, file):
+        """return all the files included by the given file, directly or not"""
+        ret = OrderedSet()
+        queue = deque([file])
+        while queue:
+            for include_file in self.inc_graph.get(queue.popleft(), ()):
+                if include_file not in ret:
+                    ret.add(include_file)
+                    queue.append(include_file)
+        return ret
+
+    def affected_files(self, inc_file):
+        """return the files of this fileset which include the given file, directly or not"""
+        return OrderedSet(filter(lambda x: inc_file in self.get_includes(x), self.files))
+
     def is_empty(self):
         if not (self.files or self.inc_dirs or self.inc_files):
             return True
@@ -67,6 +93,7 @@ class Fileset(object):
         self.files = other.files
         self.inc_dirs = other.inc_dirs
         self.inc_files = other.inc_files
+        self.inc_graph = other.inc_graph
 
     def dedup(self):
         """dedup files which are include files"""
@@ -82,6 +109,8 @@ class Fileset(object):
         ret.inc_dirs.update(self.inc_dirs)
         ret.inc_dirs.update(other.inc_dirs)
         ret.inc_files = self.inc_files | other.inc_files
+        ret.inc_graph.update(self.inc_graph)
+        ret.inc_graph.update(other.inc_graph)
         return ret
 
     def merge(self, other):
@@ -90,6 +119,7 @@ class Fileset(object):
         self.files |= other.files
         self.inc_dirs.update(other.inc_dirs)
         self.inc_files |= other.inc_files
+        self.inc_graph.update(other.inc_graph)
 
     def add_file(self, file):
         self.files.add(file)
@@ -102,6 +132,11 @@ class Fileset(object):
 
     def add_inc_file(self, inc_file):
         self.inc_files.add(inc_file)
+
+    def add_include(self, file, inc_file):
+        if file not in self.inc_graph:
+            self.inc_graph[file] = OrderedSet()
+        self.inc_graph[file].add(inc_file)
     
     def __getitem__(self, key):
         return getattr(self, key)
@@ -114,16 +149,109 @@ class Fileset(object):
         ret['files'] = self.files
         ret['inc_dirs'] = self.inc_dirs
         ret['inc_files'] = self.inc_files
+        ret['inc_graph'] = self.inc_graph
         return ret
 
 
+# how LocalFiles finds the changed files: by size and mtime, or by content
+SYNC_MODES = ('stat', 'hash')
+# how LocalFiles materializes the files in the build directory
+LINK_MODES = ('copy', 'hardlink', 'symlink')
+# the files materialized by the last fetch of each LocalFiles sharing a files_root
+SYNC_MANIFEST = '.enzi-files'
+
+# include scan cache file inside the build directory
+INCLUDE_CACHE = 'enzi-includes.json'
+INCLUDE_CACHE_SCHEMA = 2
+
+
+class IncludeCache(object):
+    """
+    An in-memory and on-disk cache of the `include lines of source files,
+    keyed by the path of the file and validated by its stat, so that only
+    the changed files are scanned again. The inode and ctime are part of the
+    stat, since an exported file gets the commit time in whole seconds.
+    """
+
+    def __init__(self, cache_path):
+        self.path = cache_path
+        # <K=file path, V=[mtime_ns, size, inode, ctime_ns, include files]>, loaded lazily
+        self.entries: typing.Optional[typing.MutableMapping[str, list]] = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load_file(self) -> dict:
+        """load the entries from the cache file, empty if there is no valid cache"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('schema') == INCLUDE_CACHE_SCHEMA:
+                return data['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            fmt = 'IncludeCache: ignore invalid cache {}: {}'
+            logger.debug(fmt.format(self.path, e))
+        return {}
+
+    def include_files(self, file, scan):
+        """
+        get the include files of the given file,
+        scan(file) returns them and is only called on cache miss.
+        """
+        stat = os.stat(file)
+        key = [stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_ctime_ns]
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load_file()
+            entry = self.entries.get(file)
+            if entry and entry[:4] == key:
+                self.hits += 1
+                return list(entry[4])
+            self.misses += 1
+        include_files = list(scan(file))
+        with self.lock:
+            self.entries[file] = key + [include_files]
+            self.dirty = True
+        return include_files
+
+    def dump(self):
+        """write the cache file if there are new entries, merged with the existing file"""
+        with self.lock:
+            fmt = 'IncludeCache: {} hits, {} misses'
+            logger.debug(fmt.format(self.hits, self.misses))
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with FileLock(self.path + '.lock'):
+                files = self.load_file()
+                files.update(self.entries)
+                data = {'schema': INCLUDE_CACHE_SCHEMA, 'files': files}
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            self.dirty = False
+            logger.debug('IncludeCache: dumped to {}'.format(self.path))
+
+
 class IncDirsResolver:
     """An Include Directories Resolver for SystemVerilog/Verilog files"""
     VEXT = ('.vh', 'svh', 'v', 'sv')
 
-    def __init__(self, files_root, files=None):
+    def __init__(self, files_root, files=None, *, include_cache: IncludeCache = None, jobs=1):
         self.files_root = files_root
         self.dfiles_cache = dict()
+        # the persistent cache of the scanned include files, if any
+        self.include_cache = include_cache
+        # number of workers scanning the files
+        self.jobs = jobs
+        # <K=file path, V=include files>, scanned ahead by resolve
+        self.include_files = dict()
+        # <K=file path, V=[(include dir, include file)]>, memoized in a resolve
+        self.includes = dict()
         if files:
             if files_root:
                 f = lambda x: os.path.normpath(os.path.join(files_root, x))
@@ -143,13 +271,32 @@ class IncDirsResolver:
         else:
             self.fileset.merge(files)
 
+    def scan_files(self, files):
+        """
+        scan the include files of the given files concurrently,
+        with at most self.jobs workers.
+        :return: dict, <K=file path, V=include files>
+        """
+        files = list(filter(lambda x: x.endswith(self.VEXT), files))
+        def scan(x): return list(self.get_include_files(x))
+        if self.jobs <= 1 or len(files) <= 1:
+            return dict(zip(files, map(scan, files)))
+        workers = min(self.jobs, len(files))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(files, executor.map(scan, files)))
+
     def resolve(self):
+        # the files are read concurrently, but merged into the fileset
+        # in the order of the files, so that inc_dirs is stable
+        self.include_files = self.scan_files(self.fileset.files)
         _ = set(map(self.extract_include_dirs, self.fileset.files))
         self.fileset.dedup()
         if FM_DEBUG:
             pfmt = pprint.pformat(self.fileset.dump_dict())
             logger.debug("resolved: \n{}".format(pfmt))
         self.dfiles_cache = dict()
+        self.include_files = dict()
+        self.includes = dict()
         return self.fileset
 
     def check_include_files(self, files_root, *, clogger=None):
@@ -184,49 +331,84 @@ class IncDirsResolver:
 
     def get_include_files(self, file):
         """return a iterator of include files of the given file"""
+        if self.include_cache is not None:
+            return iter(self.include_cache.include_files(file, self.scan_include_files))
+        return iter(self.scan_include_files(file))
+
+    def scan_include_files(self, file):
+        """read the given file and return a list of its include files"""
         with open(file, 'rb') as f:
-            data = f.read().decode('utf-8')
-            lines = data.splitlines()
-            m = map(str.strip, lines)
-            ft = filter(lambda x: x.startswith('`include'), m)
-            ex = map(lambda x: RE.search(x).group(1), ft)
-            return ex
+            if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+                return self.match_include_files(f.read())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self.match_include_files(data)
 
-    def extract_include_dirs(self, file):
-        if not file.endswith(self.VEXT):
-            return
-        fs = self.fileset
+    @staticmethod
+    def match_include_files(data):
+        """
+        find the include files in the raw bytes of a source file,
+        generated netlists without any include are skipped by a single find.
+        """
+        if data.find(b'`include') < 0:
+            return []
+        # the bytes of the paths are kept as is, even if not utf-8
+        return [x.decode('utf-8', 'surrogateescape') for x in INCLUDE_RE.findall(data)]
+
+    def resolve_includes(self, file):
+        """
+        return the resolved include directories and include files of the given file,
+        as a list of (include dir, include file), each file is only parsed once in a resolve.
+        """
+        if file in self.includes:
+            return self.includes[file]
         dirname = os.path.dirname(file)
         if not dirname in self.dfiles_cache:
             dir_files = set(os.listdir(dirname))
             self.dfiles_cache[dirname] = dir_files
         else:
             dir_files = self.dfiles_cache[dirname]
-        fs.add_inc_dir(file, dirname)
 
-        include_files = list(self.get_include_files(file))
-        if not include_files:
-            return
+        include_files = self.include_files.get(file)
+        if include_files is None:
+            include_files = list(self.get_include_files(file))
 
+        ret = []
         for include_file in include_files:
             dname = os.path.dirname(include_file)
             if dname and platform.system() == 'Windows':
                 dname = dname.replace('/', '\\')
             if dname:
-                incdir = os.path.join(dirname, dname)
+                incdir = os.path.normpath(os.path.join(dirname, dname))
                 if os.path.exists(incdir):
                     fname = os.path.basename(include_file)
-                    include_file = os.path.join(incdir, fname)
-                    fs.add_inc_dir(file, incdir)
-                    fs.add_inc_file(include_file)
+                    ret.append((incdir, os.path.join(incdir, fname)))
                 else:
                     msg = '{} is not exists'.format(incdir)
                     logger.debug(msg)
             else:
                 if include_file in dir_files:
-                    include_file = os.path.join(dirname, include_file)
-                    fs.add_inc_dir(file, dirname)
-                    fs.add_inc_file(include_file)
+                    ret.append((dirname, os.path.join(dirname, include_file)))
+        self.includes[file] = ret
+        return ret
+
+    def extract_include_dirs(self, file):
+        if not file.endswith(self.VEXT):
+            return
+        fs = self.fileset
+        fs.add_inc_dir(file, os.path.dirname(file))
+
+        # the include files of the include files are needed to compile the file too
+        visited = {file}
+        queue = deque([file])
+        while queue:
+            current = queue.popleft()
+            for incdir, include_file in self.resolve_includes(current):
+                fs.add_inc_dir(file, incdir)
+                fs.add_inc_file(include_file)
+                fs.add_include(current, include_file)
+                if include_file not in visited and os.path.isfile(include_file):
+                    visited.add(include_file)
+                    queue.append(include_file)
 
 
 class FileManager(object):
@@ -273,37 +455,128 @@ def join_path(root, file_path):
     return os.path.normpath(os.path.join(root, file_path))
 
 
+def file_digest(path):
+    h = blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.digest()
+
+
 class LocalFiles(FileManager):
     # def __init__(self, name, config, proj_root, files_root):
-    def __init__(self, name, config, proj_root, files_root, build_root=None):
+    def __init__(self, name, config, proj_root, files_root, build_root=None, *,
+                 include_cache=None, jobs=1, sync_mode='stat', link_mode='copy'):
         config['local'] = True  # LocalFiles must be local
         super(LocalFiles, self).__init__(name, config, proj_root, files_root)
         if not 'fileset' in config:
             raise RuntimeError('LocalFiles must be initilized with a fileset')
+        if not sync_mode in SYNC_MODES:
+            raise ValueError('sync_mode must be one of {}'.format(SYNC_MODES))
+        if not link_mode in LINK_MODES:
+            raise ValueError('link_mode must be one of {}'.format(LINK_MODES))
 
         files = config['fileset'].get('files', [])
         files_map = map(lambda p: os.path.normpath(p), files)
         self.fileset = Fileset()
         self.fileset.files = OrderedSet(files_map)
         self.build_root = build_root
-        self.resolver = IncDirsResolver(files_root, [])
+        self.sync_mode = sync_mode
+        self.link_mode = link_mode
+        self.resolver = IncDirsResolver(files_root, [], include_cache=include_cache, jobs=jobs)
         self.cache_files = Fileset()
+        # number of files written by the last fetch
+        self.writes = 0
+
+    def is_synced(self, src_file, dst_file):
+        """whether dst_file is up to date with src_file"""
+        if self.link_mode == 'symlink':
+            return os.path.islink(dst_file) and os.readlink(dst_file) == src_file
+        if os.path.islink(dst_file) or not os.path.exists(dst_file):
+            return False
+        if self.link_mode == 'hardlink' and os.path.samefile(src_file, dst_file):
+            return True
+        src_stat, dst_stat = os.stat(src_file), os.stat(dst_file)
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        if self.sync_mode == 'hash':
+            return file_digest(src_file) == file_digest(dst_file)
+        return src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+    def sync_file(self, src_file, dst_file):
+        """materialize src_file as dst_file, keep the mtime of src_file"""
+        if os.path.lexists(dst_file):
+            os.remove(dst_file)
+        if self.link_mode == 'symlink':
+            os.symlink(src_file, dst_file)
+            return
+        if self.link_mode == 'hardlink':
+            try:
+                os.link(src_file, dst_file)
+                return
+            except OSError as e:
+                fmt = 'LocalFiles({}): cannot hardlink {}, copy it instead: {}'
+                logger.debug(fmt.format(self.name, src_file, e))
+        shutil.copy2(src_file, dst_file)
+
+    def load_manifest(self):
+        """
+        the files of the last fetch of each LocalFiles in files_root, relative to it.
+        :return: dict, <K=LocalFiles name, V=list of files>
+        """
+        try:
+            with open(os.path.join(self.files_root, SYNC_MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def remove_stale(self, stale_files):
+        """remove the files that left the fileset, and their empty directories"""
+        for file in stale_files:
+            dst_file = join_path(self.files_root, file)
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)
+                self.writes += 1
+            dst_dir = os.path.dirname(dst_file)
+            while dst_dir != self.files_root and os.path.isdir(dst_dir) and not os.listdir(dst_dir):
+                os.rmdir(dst_dir)
+                dst_dir = os.path.dirname(dst_dir)
 
     def fetch(self):
+        """sync the files of the fileset into files_root, only the changed files are written"""
+        self.writes = 0
         for file in self.fileset.files:
             src_file = join_path(self.proj_root, file)
             dst_file = join_path(self.files_root, file)
 
             if os.path.exists(src_file):
-                dst_dir = os.path.dirname(dst_file)
-                if not os.path.exists(dst_dir):
-                    os.makedirs(dst_dir)
-                shutil.copyfile(src_file, dst_file)
+                if not self.is_synced(src_file, dst_file):
+                    dst_dir = os.path.dirname(dst_file)
+                    if not os.path.exists(dst_dir):
+                        os.makedirs(dst_dir)
+                    self.sync_file(src_file, dst_file)
+                    self.writes += 1
                 self.cache_files.files.add(dst_file)
             else:
                 msg = 'File {} not found.'.format(src_file)
                 logger.error(msg)
                 raise FileNotFoundError(msg)
+
+        files = list(self.fileset.files)
+        manifest = self.load_manifest()
+        last_files = manifest.get(self.name)
+        if last_files != files:
+            if last_files:
+                # the files of the other targets in the same files_root are kept
+                kept = set(files).union(*(v for k, v in manifest.items() if k != self.name))
+                self.remove_stale(set(last_files) - kept)
+            manifest[self.name] = files
+            os.makedirs(self.files_root, exist_ok=True)
+            with open(os.path.join(self.files_root, SYNC_MANIFEST), 'w') as f:
+                json.dump(manifest, f)
+        fmt = 'LocalFiles({}): {} of {} files written'
+        logger.debug(fmt.format(self.name, self.writes, len(files)))
         self.status = FileManagerStatus.FETCHED
         self.resolver.update_files(self.cache_files)
 
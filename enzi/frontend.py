@@ -10,15 +10,25 @@ import networkx as nx
 import enzi.project_manager
 from enzi import config
 from enzi.backend import KnownBackends
-from enzi.config import RawConfig
+from enzi.config import ConfigCache, CONFIG_CACHE, Sidecar, SIDECAR
 from enzi.config import DependencyRef, DependencySource
 from enzi.config import DependencyVersion, DependencyEntry, DependencyTable
-from enzi.git import Git, GitVersions, TreeEntry
+from enzi.file_manager import IncludeCache, INCLUDE_CACHE, SYNC_MODES, LINK_MODES
+from enzi.git import Git, GitVersions, TreeEntry, CHECKOUT_MODES
 from enzi.lock import LockLoader
 from enzi.utils import realpath, PathBuf
 
 logger = logging.getLogger('Enzi')
 
+# default number of workers for concurrent git database operations and file scans
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+
+# dependency resolver engines, see enzi.deps_resolver.new_resolver
+RESOLVERS = ('fixpoint', 'backtracking')
+
+# environment variable of the default shared database directory
+SHARED_CACHE_ENV = 'ENZI_SHARED_CACHE'
+
 
 def opts2str(opts):
     if type(opts) == list:
@@ -36,14 +46,22 @@ class Enzi(object):
         self.build_dir = os.path.join(self.work_dir, 'build')
         work_root_config = os.path.join(self.work_dir, config_name)
         self.config_path = work_root_config
+        # never access the remotes of dependencies, use the existing databases
+        self.offline = kwargs.get('offline', False)
+        # the validated Enzi.toml and Enzi.lock of the last run
+        self.sidecar = Sidecar(os.path.join(self.build_dir, SIDECAR))
         if os.path.exists(work_root_config):
-            config = RawConfig(work_root_config).validate()
+            config = self.sidecar.config(
+                work_root_config, check_deps=not self.offline)
             self.config = config
         else:
             raise RuntimeError('No {} in this directory.'.format(config_name))
 
         # mitime in nanosecond
         self.config_mtime = self.config.file_stat.st_mtime_ns
+        # content hashes, the lock is only outdated when deps_hash changes
+        self.config_hash = self.config.digest()
+        self.deps_hash = self.config.deps_digest()
         # targets is a reference for self.config.targets for convenience.
         self.targets = config.targets
         self.is_local = config.is_local
@@ -58,28 +76,25 @@ class Enzi(object):
         self.known_backends = KnownBackends()
         self.backend_conf_generator = BackendConfigGen(self.known_backends)
 
-        # database
-        self.database_path: PathBuf = PathBuf(self.build_dir).join('database')
+        # database, the git databases and the config cache can be shared
+        # by all the projects on this machine, see EnziIO.git_db_dir
+        shared_cache = kwargs.get('shared_cache') or os.environ.get(SHARED_CACHE_ENV)
+        self.shared_cache = bool(shared_cache)
+        if shared_cache:
+            self.database_path: PathBuf = PathBuf(realpath(shared_cache))
+        else:
+            self.database_path: PathBuf = PathBuf(self.build_dir).join('database')
         self.build_deps_path: PathBuf = PathBuf(self.build_dir).join('deps')
         self.git_db_records: typing.MutableMapping[str,
                                                    typing.MutableSet[str]] = {}
+        # validated Enzi.toml of git dependencies, shared by all EnziIOs
+        self.config_cache = ConfigCache(
+            self.database_path.join(CONFIG_CACHE).path, check_deps=not self.offline)
+        # the include files of the source files of this project and its dependencies
+        self.include_cache = IncludeCache(os.path.join(self.build_dir, INCLUDE_CACHE))
 
-        # check if we need update database
-        potential_lock_file = os.path.join(self.work_dir, 'Enzi.lock')
         self.locked = None
-        if os.path.exists(potential_lock_file) and not self.config.dependencies:
-            self.need_update = False
-        elif os.path.exists(potential_lock_file) and self.database_path.exists():
-            self.need_update = False
-        elif os.path.exists(potential_lock_file) and not self.database_path.exists():
-            if self.config.dependencies:
-                logger.warning(
-                    'no database directory found, but there is an Enzi.lock file.')
-                logger.warning('Create a new database.')
-            self.need_update = True
-        else:
-            self.need_update = None
-        
+
         self.deps_graph = nx.DiGraph()
         self.initialized = False
 
@@ -88,15 +103,75 @@ class Enzi(object):
         non_lazy = kwargs.get('non_lazy', False)
         self.non_lazy_configure = non_lazy
 
-    def init(self, *, update=False):
+        # number of workers for concurrent git database operations and file scans
+        jobs = kwargs.get('jobs')
+        if jobs is None:
+            jobs = DEFAULT_JOBS
+        if type(jobs) != int or jobs < 1:
+            raise ValueError('jobs must be a positive integer')
+        self.jobs = jobs
+
+        # seconds since the last fetch in which a git database is not fetched
+        # again, unless it is updated explicitly, None for no limit
+        fetch_ttl = kwargs.get('fetch_ttl')
+        if not fetch_ttl is None and (type(fetch_ttl) not in (int, float) or fetch_ttl < 0):
+            raise ValueError('fetch_ttl must be a non-negative number')
+        self.fetch_ttl = fetch_ttl
+
+        # how to check out new dependency repositories from their databases
+        checkout_mode = kwargs.get('checkout_mode')
+        if checkout_mode is None:
+            checkout_mode = CHECKOUT_MODES[0]
+        if not checkout_mode in CHECKOUT_MODES:
+            raise ValueError('checkout_mode must be one of {}'.format(CHECKOUT_MODES))
+        self.checkout_mode = checkout_mode
+        # whether to check out only the directories of the dependencies' filesets
+        self.sparse_checkout = kwargs.get('sparse_checkout', False)
+
+        # how to find and materialize the changed files of this project in the build directory
+        sync_mode = kwargs.get('sync_mode')
+        if sync_mode is None:
+            sync_mode = SYNC_MODES[0]
+        if not sync_mode in SYNC_MODES:
+            raise ValueError('sync_mode must be one of {}'.format(SYNC_MODES))
+        self.sync_mode = sync_mode
+        link_mode = kwargs.get('link_mode')
+        if link_mode is None:
+            link_mode = LINK_MODES[0]
+        if not link_mode in LINK_MODES:
+            raise ValueError('link_mode must be one of {}'.format(LINK_MODES))
+        self.link_mode = link_mode
+
+        # whether to create new git databases as blob-less partial clones
+        self.partial_clone = kwargs.get('partial_clone', False)
+        # whether to fetch the existing git databases even if they were
+        # fetched after the last modification of Enzi.toml, set by init(update=True)
+        self.fetch_databases = False
+        # the dependencies to update, the others keep their locked revisions
+        self.update_deps: typing.Set[str] = set()
+
+        # the dependency resolver engine
+        resolver = kwargs.get('resolver')
+        if resolver is None:
+            resolver = RESOLVERS[0]
+        if not resolver in RESOLVERS:
+            raise ValueError('resolver must be one of {}'.format(RESOLVERS))
+        self.resolver = resolver
+
+    def init(self, *, update=False, deps=None):
         """
         Initialize the Enzi object, resolve dependencies and etc.
+        :param deps: the dependencies to update, all dependencies if None
         """
         if self.initialized:
             return
 
-        if not self.need_update is None:
-            update |= self.need_update
+        self.update_deps = set(deps or ())
+        # the databases are kept on relock, an explicit update must fetch them
+        self.fetch_databases = update and not self.update_deps
+
+        # missing databases are detected by LockLoader,
+        # which creates them without dropping the locked revisions
 
         # TODO: add more useful data in lock file
         msg = 'Enzi:init: this project has dependencies, launching LockLoader'
@@ -106,7 +181,8 @@ class Enzi(object):
             msg = 'Enzi:init: launching LockLoader'
         
         logger.debug(msg)
-        locked = LockLoader(self, self.work_dir).load(update)
+        lock_loader = LockLoader(self, self.work_dir)
+        locked = lock_loader.load(update, deps=self.update_deps)
 
         if locked.cache and 'git' in locked.cache:
             self.git_db_records = locked.cache['git']
@@ -118,13 +194,14 @@ class Enzi(object):
         logger.debug('Enzi:init: locked deps:\n{}'.format(dep_msg))
         logger.debug('Enzi:init: locked caches:\n{}'.format(cache_msg))
 
-        if self.config_mtime != locked.config_mtime:
+        if lock_loader.config_changed:
             self.non_lazy_configure = True
 
         if not self.config.dependencies:
             logger.debug('Enzi:init: this project has no dependencies')
 
         self.init_deps_graph()
+        self.sidecar.dump()
         self.initialized = True
 
     def init_deps_graph(self):
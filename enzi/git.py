@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import json
 import logging
 import os
 import pprint
+import re
 import shutil
 import subprocess
 import semver
+import tarfile
+import threading
+import time
 import typing
 import copy as py_copy
+from collections import OrderedDict
+from hashlib import blake2b
 from ordered_set import OrderedSet
 
 from enzi.config import RawConfig, validate_git_repo, Config
@@ -17,6 +25,64 @@ from enzi.utils import Launcher, realpath, rmtree_onerror
 
 logger = logging.getLogger(__name__)
 
+# refspecs for fetching branches and tags in a single negotiation
+FETCH_BRANCHES_REFSPEC = '+refs/heads/*:refs/remotes/{}/*'
+FETCH_TAGS_REFSPEC = '+refs/tags/*:refs/tags/*'
+# refs pinning the checked out revisions in a database, outside of the refs
+# pruned by Git.fetch, so that the checkouts sharing its objects keep them
+PIN_REF_PREFIX = 'refs/enzi/pins/'
+# filter for partial clone databases, which only contain commits and trees
+PARTIAL_CLONE_FILTER = 'blob:none'
+# max number of objects to request in a single prefetch
+PREFETCH_BATCH = 1000
+# environment of git in the offline mode, a partial clone never fetches
+# its missing objects from the promisor remote (honored since git 2.44)
+OFFLINE_ENV = {'GIT_NO_LAZY_FETCH': '1'}
+# how GitRepo checks out a dependency from its database:
+# clone copies the objects, shared borrows them through alternates,
+# worktree adds a worktree of the database,
+# export extracts the files of the revision without a working tree
+CHECKOUT_MODES = ('clone', 'shared', 'worktree', 'export')
+# stamp file of a dependency, records the materialized revision and fileset
+STAMP_FILE = '.enzi-stamp'
+STAMP_SCHEMA = 2
+
+
+# scp-like syntax of ssh urls, i.e. [user@]host:path
+SCP_LIKE_URL = re.compile(r'^(?:([^@/]+)@)?([^:/]{2,}):(?!//)(.*)$')
+
+
+def normalize_git_url(git_url: str) -> str:
+    """
+    normalize a git url to compare and key the git databases, the host is
+    lower-cased, scp-like urls become ssh:// urls, the trailing slash and
+    .git are dropped, local paths become real paths.
+    """
+    url = git_url.strip()
+    if url.startswith('file://'):
+        return realpath(url[len('file://'):])
+    if '://' in url:
+        scheme, rest = url.split('://', 1)
+        netloc, _, path = rest.partition('/')
+        user, at, host = netloc.rpartition('@')
+        url = '{}://{}{}{}/{}'.format(scheme.lower(), user, at, host.lower(), path)
+    else:
+        match = SCP_LIKE_URL.match(url)
+        if not match:
+            return realpath(url)
+        user, host, path = match.groups()
+        user = user + '@' if user else ''
+        url = 'ssh://{}{}/{}'.format(user, host.lower(), path.lstrip('/'))
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url
+
+
+def min_version(major: int):
+    """the smallest possible version of a major version, i.e. <major>.0.0-0"""
+    return semver.VersionInfo(major, 0, 0, prerelease='0')
+
 
 class GitVersions(object):
     def __init__(self, versions, refs, revisions):
@@ -28,6 +94,70 @@ class GitVersions(object):
         self.versions: typing.List[typing.Tuple[semver.VersionInfo, str]] = versions
         self.refs: typing.MutableMapping[str, str] = refs
         self.revisions: typing.List[str] = revisions
+        # indexes, <K=revision, V=index in revisions>
+        self.rev_index: typing.MutableMapping[str, int] = dict(
+            map(lambda x: (x[1], x[0]), enumerate(revisions)))
+        # sorted revisions, for looking up abbreviated hashes
+        self.sorted_revisions: typing.List[str] = sorted(revisions)
+        # sorted versions only, for range queries
+        self.versions.sort()
+        self.version_keys: typing.List[semver.VersionInfo] = list(
+            map(lambda x: x[0], versions))
+        # <K=revision, V=the max version tagged at this revision>
+        self.rev_version: typing.MutableMapping[str, semver.VersionInfo] = dict(
+            map(lambda x: (x[1], x[0]), versions))
+
+    def index_of(self, rev: str) -> typing.Optional[int]:
+        """return the index of a full revision hash, None if not found"""
+        return self.rev_index.get(rev)
+
+    def find_revisions(self, prefix: str) -> typing.List[int]:
+        """return the indices of all the revisions starting with the given prefix"""
+        revs = self.sorted_revisions
+        idx = bisect.bisect_left(revs, prefix)
+        ret = []
+        while idx < len(revs) and revs[idx].startswith(prefix):
+            ret.append(self.rev_index[revs[idx]])
+            idx += 1
+        return ret
+
+    def matching_versions(self, req) -> typing.List[typing.Tuple[semver.VersionInfo, str]]:
+        """
+        return the versions which match the given enzi.ver.VersionReq.
+        Only versions inside the req's major range are checked.
+        """
+        lo, hi = req.major_range()
+        start, end = 0, len(self.versions)
+        if lo is not None:
+            start = bisect.bisect_left(self.version_keys, min_version(lo))
+        if hi is not None:
+            end = bisect.bisect_left(self.version_keys, min_version(hi + 1))
+        candidates = self.versions[start:end]
+        return list(filter(lambda x: req.matches(x[0]), candidates))
+
+    def find_version(self, rev: str) -> typing.Optional[semver.VersionInfo]:
+        """return the max version tagged at the given revision, None if not tagged"""
+        return self.rev_version.get(rev)
+
+    def dumps(self):
+        """
+        dump this GitVersions to a dict, which only contains json types
+        """
+        versions = list(map(lambda x: [str(x[0]), x[1]], self.versions))
+        return {
+            'versions': versions,
+            'refs': dict(self.refs),
+            'revisions': self.revisions
+        }
+
+    @staticmethod
+    def loads(data: dict):
+        """
+        load a GitVersions from a given dict generated by GitVersions.dumps
+        """
+        versions = list(map(lambda x: (semver.VersionInfo.parse(x[0]), x[1]),
+                            data['versions']))
+        return GitVersions(versions, data['refs'], data['revisions'])
 
     def __repr__(self):
         str_buf = ['GitVersions {']
@@ -69,6 +199,87 @@ class TreeEntry(object):
             self.name, self.hash, self.kind)
 
 
+class GitObjectReader(object):
+    """
+    A long-lived `git cat-file --batch` coprocess for a git database.
+    Objects are requested by any name git understands, like <hash> or
+    <rev>:<path>, so a tree lookup and a blob read costs a single request.
+    The `--batch-check` coprocess is only started when info is requested.
+    """
+
+    def __init__(self, path, env=None):
+        self.path = path
+        self.env = env
+        self._batch: typing.Optional[subprocess.Popen] = None
+        self._batch_check: typing.Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def _spawn(self, mode):
+        logger.debug('GitObjectReader: start cat-file {} at {}'.format(
+            mode, self.path))
+        return subprocess.Popen(
+            ['git', 'cat-file', mode],
+            cwd=self.path,
+            env=self.env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+
+    @staticmethod
+    def _request(proc: subprocess.Popen, name):
+        proc.stdin.write(name.encode('utf-8') + b'\n')
+        proc.stdin.flush()
+        header = proc.stdout.readline()
+        if not header:
+            raise RuntimeError(
+                'GitObjectReader: cat-file exited unexpectedly')
+        fields = header.split()
+        # <name> missing | <name> ambiguous, the name may contain spaces
+        if fields[-1] in (b'missing', b'ambiguous'):
+            return None
+        obj_hash, obj_type, size = fields
+        return (obj_hash.decode('utf-8'), obj_type.decode('utf-8'), int(size))
+
+    def info(self, name):
+        """
+        return (hash, type, size) of the given object name, None if missing
+        """
+        with self._lock:
+            if self._batch_check is None:
+                self._batch_check = self._spawn('--batch-check')
+            self.requests += 1
+            return self._request(self._batch_check, name)
+
+    def read(self, name):
+        """
+        return (hash, type, content: bytes) of the given object name, None if missing
+        """
+        with self._lock:
+            if self._batch is None:
+                self._batch = self._spawn('--batch')
+            self.requests += 1
+            header = self._request(self._batch, name)
+            if header is None:
+                return None
+            obj_hash, obj_type, size = header
+            data = self._batch.stdout.read(size)
+            # the content is followed by a LF
+            self._batch.stdout.read(1)
+            return (obj_hash, obj_type, data)
+
+    def close(self):
+        with self._lock:
+            for proc in (self._batch, self._batch_check):
+                if proc is None:
+                    continue
+                proc.stdin.close()
+                proc.wait()
+                proc.stdout.close()
+            self._batch = None
+            self._batch_check = None
+
+
 class Git(object):
     def __init__(self, path, enzi_io=None):
         """
@@ -79,12 +290,32 @@ class Git(object):
             path = realpath(path)
         self.path = path
         self.enzi_io = enzi_io
+        self.reader: typing.Optional[GitObjectReader] = None
+        # whether this git is a partial clone, <K=remote, V=bool>, see is_partial
+        self.partial: typing.MutableMapping[str, bool] = {}
+        # fetch timing counter
+        self.fetch_count = 0
+        self.fetch_time = 0.0
+
+    @property
+    def offline(self):
+        """whether this git must not contact any remote, see Enzi offline"""
+        enzi = self.enzi_io.enzi if self.enzi_io is not None else None
+        return enzi is not None and enzi.offline
+
+    @property
+    def env(self):
+        """the environment of the spawned git, None to inherit the current one"""
+        if self.offline:
+            return dict(os.environ, **OFFLINE_ENV)
+        return None
 
     def spawn(self, cmd: GitCommand, *, get_output=True, suppress_stderr=False, no_log=False):
         return Launcher(
             cmd.cmd,
             cmd.args,
-            self.path
+            self.path,
+            self.env
         ).run(get_output, suppress_stderr=suppress_stderr, no_log=no_log)
 
     def spawn_with(self, f, *, get_output=True, no_log=False):
@@ -98,11 +329,129 @@ class Git(object):
         return self.spawn(cmd, get_output=False, suppress_stderr=True, no_log=no_log)
 
     # fetch the tags and refs of a remote git repository
-    def fetch(self, remote):
-        self.spawn_with(lambda x: x.arg('fetch').arg(
-            '-q').arg('--prune').arg(remote))
-        self.spawn_with(lambda x:
-                        x.arg('fetch').arg('-q').arg('--tags').arg('--prune').arg(remote))
+    def fetch(self, remote, *, single_pass=True, filter_spec=None):
+        """
+        fetch the branches and tags of a remote.
+        With single_pass, branches and tags are fetched in one negotiation
+        with an explicit refspec, otherwise they are fetched separately.
+        With filter_spec (e.g. blob:none), the remote is registered
+        as a promisor remote and this git becomes a partial clone.
+        The local tags missing in the remote are pruned, the pins under
+        PIN_REF_PREFIX are not.
+        """
+        def fetch_cmd(cmd: GitCommand, tags=False):
+            cmd.arg('fetch').arg('-q').arg('--prune')
+            if tags:
+                cmd.arg('--tags')
+            if filter_spec:
+                cmd.arg('--filter={}'.format(filter_spec))
+            return cmd.arg(remote)
+
+        start = time.perf_counter()
+        # a fetch with filter_spec makes this git a partial clone
+        self.partial.clear()
+        if single_pass:
+            self.spawn_with(
+                lambda x: fetch_cmd(x)
+                .arg(FETCH_BRANCHES_REFSPEC.format(remote))
+                .arg(FETCH_TAGS_REFSPEC)
+            )
+        else:
+            self.spawn_with(fetch_cmd)
+            self.spawn_with(lambda x: fetch_cmd(x, tags=True))
+        elapsed = time.perf_counter() - start
+        self.fetch_count += 1
+        self.fetch_time += elapsed
+        fmt = 'Git:fetch: fetched {} for {} in {:.3f}s (fetches: {}, total: {:.3f}s)'
+        logger.debug(fmt.format(remote, self.path, elapsed,
+                                self.fetch_count, self.fetch_time))
+
+    def remote_url(self, remote='origin') -> typing.Optional[str]:
+        """read the url of a remote from the config file, without spawning git"""
+        config_path = os.path.join(self.path, 'config')
+        if not os.path.exists(config_path):
+            # not a bare repository
+            config_path = os.path.join(self.path, '.git', 'config')
+        section = '[remote "{}"]'.format(remote)
+        in_section = False
+        try:
+            with open(config_path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('['):
+                        in_section = line == section
+                    elif in_section and line.startswith('url'):
+                        key, _, value = line.partition('=')
+                        if key.strip() == 'url':
+                            return value.strip()
+        except FileNotFoundError:
+            pass
+        return None
+
+    def is_partial(self, remote='origin'):
+        """whether this git is a partial clone of the given remote"""
+        if remote in self.partial:
+            return self.partial[remote]
+        try:
+            promisor = self.spawn_with(
+                lambda x: x.arg('config')
+                .arg('--get')
+                .arg('remote.{}.promisor'.format(remote)),
+                no_log=True
+            )
+            partial = promisor.strip() == 'true'
+        except Exception:
+            partial = False
+        self.partial[remote] = partial
+        return partial
+
+    def missing_objects(self, rev_id):
+        """
+        list the objects of the given revision's tree which are
+        missing in a partial clone, without fetching them.
+        """
+        out = self.spawn_with(
+            lambda x: x.arg('rev-list')
+            .arg('--objects')
+            .arg('--no-walk')
+            .arg('--missing=print')
+            .arg(rev_id)
+        )
+        missing = filter(lambda x: x.startswith('?'), out.splitlines())
+        return list(map(lambda x: x[1:].strip(), missing))
+
+    def prefetch(self, rev_id, remote='origin'):
+        """
+        fetch all the missing blobs of the given revision's tree
+        from the promisor remote, in batches instead of one by one.
+        """
+        missing = self.missing_objects(rev_id)
+        if not missing:
+            return
+        if self.offline:
+            fmt = 'Git:prefetch: offline and {} objects of {} are not present in {}'
+            msg = fmt.format(len(missing), rev_id, self.path)
+            logger.error(msg)
+            raise RuntimeError(msg)
+        fmt = 'Git:prefetch: fetching {} missing objects of {} for {}'
+        logger.debug(fmt.format(len(missing), rev_id, self.path))
+        start = time.perf_counter()
+        for idx in range(0, len(missing), PREFETCH_BATCH):
+            batch = missing[idx:idx+PREFETCH_BATCH]
+
+            def fetch_objs(cmd: GitCommand):
+                cmd.arg('-c').arg('fetch.negotiationAlgorithm=noop')
+                cmd.arg('fetch').arg('-q').arg('--no-tags')
+                cmd.arg('--no-write-fetch-head')
+                cmd.arg('--filter={}'.format(PARTIAL_CLONE_FILTER))
+                cmd.arg(remote)
+                for obj in batch:
+                    cmd.arg(obj)
+                return cmd
+            self.spawn_with(fetch_objs)
+        elapsed = time.perf_counter() - start
+        self.fetch_count += 1
+        self.fetch_time += elapsed
 
     def init_repo(self, dst_path, url_path):
         """
@@ -129,54 +478,96 @@ class Git(object):
         # except Exception:
         #     return False
 
-    def list_refs(self):
-        refs = self.spawn_with(lambda x: x.arg('show-ref'))
-        ret = []
+    def peel_refs(self, *patterns):
+        """
+        Peel all the refs (optionally filtered by the given for-each-ref patterns)
+        to the commits they point to, with a single `git for-each-ref` call.
+        Refs which do not point to a commit are skipped.
+
+        :return: OrderedDict[str, str], refname -> commit hash
+        """
+        fmt = '%(objectname) %(objecttype) %(*objectname) %(*objecttype) %(refname)'
+
+        def for_each_ref(cmd: GitCommand):
+            cmd.arg('for-each-ref').arg('--format={}'.format(fmt))
+            for pattern in patterns:
+                cmd.arg(pattern)
+            return cmd
+
+        refs = self.spawn_with(for_each_ref, no_log=True)
+        ret = OrderedDict()
+        nested = []
         for line in refs.splitlines():
-            fields = line.split()
-            # TODO: bender said: Handle the case where the line might not contain enough
-            # information or is missing some fields.
-            rev_id = fields[0]
-            ref = fields[1]
-            rev_id = rev_id + '^{commit}'
-            rev_id = self.spawn_with(
-                lambda x: x.arg('rev-parse')
-                .arg('--verify')
-                .arg(rev_id)
-            ).strip()
-            ret.append((rev_id, ref))
+            # for a non-tag object, the peeled fields are empty strings
+            fields = line.split(' ', 4)
+            if len(fields) != 5:
+                logger.debug('Git:peel_refs: skip malformed line {}'.format(line))
+                continue
+            obj, obj_type, peeled, peeled_type, ref = fields
+            if obj_type == 'commit':
+                ret[ref] = obj
+            elif obj_type == 'tag' and peeled_type == 'commit':
+                ret[ref] = peeled
+            elif obj_type == 'tag' and peeled_type == 'tag':
+                # tag of tag, for-each-ref only peels one level
+                ret[ref] = None
+                nested.append(ref)
+            else:
+                fmt_msg = 'Git:peel_refs: skip {}, which points to a {}'
+                logger.debug(fmt_msg.format(ref, peeled_type or obj_type))
+
+        if nested:
+            # peel all the nested tags at once
+            def rev_parse(cmd: GitCommand):
+                cmd.arg('rev-parse')
+                for ref in nested:
+                    cmd.arg(ref + '^{commit}')
+                return cmd
+            revs = self.spawn_with(rev_parse).split()
+            for ref, rev in zip(nested, revs):
+                ret[ref] = rev
+
         return ret
 
+    def list_refs(self):
+        refs = self.peel_refs()
+        return [(rev_id, ref) for ref, rev_id in refs.items()]
+
     def list_tags(self, with_rev=False):
         try:
-            refs = self.spawn_with(
-                lambda x: x.arg('show-ref')
-                .arg('--tags')
-                .arg('-d'),
-                no_log=True
-            )
+            refs = self.peel_refs('refs/tags')
         except Exception:
             return []
 
-        tags = []
-        rev_ids = []
-        for line in refs.splitlines():
-            fields = line.split()  # <hash> <refs/tags/*>
-            rev_id = fields[0]
-            tag = fields[1]
-            rev_id = rev_id + '^{commit}'
-            rev_id = self.spawn_with(
-                lambda x: x.arg('rev-parse')
-                .arg('--verify')
-                .arg(rev_id)
-            ).strip()
-            tags.append(tag)
-            rev_ids.append(rev_id)
-
         if with_rev:
-            return list(zip(rev_ids, tags))
+            return [(rev_id, tag) for tag, rev_id in refs.items()]
+
+        return list(refs.keys())
 
-        return tags
+    def refs_fingerprint(self):
+        """
+        a fingerprint of the refs of this git database, which changes
+        whenever packed-refs, the loose refs or FETCH_HEAD change.
+        """
+        h = blake2b(digest_size=16)
+
+        def update(name):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+                h.update('{} {} {}\n'.format(
+                    name, st.st_mtime_ns, st.st_size).encode('utf-8'))
+            except FileNotFoundError:
+                h.update('{} -\n'.format(name).encode('utf-8'))
+
+        update('packed-refs')
+        update('FETCH_HEAD')
+        refs_dir = os.path.join(self.path, 'refs')
+        for dirpath, dirnames, filenames in os.walk(refs_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                update(os.path.relpath(os.path.join(dirpath, filename), self.path))
+        return h.hexdigest()
 
     def list_revs(self):
         revs = self.spawn_with(lambda x:
@@ -193,6 +584,57 @@ class Git(object):
         return self.spawn_with(lambda x:
                                x.arg('cat-file').arg('blob').arg(hash))
 
+    def object_reader(self) -> GitObjectReader:
+        """get the persistent object reader of this git, start it if needed"""
+        if self.reader is None:
+            self.reader = GitObjectReader(self.path, self.env)
+        return self.reader
+
+    def read_file(self, rev_id, path) -> typing.Optional[str]:
+        """
+        read a file at the given revision through the object reader,
+        return None if the file does not exist.
+        """
+        if self.offline and self.is_partial():
+            # a reader of git older than 2.44 would fetch a missing blob
+            missing = self.missing_objects(rev_id)
+            if missing and any(e.hash in missing for e in self.list_files(rev_id, path)):
+                fmt = 'Git:read_file: offline and {} at {} is not present in {}'
+                msg = fmt.format(path, rev_id, self.path)
+                logger.error(msg)
+                raise RuntimeError(msg)
+        res = self.object_reader().read('{}:{}'.format(rev_id, path))
+        if res is None or res[1] != 'blob':
+            return None
+        return res[2].decode('utf-8')
+
+    def entry_hash(self, rev_id, name) -> typing.Optional[str]:
+        """
+        get the object hash of a top-level tree entry at the given revision,
+        return None if there is no such entry.
+        Only the tree is read, so no blob is fetched from a partial database.
+        """
+        res = self.object_reader().read('{}^{{tree}}'.format(rev_id))
+        if res is None:
+            return None
+        # raw tree entries: <mode> SP <name> NUL <raw hash>, the hash has
+        # the width of the tree's own hash, 20 bytes for sha1 and 32 for sha256
+        width = len(res[0]) // 2
+        data, name, pos = res[2], name.encode('utf-8'), 0
+        while pos < len(data):
+            sep = data.index(b' ', pos)
+            end = data.index(b'\0', sep)
+            if data[sep + 1:end] == name:
+                return data[end + 1:end + 1 + width].hex()
+            pos = end + 1 + width
+        return None
+
+    def close(self):
+        """shut down the object reader of this git, if any"""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
     def list_files(self, rev_id, path=None) -> typing.List[TreeEntry]:
         def ls(cmd: GitCommand):
             cmd.arg('ls-tree').arg(rev_id)
@@ -202,6 +644,33 @@ class Git(object):
         lines = self.spawn_with(ls).splitlines()
         return list(map(TreeEntry.parse, lines))
 
+    def archive(self, rev_id, dest, paths=None):
+        """
+        extract the tree of the given revision, or only the given paths of it,
+        into dest, streaming the archive without a working tree or index.
+        """
+        cmd = ['git', 'archive', '--format=tar', rev_id]
+        if paths:
+            cmd.append('--')
+            cmd.extend(sorted(paths))
+        logger.debug('Git:archive: {} into {}'.format(' '.join(cmd), dest))
+        proc = subprocess.Popen(cmd, cwd=self.path, env=self.env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                if hasattr(tarfile, 'tar_filter'):
+                    tar.extractall(dest, filter='tar')
+                else:
+                    tar.extractall(dest)
+        finally:
+            proc.stdout.close()
+            err = proc.stderr.read()
+            proc.stderr.close()
+            proc.wait()
+        if proc.returncode:
+            msg = err.decode('utf-8', errors='replace').strip()
+            raise RuntimeError('Git:archive: {}'.format(msg))
+
     def list_cached(self):
         res = self.spawn_with(
             lambda x: x.arg('ls-files')
@@ -267,21 +736,41 @@ class GitRepo(FileManager):
     Normall, this call after the dependencies of the root project is resolved.
     """
 
-    def __init__(self, name: str, proj_root: str, git: Git, db_path: str, revision: str, *, enzi_io=None):
+    def __init__(self, name: str, proj_root: str, git: Git, db_path: str, revision: str, *, enzi_io=None, git_url=None, checkout_mode='clone', sparse=False):
+        if not checkout_mode in CHECKOUT_MODES:
+            raise ValueError('checkout_mode must be one of {}'.format(CHECKOUT_MODES))
         files_root = os.path.dirname(git.path)
         self.db_path = db_path
+        self.checkout_mode = checkout_mode
+        # the required checkout mode, which is kept in the stamp
+        # even if an export falls back to a clone, see export
+        self.requested_mode = checkout_mode
+        # whether to check out only the directories of the fileset files
+        self.sparse = sparse
+        # the source of the database, used as the key of the config cache
+        self.git_url = git_url
         self.path = git.path
         self.revision = revision
         self.git: Git = git
         self.enzi_io = enzi_io
         self.enzi_config: typing.Optional[Config] = None
         self.cache_files = Fileset()
-        self.resolver = IncDirsResolver(self.path)
+        include_cache = enzi_io.enzi.include_cache if enzi_io else None
+        jobs = enzi_io.enzi.jobs if enzi_io else 1
+        self.resolver = IncDirsResolver(self.path, include_cache=include_cache, jobs=jobs)
         # before fetch we don't have any known files
         self.fileset = Fileset()
         super(GitRepo, self).__init__(name, {}, proj_root, files_root)
 
-        if os.path.exists(self.git.path) and validate_git_repo(self.name, self.git.path, test=True):
+        # the stamp of the last fetch, an up-to-date one skips all the git commands
+        self.stamp = self.read_stamp()
+        # a checkout of another mode is checked out again, but a checkout
+        # without a stamp, i.e. from an older enzi, keeps its mode
+        if self.stamp is not None:
+            if self.stamp.get('checkout_mode') == self.requested_mode:
+                self.status = FileManagerStatus.EXIST
+        elif os.path.exists(os.path.join(self.git.path, '.git')) and \
+                validate_git_repo(self.name, self.git.path, test=True):
             self.status = FileManagerStatus.EXIST
 
     def init_repo(self):
@@ -309,6 +798,243 @@ class GitRepo(FileManager):
         msg = fmt.format(self.name, self.db_path, self.git.path)
         logger.debug(msg)
         db_git = Git(self.db_path, self.enzi_io)
+        # for a partial clone database, only fetch the blobs of the locked revision,
+        # and share the objects with the database so that later checkouts find
+        # the blobs prefetched into the database.
+        partial = db_git.is_partial()
+        if partial:
+            db_git.prefetch(self.revision)
+        # the working files are checked out after the sparse checkout is set
+        sparse = self.sparse
+        if sparse and db_git.entry_hash(self.revision, '.gitmodules'):
+            logger.debug('GitRepo({}): submodules, skip sparse checkout'.format(self.name))
+            sparse = False
+        db_git.close()
+
+        if self.checkout_mode == 'worktree':
+            self.add_worktree(db_git, no_checkout=sparse)
+        else:
+            tmp_tag_name = self.tag_revision(db_git)
+            # a shared clone borrows the objects of the database,
+            # which are kept by the pin of the revision, see pin_revision
+            shared = partial or self.checkout_mode == 'shared'
+
+            def clone(cmd: GitCommand):
+                cmd.arg('clone').arg('-q')
+                if shared:
+                    cmd.arg('--shared')
+                if sparse:
+                    cmd.arg('--no-checkout')
+                return cmd.arg(self.db_path) \
+                          .arg(self.git.path) \
+                          .arg('--recursive') \
+                          .arg('--branch') \
+                          .arg(tmp_tag_name)
+            git.quiet_spawn_with(clone)
+
+        # get the repo enzi config file
+        self.detect_file()
+        if sparse:
+            self.sparse_checkout()
+            git.spawn_with(lambda x: x.arg('read-tree').arg('-mu').arg('HEAD'))
+            self.check_sparse()
+
+    def sparse_dirs(self):
+        """the directories of the fileset files, relative to the repository"""
+        dirs = set()
+        for file in self.fileset.files:
+            rel_dir = os.path.relpath(os.path.dirname(file), self.path)
+            if rel_dir != '.' and not rel_dir.startswith('..'):
+                dirs.add(rel_dir.replace(os.sep, '/'))
+        return dirs
+
+    def sparse_checkout(self, dirs=None):
+        """only check out the files at the top level and in the given directories"""
+        if dirs is None:
+            dirs = self.sparse_dirs()
+        logger.debug('GitRepo({}): sparse checkout {}'.format(self.name, sorted(dirs)))
+
+        def sparse_set(cmd: GitCommand):
+            cmd.arg('sparse-checkout').arg('set').arg('--cone')
+            for rel_dir in sorted(dirs):
+                cmd.arg(rel_dir)
+            return cmd
+        self.git.spawn_with(sparse_set)
+
+    def missing_include_dirs(self):
+        """
+        the directories of the include files of the fileset files,
+        which are in this repository but not on the disk.
+        """
+        missing = set()
+        files = filter(lambda x: x.endswith(IncDirsResolver.VEXT), self.fileset.files)
+        files = list(filter(os.path.exists, files))
+        while files:
+            file = files.pop()
+            for include_file in self.resolver.get_include_files(file):
+                inc_file = os.path.normpath(
+                    os.path.join(os.path.dirname(file), include_file))
+                rel_dir = os.path.relpath(os.path.dirname(inc_file), self.path)
+                if rel_dir.startswith('..'):
+                    continue
+                if os.path.exists(inc_file):
+                    files.append(inc_file)
+                elif os.path.dirname(include_file):
+                    # a bare include may come from other packages
+                    missing.add(rel_dir.replace(os.sep, '/'))
+        return missing
+
+    def check_sparse(self):
+        """
+        add the directories of the missing include files to the sparse checkout,
+        fall back to a full checkout if an include file is not in the repository.
+        """
+        dirs = self.sparse_dirs()
+        while True:
+            missing = self.missing_include_dirs()
+            if not missing:
+                return
+            if missing <= dirs:
+                fmt = 'GitRepo({}): missing include files in {}, fall back to a full checkout'
+                logger.warning(fmt.format(self.name, sorted(missing)))
+                self.git.spawn_with(lambda x: x.arg('sparse-checkout').arg('disable'))
+                return
+            dirs |= missing
+            self.sparse_checkout(dirs)
+
+    def read_stamp(self):
+        """the stamp of the last fetch, None if there is no valid one"""
+        try:
+            with open(os.path.join(self.path, STAMP_FILE)) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(stamp, dict) or stamp.get('schema') != STAMP_SCHEMA:
+            return None
+        return stamp
+
+    def stamp_key(self):
+        return {
+            'schema': STAMP_SCHEMA,
+            'revision': self.revision,
+            'checkout_mode': self.requested_mode,
+            'sparse': self.sparse,
+        }
+
+    def is_stamped(self):
+        """whether the stamp records the required revision and checkout"""
+        if self.stamp is None:
+            return False
+        return all(self.stamp.get(k) == v for k, v in self.stamp_key().items())
+
+    def write_stamp(self):
+        """record the materialized revision and the fileset files, relative to the repo"""
+        stamp = self.stamp_key()
+        stamp['files'] = [os.path.relpath(x, self.path) for x in self.fileset.files]
+        path = os.path.join(self.path, STAMP_FILE)
+        if self.checkout_mode != 'export' and self.read_stamp() is None:
+            # keep the stamp out of the status of the repository
+            exclude = self.git.spawn_with(
+                lambda x: x.arg('rev-parse').arg('--git-path').arg('info/exclude')).strip()
+            exclude = os.path.join(self.path, exclude)
+            os.makedirs(os.path.dirname(exclude), exist_ok=True)
+            with open(exclude, 'a') as f:
+                f.write('/{}\n'.format(STAMP_FILE))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(stamp, f)
+        os.replace(tmp_path, path)
+        self.stamp = stamp
+
+    def set_files(self, files):
+        self.fileset.files = files
+        # for git repo, cache_files is the same as it's files listed on fileset
+        self.cache_files.files = files
+        self.resolver.update_files(files)
+
+    def export(self):
+        """
+        extract the files of the revision from the database, without a working tree.
+        Return False if the revision cannot be exported, i.e. it has submodules.
+        """
+        db_git = Git(self.db_path, self.enzi_io)
+        # the cat-file coprocesses are shut down on every path
+        try:
+            reader = db_git.object_reader()
+            if not reader.info('{}^{{commit}}'.format(self.revision)):
+                raise self.missing_revision()
+            if db_git.entry_hash(self.revision, '.gitmodules'):
+                fmt = 'GitRepo({}): git archive skips submodules, fall back to a clone'
+                logger.warning(fmt.format(self.name))
+                self.checkout_mode = 'clone'
+                if not os.path.exists(os.path.join(self.path, '.git')):
+                    self.clean_cache()
+                    self.status = FileManagerStatus.INIT
+                return False
+
+            logging.getLogger('Enzi').info('fetch {}'.format(self.name))
+            fmt = 'GitRepo({}): exporting revision {} to {}'
+            logger.debug(fmt.format(self.name, self.revision, self.path))
+            self.clean_cache()
+            os.makedirs(self.path, exist_ok=True)
+            if db_git.is_partial():
+                db_git.prefetch(self.revision)
+            self.detect_file()
+            if self.sparse:
+                # the top level files and the directories of the fileset files
+                entries = db_git.list_files(self.revision)
+                paths = set(e.name for e in entries if e.kind == 'blob')
+                dirs = set(filter(lambda x: reader.info('{}:{}'.format(self.revision, x)),
+                                  self.sparse_dirs()))
+                db_git.archive(self.revision, self.path, paths | dirs)
+                while True:
+                    missing = self.missing_include_dirs() - dirs
+                    missing = set(filter(
+                        lambda x: reader.info('{}:{}'.format(self.revision, x)), missing))
+                    if not missing:
+                        break
+                    dirs |= missing
+                    db_git.archive(self.revision, self.path, missing)
+                if self.missing_include_dirs():
+                    fmt = 'GitRepo({}): missing include files, fall back to a full export'
+                    logger.warning(fmt.format(self.name))
+                    db_git.archive(self.revision, self.path)
+            else:
+                db_git.archive(self.revision, self.path)
+        finally:
+            db_git.close()
+        self.status = FileManagerStatus.FETCHED
+        return True
+
+    def add_worktree(self, db_git: Git, no_checkout=False):
+        """check out the revision in a worktree of the database, which owns all the objects"""
+        # forget the worktrees removed without git, e.g. by enzi clean
+        db_git.spawn_with(lambda x: x.arg('worktree').arg('prune'))
+
+        def worktree_add(cmd: GitCommand):
+            cmd.arg('worktree').arg('add').arg('-q').arg('--detach')
+            if no_checkout:
+                cmd.arg('--no-checkout')
+            return cmd.arg(self.git.path).arg(self.revision)
+        db_git.quiet_spawn_with(worktree_add)
+        if os.path.exists(os.path.join(self.git.path, '.gitmodules')):
+            self.git.quiet_spawn_with(
+                lambda x: x.arg('submodule').arg('update').arg('-q')
+                           .arg('--init').arg('--recursive'))
+
+    def pin_revision(self, db_git: Git):
+        """
+        pin the required revision in the database, so that it can be fetched,
+        and neither fetch --prune nor gc drops its objects.
+        """
+        pin = PIN_REF_PREFIX + self.revision
+        db_git.spawn_with(lambda x: x.arg('update-ref').arg(pin).arg(self.revision))
+        return pin
+
+    def tag_revision(self, db_git: Git):
+        """pin the required revision in the database, and tag it so that it can be cloned"""
+        self.pin_revision(db_git)
+        # the tag is pruned by the next fetch of the database, the pin is kept
         tmp_tag_name = 'enzi-tmp-{}'.format(self.revision)
         db_git.spawn_with(
             lambda x: x.arg('tag')
@@ -316,27 +1042,66 @@ class GitRepo(FileManager):
                        .arg(self.revision)
                        .arg('--force')
         )
-        git.quiet_spawn_with(
-            lambda x: x.arg('clone')
-                       .arg('-q')
-                       .arg(self.db_path)
-                       .arg(self.git.path)
-                       .arg('--recursive')
-                       .arg('--branch')
-                       .arg(tmp_tag_name)
-        )
+        return tmp_tag_name
 
-        # get the repo enzi config file
-        self.detect_file()
+    def fetch_revision(self, db_git: Git):
+        """
+        fetch the required revision from the database into an existing repo,
+        if it is fetched into the database after the repo was cloned.
+        """
+        reader = self.git.object_reader()
+        found = reader.info('{}^{{commit}}'.format(self.revision))
+        self.git.close()
+        if found:
+            return
+        # a worktree shares all the objects of the database
+        if self.checkout_mode == 'worktree':
+            raise self.missing_revision()
+        logger.debug('GitRepo({}): fetch revision {} from the database'.format(
+            self.name, self.revision))
+        refspec = '{0}:{0}'.format(self.pin_revision(db_git))
+        try:
+            self.git.quiet_spawn_with(
+                lambda x: x.arg('fetch').arg('-q').arg('origin').arg(refspec))
+        except Exception as e:
+            raise self.missing_revision() from e
+
+    def missing_revision(self):
+        fmt = 'GitRepo({}): cannot find required revision {}'
+        err_msg = fmt.format(self.name, self.revision)
+        logger.error(err_msg)
+        fmt = 'GitRepo({}): suggestion: try to update the database/lock file, via enzi update'
+        logger.error(fmt.format(self.name))
+        return RuntimeError(err_msg)
 
     def detect_file(self):
         git = self.git
-        config_entry = git.list_files(self.revision, 'Enzi.toml')[0]
-        data = git.cat_file(config_entry.hash)
-        msg = 'GitRepo({}): loaded Enzi.toml'.format(self.name)
-        logger.debug(msg)
-        enzi_config = RawConfig(data, from_str=True, base_path=git.path,
-                                fileset_only=True).validate()
+
+        def read():
+            # read Enzi.toml from the database, reuse its object reader if possible
+            if self.enzi_io:
+                db_git = self.enzi_io.git_db(self.db_path)
+            else:
+                db_git = Git(self.db_path)
+            data = db_git.read_file(self.revision, 'Enzi.toml')
+            if not self.enzi_io:
+                db_git.close()
+            if data is None:
+                fmt = 'GitRepo({}): no Enzi.toml at revision {}'
+                msg = fmt.format(self.name, self.revision)
+                logger.error(msg)
+                raise RuntimeError(msg)
+            msg = 'GitRepo({}): loaded Enzi.toml'.format(self.name)
+            logger.debug(msg)
+            return data
+
+        if self.enzi_io and self.git_url:
+            config_cache = self.enzi_io.enzi.config_cache
+            enzi_config = config_cache.load(
+                self.git_url, self.revision, read, git.path, fileset_only=True)
+        else:
+            enzi_config = RawConfig(read(), from_str=True, base_path=git.path,
+                                    fileset_only=True).validate()
 
         # extract repo's fileset
         _files = OrderedSet()
@@ -345,11 +1110,7 @@ class GitRepo(FileManager):
             _new_files = fileset.get('files', [])
             _new_files = map(fn, _new_files)
             _files |= OrderedSet(_new_files)
-        self.fileset.files = _files
-
-        # for git repo, cache_files is the same as it's files listed on fileset
-        self.cache_files.files = _files
-        self.resolver.update_files(_files)
+        self.set_files(_files)
 
     def check_outdated(self):
         head_rev = self.git.current_checkout()
@@ -360,18 +1121,30 @@ class GitRepo(FileManager):
             fmt_msg = 'GitRepo({}): current revision: {} does not match requirement, fetch the required revision {}'
             logger.debug(fmt_msg.format(self.name, head_rev, self.revision))
             self.status = FileManagerStatus.OUTDATED
-            all_revs = self.git.list_revs()
-            if not self.revision in all_revs:
-                fmt = 'GitRepo({}): cannot find required revision {}'
-                err_msg = fmt.format(self.name, self.revision)
-                logger.error(err_msg)
-                fmt = 'GitRepo({}): suggestion: try to update the database/lock file, via enzi update'
-                logger.error(fmt.format(self.name))
-                raise RuntimeError(err_msg)
             return True
 
         return False
 
+    def is_sparse(self):
+        """whether the existing repository is a sparse checkout"""
+        try:
+            out = self.git.spawn_with(
+                lambda x: x.arg('config').arg('--get').arg('core.sparseCheckout'), no_log=True)
+        except Exception:
+            return False
+        return out.strip() == 'true'
+
+    def update_sparse(self):
+        """apply the sparse setting to the checked out revision"""
+        if not self.sparse:
+            if self.is_sparse():
+                self.git.spawn_with(lambda x: x.arg('sparse-checkout').arg('disable'))
+        elif os.path.exists(os.path.join(self.git.path, '.gitmodules')):
+            logger.debug('GitRepo({}): submodules, skip sparse checkout'.format(self.name))
+        else:
+            self.sparse_checkout()
+            self.check_sparse()
+
     def clean_cache(self):
         if os.path.exists(self.git.path):
             shutil.rmtree(self.git.path, onerror=rmtree_onerror)
@@ -385,12 +1158,40 @@ class GitRepo(FileManager):
         )
 
     def fetch(self):
+        if self.is_stamped():
+            if self.status != FileManagerStatus.FETCHED:
+                fmt = 'GitRepo({}): revision {} is up to date in {}'
+                logger.debug(fmt.format(self.name, self.revision, self.path))
+                files = map(lambda x: os.path.normpath(os.path.join(self.path, x)),
+                            self.stamp['files'])
+                self.set_files(OrderedSet(files))
+                self.status = FileManagerStatus.FETCHED
+            self.resolver.update_files(self.cache_files)
+            return
+
+        if self.checkout_mode == 'export' and self.export():
+            self.write_stamp()
+            self.resolver.update_files(self.cache_files)
+            return
+
         if self.status != FileManagerStatus.FETCHED:
             self.init_repo()
 
+        # the sparse checkout is turned on or off since the last fetch
+        sparse_changed = self.stamp is not None and self.stamp.get('sparse') != self.sparse
         if self.check_outdated():
+            db_git = Git(self.db_path, self.enzi_io)
+            if db_git.is_partial():
+                db_git.prefetch(self.revision)
+            self.fetch_revision(db_git)
             self.checkout(self.revision)
+            # the filesets of the new revision may be in other directories
+            if sparse_changed or self.is_sparse():
+                self.update_sparse()
             self.status = FileManagerStatus.FETCHED
+        elif sparse_changed:
+            self.update_sparse()
+        self.write_stamp()
         self.resolver.update_files(self.cache_files)
 
     def cached_fileset(self):
@@ -1,19 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hashlib import blake2b
+import json
 import logging
 import os
+import threading
+import time
 import typing
 
 from enzi.config import DependencyRef, DependencyVersion
-from enzi.config import RawConfig
 from enzi.frontend import Enzi
-from enzi.git import Git, GitRepo, GitVersions, TreeEntry
-from enzi.utils import PathBuf, try_parse_semver
+from enzi.git import Git, GitRepo, GitVersions
+from enzi.git import PARTIAL_CLONE_FILTER, normalize_git_url
+from enzi.utils import FileLock, PathBuf, try_parse_semver
 
 logger = logging.getLogger(__name__)
 
 HASH_GDEP_NAME = os.environ.get('HASH_GDEP_NAME')
 
 
+# versions cache file inside each git database
+VERSIONS_CACHE = 'enzi-versions.json'
+# lock file inside each git database, held by the process updating it
+FETCH_LOCK = 'enzi-fetch.lock'
+VERSIONS_CACHE_SCHEMA = 1
+
+
+def load_versions_cache(cache_path, fingerprint) -> typing.Optional[GitVersions]:
+    """
+    load a GitVersions from the given cache file,
+    return None if there is no valid cache for the given fingerprint.
+    """
+    try:
+        with open(cache_path, 'r') as f:
+            data = json.load(f)
+        if data.get('schema') != VERSIONS_CACHE_SCHEMA:
+            return None
+        if data.get('fingerprint') != fingerprint:
+            return None
+        return GitVersions.loads(data['versions'])
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        fmt = 'load_versions_cache: ignore invalid cache {}: {}'
+        logger.debug(fmt.format(cache_path, e))
+        return None
+
+
+def dump_versions_cache(cache_path, fingerprint, versions: GitVersions):
+    """dump a GitVersions to the given cache file"""
+    data = {
+        'schema': VERSIONS_CACHE_SCHEMA,
+        'fingerprint': fingerprint,
+        'versions': versions.dumps()
+    }
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, cache_path)
+
+
+def same_git_url(remote_url, git_url):
+    return not remote_url is None and normalize_git_url(remote_url) == normalize_git_url(git_url)
+
+
 class EnziIO(object):
     """
     IO Spawner class for Enzi
@@ -22,10 +71,62 @@ class EnziIO(object):
 
     def __init__(self, enzi: Enzi):
         self.enzi = enzi
+        # opened git databases, <K=db path, V=Git>
+        # the Git objects own their object readers, which are shut down in close()
+        self.git_dbs: typing.MutableMapping[str, Git] = {}
+        # the databases which have been created/updated by this EnziIO
+        self.updated_dbs: typing.MutableSet[str] = set()
+        self.lock = threading.Lock()
+        self.db_locks: typing.MutableMapping[str, threading.Lock] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def git_db_dir(self, name):
+    def close(self):
+        """shut down all the object readers of the opened git databases"""
+        for git in self.git_dbs.values():
+            if git.fetch_count:
+                fmt = 'EnziIO: database {} fetched {} times in {:.3f}s'
+                logger.debug(fmt.format(git.path, git.fetch_count, git.fetch_time))
+            git.close()
+        self.git_dbs = {}
+        self.updated_dbs = set()
+        if self.enzi:
+            self.enzi.config_cache.dump()
+
+    def db_lock(self, db_path) -> threading.Lock:
+        """get the lock which guards the git database at the given path"""
+        with self.lock:
+            if not db_path in self.db_locks:
+                self.db_locks[db_path] = threading.Lock()
+            return self.db_locks[db_path]
+
+    def git_db(self, db_path) -> Git:
+        """get the opened git database at the given path, without fetching"""
+        with self.lock:
+            if db_path in self.git_dbs:
+                return self.git_dbs[db_path]
+            git = Git(db_path, self)
+            self.git_dbs[db_path] = git
+            return git
+
+    def git_db_dir(self, name, git_url=None):
+        """
+        get the git database directory of the given dependency, the databases
+        in a shared cache are keyed by the normalized git url instead of name.
+        """
         # TODO: change git database name format
-        if HASH_GDEP_NAME:
+        if self.enzi.shared_cache:
+            if git_url is None:
+                raise RuntimeError('INTERNAL ERROR: shared database needs a git url')
+            url = normalize_git_url(git_url)
+            url_hash_slice = blake2b(url.encode('utf-8')).hexdigest()[:16]
+            basename = os.path.basename(url) or name
+            db_name = '{}-{}'.format(basename, url_hash_slice)
+        elif HASH_GDEP_NAME:
             name_hash_slice = blake2b(name.encode('utf-8')).hexdigest()[:16]
             db_name = '{}-{}'.format(name, name_hash_slice)
         else:
@@ -47,7 +148,7 @@ class EnziIO(object):
         
         return repo_dir
 
-    def git_repo(self, name, db_path, revision, *, proj_root=None) -> GitRepo:
+    def git_repo(self, name, db_path, revision, *, proj_root=None, git_url=None) -> GitRepo:
         """
         create a git repo with given db_path and revision,
         the storage path is build from enzi.build_deps_path + name + Optional[blake2b[:16]]
@@ -57,46 +158,179 @@ class EnziIO(object):
         git = Git(repo_dir.path, self)
         if proj_root is None:
             proj_root = self.enzi.work_dir
-        return GitRepo(name, proj_root, git, db_path, revision, enzi_io=self)
+        return GitRepo(name, proj_root, git, db_path, revision, enzi_io=self,
+                       git_url=git_url, checkout_mode=self.enzi.checkout_mode,
+                       sparse=self.enzi.sparse_checkout)
 
-    def dep_versions(self, dep_id):
+    def dep_versions(self, dep_id, revision=None):
         dep = self.enzi.dependecy(dep_id)
         git_url = dep.source.git_url
-        dep_git = self.git_database(dep.name, git_url)
+        dep_git = self.git_database(dep.name, git_url, revision)
         return self.git_versions(dep_git)
 
-    def git_database(self, name, git_url) -> Git:
-
+    def git_database(self, name, git_url, revision=None) -> Git:
+        """
+        get the git database of the given dependency, create/update it if necessary.
+        Each database is only updated once per EnziIO and this method is thread-safe.
+        If the existing database has the given (locked) revision, it is not updated.
+        """
         # TODO: cache db_dir in Enzi
-        db_dir: PathBuf = self.git_db_dir(name)
+        db_dir: PathBuf = self.git_db_dir(name, git_url)
+        with self.db_lock(db_dir.path):
+            if db_dir.path in self.updated_dbs:
+                return self.git_dbs[db_dir.path]
+            if revision and self.has_revision(name, git_url, db_dir, revision):
+                return self.git_dbs[db_dir.path]
+            git = self.update_git_database(name, git_url, db_dir)
+            self.updated_dbs.add(db_dir.path)
+            return git
+
+    def has_revision(self, name, git_url, db_dir: PathBuf, revision) -> bool:
+        """whether the existing database of git_url has the given commit"""
+        enzi = self.enzi
+        if enzi.fetch_databases or name in enzi.update_deps:
+            return False
+        if not db_dir.join('config').exists():
+            return False
+        git = self.git_db(db_dir.path)
+        if not same_git_url(git.remote_url(), git_url):
+            return False
+        info = git.object_reader().info(revision)
+        if info is None or info[1] != 'commit':
+            return False
+        logger.debug('EnziIO:git_database: {} has revision {}, skip update'.format(
+            db_dir.path, revision))
+        self.record_git_database(name, db_dir)
+        return True
+
+    def record_git_database(self, name, db_dir: PathBuf):
+        with self.lock:
+            git_db_records = self.enzi.git_db_records
+            if name in git_db_records:
+                git_db_records[name].add(db_dir.path)
+            else:
+                git_db_records[name] = set([db_dir.path])
+
+    def update_git_database(self, name, git_url, db_dir: PathBuf) -> Git:
+        if self.enzi.offline:
+            return self.offline_git_database(name, git_url, db_dir)
         os.makedirs(db_dir.path, exist_ok=True)
-        git = Git(db_dir.path, self)
+        # other enzi processes may update the same (shared) database
+        with FileLock(db_dir.join(FETCH_LOCK).path):
+            return self.fetch_git_database(name, git_url, db_dir)
+
+    def fetch_git_database(self, name, git_url, db_dir: PathBuf) -> Git:
+        git = self.git_db(db_dir.path)
 
         logger.debug("EnziIO:git_database: new git_db at {}, origin: {}".format(
             db_dir.path, git_url))
 
-        git_db_records = self.enzi.git_db_records
-        if name in git_db_records:
-            git_db_records[name].add(db_dir.path)
-        else:
-            git_db_records[name] = set([db_dir.path])
+        self.record_git_database(name, db_dir)
 
         if not db_dir.join("config").exists():
             git.spawn_with(lambda x: x.arg('init').arg('--bare'))
             git.spawn_with(lambda x: x.arg('remote').arg('add')
                            .arg('origin').arg(git_url))
+            # a partial clone database keeps its filter for later fetches
+            if self.enzi.partial_clone:
+                filter_spec = PARTIAL_CLONE_FILTER
+            else:
+                filter_spec = None
+            git.fetch('origin', filter_spec=filter_spec)
+            return git
+        elif not same_git_url(git.remote_url(), git_url):
+            # the dependency moved to another url
+            logger.debug('EnziIO:git_database: set origin of {} to {}'.format(
+                db_dir.path, git_url))
+            git.spawn_with(lambda x: x.arg('remote').arg('set-url')
+                           .arg('origin').arg(git_url))
             git.fetch('origin')
             return git
         else:
-            db_mtime = os.stat(db_dir.join('FETCH_HEAD').path).st_mtime_ns
-            if self.enzi.config_mtime < db_mtime:
+            db_stat = os.stat(db_dir.join('FETCH_HEAD').path)
+            db_mtime = db_stat.st_mtime_ns
+            fetch = self.enzi.fetch_databases or name in self.enzi.update_deps
+            fetch_ttl = self.enzi.fetch_ttl
+            if not fetch and not fetch_ttl is None:
+                if time.time() - db_stat.st_mtime < fetch_ttl:
+                    logger.debug('skip update of {}, fetched within {}s'.format(
+                        db_dir.path, fetch_ttl))
+                    return git
+            if not fetch and self.enzi.config_mtime < db_mtime:
                 logger.debug('skip update of {}'.format(db_dir.path))
                 return git
             git.fetch('origin')
             return git
 
+    def offline_git_database(self, name, git_url, db_dir: PathBuf) -> Git:
+        """get the existing git database without fetching, for the offline mode"""
+        if not db_dir.join('config').exists():
+            msg = 'offline: no git database of {} from {}'.format(name, git_url)
+            logger.error(msg)
+            raise RuntimeError(msg)
+        git = self.git_db(db_dir.path)
+        if not same_git_url(git.remote_url(), git_url):
+            fmt = 'offline: git database of {} is from {} instead of {}'
+            msg = fmt.format(name, git.remote_url(), git_url)
+            logger.error(msg)
+            raise RuntimeError(msg)
+        logger.debug('EnziIO:git_database: offline, use {}'.format(db_dir.path))
+        self.record_git_database(name, db_dir)
+        return git
+
+    def deps_versions(self, dep_ids, jobs=None, revisions=None):
+        """
+        create/update the git databases of the given dependencies concurrently,
+        with at most `jobs` workers, and list their versions.
+        :param revisions: the locked revisions, <K=DependencyRef, V=str>,
+            a database having the locked revision is not updated
+        :return: dict, <K=DependencyRef, V=GitVersions>
+        """
+        if jobs is None:
+            jobs = self.enzi.jobs
+        if revisions is None:
+            revisions = {}
+        dep_ids = list(dep_ids)
+        if jobs <= 1 or len(dep_ids) <= 1:
+            return dict(map(lambda x: (x, self.dep_versions(x, revisions.get(x))), dep_ids))
+
+        versions = {}
+        workers = min(jobs, len(dep_ids))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for dep_id in dep_ids:
+                future = executor.submit(
+                    self.dep_versions, dep_id, revisions.get(dep_id))
+                futures[future] = dep_id
+            # collect the versions as the fetches complete
+            for future in as_completed(futures):
+                dep_id = futures[future]
+                versions[dep_id] = future.result()
+                logger.debug('EnziIO:deps_versions: {} is ready'.format(
+                    self.enzi.dependency_name(dep_id)))
+        return versions
+
     def git_versions(self, git: Git) -> GitVersions:
-        dep_refs = git.list_refs()
+        """
+        get the versions of a git database, load them from the database's
+        versions cache if the refs have not changed since it was written.
+        """
+        fingerprint = git.refs_fingerprint()
+        cache_path = os.path.join(git.path, VERSIONS_CACHE)
+        versions = load_versions_cache(cache_path, fingerprint)
+        if versions:
+            logger.debug('EnziIO:git_versions: cache hit for {}'.format(git.path))
+            return versions
+
+        versions = self.scan_git_versions(git)
+        dump_versions_cache(cache_path, fingerprint, versions)
+        return versions
+
+    def scan_git_versions(self, git: Git) -> GitVersions:
+        # peel all tags and branches to commits in one git call
+        tag_prefix = "refs/tags/"
+        branch_prefix = "refs/remotes/origin/"
+        dep_refs = git.peel_refs(tag_prefix, branch_prefix)
         dep_revs = git.list_revs()
 
         rev_ids = set(dep_revs)
@@ -104,9 +338,7 @@ class EnziIO(object):
         # get tags and branches
         tags = {}
         branches = {}
-        tag_prefix = "refs/tags/"
-        branch_prefix = "refs/remotes/origin/"
-        for rev_id, ref in dep_refs:
+        for ref, rev_id in dep_refs.items():
             if not rev_id in rev_ids:
                 continue
             if ref.startswith(tag_prefix):
@@ -124,10 +356,6 @@ class EnziIO(object):
         return GitVersions(versions, refs, dep_revs)
 
     def dep_config_version(self, dep_id: DependencyRef, version: DependencyVersion):
-        # from enzi.config import DependencySource as DepSrc
-        # from enzi.config import DependencyVersion as DepVer
-        # TODO: cache dep_config to reduce io workload
-
         dep = self.enzi.dependecy(dep_id)
 
         logger.debug("dep_config_version: get dep {}".format(dep.dump_vars()))
@@ -137,23 +365,21 @@ class EnziIO(object):
             git_url = dep.source.git_url
             is_local = dep.is_local
             git_rev = version.revision
-            git_db = self.git_database(dep_name, git_url)
-
-            entries: typing.List[TreeEntry] = git_db.list_files(
-                git_rev, 'Enzi.toml')
-            # actually, there must be only one entry
-            entry = entries[0]
-            data = git_db.cat_file(entry.hash)
-            logger.debug('dep_config_version: dep_name={}, db_path={}'.format(
-                dep_name, git_db.path))
-            # logger.debug(data)
-            dep_config = RawConfig(
-                data, 
-                from_str=True, 
-                base_path=git_db.path,
-                is_local=is_local,
-                git_url=git_url
-            ).validate()
-            return dep_config
+            # only the picked revision is read, which may be a locked one
+            git_db = self.git_database(dep_name, git_url, git_rev)
+
+            def read():
+                data = git_db.read_file(git_rev, 'Enzi.toml')
+                if data is None:
+                    fmt = 'dep_config_version: no Enzi.toml in {} at revision {}'
+                    msg = fmt.format(dep_name, git_rev)
+                    logger.error(msg)
+                    raise RuntimeError(msg)
+                logger.debug('dep_config_version: dep_name={}, db_path={}'.format(
+                    dep_name, git_db.path))
+                return data
+
+            return self.enzi.config_cache.load(
+                git_url, git_rev, read, git_db.path, is_local=is_local)
         else:
             raise RuntimeError('INTERNAL ERROR: unreachable')
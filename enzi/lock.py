@@ -40,35 +40,64 @@ class LockLoader(object):
         self.enzi: enzi.frontend.Enzi = enzi
         self.lock_file = lock_file
         if os.path.exists(lock_file):
-            self.lock_existing = Locked.load(lock_file)
+            self.lock_existing = enzi.sidecar.locked(lock_file)
         else:
             self.lock_existing = None
+        # whether Enzi.toml was changed since the lock file was generated
+        self.config_changed = False
 
-    def load(self, update=False):
+    def load(self, update=False, deps=None):
         """
         Construct an enzi.config.Locked instance with all the known information.
+        Dependencies are only resolved again if the dependencies in Enzi.toml
+        were changed, other changes only refresh the lock file's metadata.
+        The revisions of the existing lock are kept if they still satisfy
+        the dependencies, unless all dependencies are updated.
 
         :param update: whether to update the potential exiting lock file or not.
+        :param deps: the dependencies to update, all dependencies if empty.
         :return: enzi.config.Locked
         """
-        # check if config file metatdata change after the exiting lockfile was generated.
+        enzi = self.enzi
+        refresh = False
+        unlock = set(deps or ())
+        full_update = update and not unlock
+        if unlock:
+            known = set(enzi.config.dependencies.keys())
+            if self.lock_existing:
+                known.update(self.lock_existing.dependencies.keys())
+            unknown = sorted(unlock - known)
+            if unknown:
+                raise ValueError('unknown dependencies: {}'.format(
+                    ', '.join(unknown)))
+        # check if config file content change after the exiting lockfile was generated.
         if self.lock_existing:
-            config_path = self.lock_existing.config_path
-            config_mtime = self.lock_existing.config_mtime
-            mtime_changed = config_mtime < self.enzi.config_mtime
-            path_changed = config_path != self.enzi.config_path
-            changed = mtime_changed or path_changed
-            update = update or changed
+            locked = self.lock_existing
+            path_changed = locked.config_path != enzi.config_path
+            if locked.deps_hash is None:
+                # no hashes in the lock file, fallback to mtime
+                deps_changed = locked.config_mtime < enzi.config_mtime
+                self.config_changed = deps_changed
+            else:
+                deps_changed = locked.deps_hash != enzi.deps_hash
+                self.config_changed = locked.config_hash != enzi.config_hash
+            changed = path_changed or deps_changed
             if changed:
-                msg = "Enzi Config File was modified since last execution"
+                msg = "Enzi Config File's dependencies were modified since last execution"
                 logger.debug(msg)
+            elif self.records_outdated(locked):
+                # e.g. switched from/to a shared database directory,
+                # the locked revisions are kept while recording the databases
+                logger.debug('LockLoader: git database records outdated')
+                changed = True
+            update = update or changed
+            refresh = locked.config_mtime != enzi.config_mtime
+            refresh = refresh or locked.config_hash != enzi.config_hash
+            refresh = refresh or locked.deps_hash is None
 
         if update or not self.lock_existing:
-            from enzi.deps_resolver import DependencyResolver
-            
-            if os.path.exists(self.enzi.build_dir):
-                shutil.rmtree(self.enzi.build_dir, onerror=rmtree_onerror)
-            
+            from enzi.deps_resolver import new_resolver
+
             if update:
                 fmt = 'LockLoader: lock file {} outdated'
                 msg = fmt.format(self.lock_file)
@@ -79,30 +108,31 @@ class LockLoader(object):
                 msg = fmt.format(self.lock_file)
                 logger.debug(msg)
 
-            resolver = DependencyResolver(self.enzi)
+            if full_update:
+                resolver = new_resolver(enzi)
+            else:
+                resolver = new_resolver(
+                    enzi, locked=self.lock_existing, unlock=unlock)
             new_locked = resolver.resolve()
 
-            lock_file_buf = [LOCKED_HEADER]
-
-            if self.enzi.git_db_records:
-                git_db_records = self.enzi.git_db_records
+            if enzi.git_db_records:
+                git_db_records = enzi.git_db_records
                 new_locked.add_cache('git', git_db_records)
                 logger.debug(
                     'LockLoader: database records\n{}'.format(git_db_records))
 
-            locked_dump = new_locked.dumps()
-            dumps_str = toml.dumps(locked_dump)
-            lock_file_buf.append(dumps_str)
-
-            lock_file_data = '\n'.join(lock_file_buf)
-
-            f = io.FileIO(self.lock_file, 'w')
-            writer = io.BufferedWriter(f)
-            data = lock_file_data.encode('utf-8')
-            writer.write(data)
-            writer.close()
-
+            self.invalidate(self.lock_existing, new_locked)
+            self.dump(new_locked)
             self.lock_existing = new_locked
+            self.config_changed = True
+        elif refresh:
+            # targets, filesets, tools or only the mtime changed
+            logger.debug(
+                'LockLoader: refresh metadata of lock file {}'.format(self.lock_file))
+            locked.config_mtime = enzi.config_mtime
+            locked.config_hash = enzi.config_hash
+            locked.deps_hash = enzi.deps_hash
+            self.dump(locked)
         else:
             logger.debug(
                 'LockLoader: lock file {} up to date'.format(self.lock_file))
@@ -110,3 +140,72 @@ class LockLoader(object):
         if update:
             logger.debug('LockLoader: update finished')
         return self.lock_existing
+
+    def records_outdated(self, locked: Locked):
+        """
+        whether the git database records of the given lock are not the
+        existing databases of its dependencies in the current database directory
+        """
+        from enzi.io import EnziIO
+        enzi_io = EnziIO(self.enzi)
+        records = locked.cache.get('git', {})
+        for name, dep in locked.dependencies.items():
+            db_dir = enzi_io.git_db_dir(name, str(dep.source))
+            if records.get(name) != {db_dir.path}:
+                return True
+            if not db_dir.join('config').exists():
+                return True
+        return False
+
+    def invalidate(self, old: typing.Optional[Locked], new: Locked):
+        """
+        Remove the outdated files in the build directory after relocking.
+        The git databases are always kept. Without an old lock, everything else
+        is removed. Otherwise, only the checkouts of dependencies which are
+        dropped or moved to another source are removed. Checkouts of changed
+        revisions are updated in place by GitRepo, so the unchanged files keep
+        their mtime for the incremental compilation of the backends.
+        """
+        build_dir = self.enzi.build_dir
+        if not os.path.exists(build_dir):
+            return
+        database = self.enzi.database_path.path
+        if old is None:
+            for entry in os.listdir(build_dir):
+                path = os.path.join(build_dir, entry)
+                if path == database:
+                    continue
+                logger.debug('LockLoader: remove {}'.format(path))
+                if os.path.isdir(path):
+                    shutil.rmtree(path, onerror=rmtree_onerror)
+                else:
+                    os.remove(path)
+            return
+
+        from enzi.io import EnziIO
+        enzi_io = EnziIO(self.enzi)
+        for name, dep in old.dependencies.items():
+            new_dep = new.dependencies.get(name)
+            if new_dep and str(new_dep.source) == str(dep.source):
+                continue
+            repo_dir = enzi_io.git_repo_dir(name).path
+            if os.path.exists(repo_dir):
+                logger.debug('LockLoader: remove outdated {}'.format(repo_dir))
+                shutil.rmtree(repo_dir, onerror=rmtree_onerror)
+
+    def dump(self, locked: Locked):
+        """write the given Locked to the lock file"""
+        lock_file_buf = [LOCKED_HEADER]
+
+        locked_dump = locked.dumps()
+        dumps_str = toml.dumps(locked_dump)
+        lock_file_buf.append(dumps_str)
+
+        lock_file_data = '\n'.join(lock_file_buf)
+
+        f = io.FileIO(self.lock_file, 'w')
+        writer = io.BufferedWriter(f)
+        data = lock_file_data.encode('utf-8')
+        writer.write(data)
+        writer.close()
+        self.enzi.sidecar.put_locked(self.lock_file, data)
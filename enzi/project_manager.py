@@ -36,13 +36,19 @@ class ProjectFiles(FileManager):
             self.lf_managers[target] = LocalFiles(name,
                                                   config,
                                                   enzi_project.work_dir,
-                                                  build_src_dir)
+                                                  build_src_dir,
+                                                  include_cache=enzi_project.include_cache,
+                                                  jobs=enzi_project.jobs,
+                                                  sync_mode=enzi_project.sync_mode,
+                                                  link_mode=enzi_project.link_mode)
             self.cache_files[target] = Fileset()
 
         self.git_db_records = {}
         self.git_repos: typing.Mapping[str, GitRepo] = {}
 
         enzi_io = EnziIO(enzi_project)
+        self.enzi_io = enzi_io
+        self.include_cache = enzi_project.include_cache
 
         self.dependencies = {}
         if enzi_project.locked:
@@ -61,7 +67,8 @@ class ProjectFiles(FileManager):
                     locked_dep = locked_deps[name]
                     revision = locked_dep.revision
                     git_repo = enzi_io.git_repo(
-                        name, path, revision, proj_root=proj_root)
+                        name, path, revision, proj_root=proj_root,
+                        git_url=str(locked_dep.source))
                     self.git_repos[name] = git_repo
 
         self.deps_fileset = OrderedDict()
@@ -92,12 +99,13 @@ class ProjectFiles(FileManager):
         postorder_deps = nx.dfs_postorder_nodes(self.deps_graph)
         postorder_deps = list(postorder_deps)[:-1]
         # converter = lambda path: relpath(self.files_root, path)
-        for dep_name in postorder_deps:
-            dep = self.git_repos.get(dep_name)
-            dep.fetch()
-            cache = dep.cached_fileset()
-            self.deps_fileset[dep_name] = cache
-            _ccfiles[dep_name] = cache
+        with self.enzi_io:
+            for dep_name in postorder_deps:
+                dep = self.git_repos.get(dep_name)
+                dep.fetch()
+                cache = dep.cached_fileset()
+                self.deps_fileset[dep_name] = cache
+                _ccfiles[dep_name] = cache
 
         if file_manager.FM_DEBUG:
             if _ccfiles:
@@ -125,6 +133,7 @@ class ProjectFiles(FileManager):
         ccfiles = self.lf_managers[target_name].cached_fileset()
 
         self.cache_files[target_name] = ccfiles
+        self.include_cache.dump()
         self.status = FileManagerStatus.FETCHED
 
     def clean_cache(self):
@@ -13,6 +13,12 @@ from itertools import chain
 
 from semver import VersionInfo as Version
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 logger = logging.getLogger(__name__)
 
 # use an environment variable `LAUNCHER_DEBUG` to control Launcher debug output
@@ -281,12 +287,55 @@ class OptionalAction(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
+class FileLock(object):
+    """
+    An exclusive lock of a file shared by processes, e.g. enzi processes
+    fetching the same git database. It is not reentrant.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd: typing.Optional[int] = None
+
+    def __enter__(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 attempts
+                        continue
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fd, self.fd = self.fd, None
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+
 class Launcher:
     # launcher from fusesoc https://github.com/olofk/fusesoc/tree/master/fusesoc
-    def __init__(self, cmd, args=[], cwd=None):
+    def __init__(self, cmd, args=[], cwd=None, env=None):
         self.cmd = cmd
         self.args = args
         self.cwd = cwd if cwd else os.getcwd()
+        # the environment of the command, None to inherit the current one
+        self.env = env
 
     def expected(self, exit_code, *, suppress_stderr=False, no_log=False):
         """Expect this Launcher to exit with the given exit code"""
@@ -296,6 +345,7 @@ class Launcher:
             call_dict = {
                 'args': [self.cmd] + self.args,
                 'cwd': self.cwd,
+                'env': self.env,
                 'stdin': subprocess.PIPE,
                 'stdout': subprocess.DEVNULL,
                 'stderr': subprocess.DEVNULL
@@ -333,12 +383,14 @@ class Launcher:
             if get_output:
                 output = subprocess.check_output([self.cmd] + self.args,  # pylint: disable=E1123
                                                  cwd=self.cwd,
+                                                 env=self.env,
                                                  stdin=subprocess.PIPE)
                 return output.decode("utf-8")  # pylint: disable=E1101
             else:
                 call_dict = {
                     'args': [self.cmd] + self.args,
                     'cwd': self.cwd,
+                    'env': self.env,
                     'stdin': subprocess.PIPE,
                     'stdout': subprocess.DEVNULL,
                     'stderr': subprocess.DEVNULL
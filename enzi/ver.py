@@ -240,6 +240,18 @@ class Predicate(object):
         elif self.op == ReqOp.Caret:
             return self.is_compatible(ver)
 
+    def major_range(self):
+        """
+        return the (min, max) major version, which may match this Predicate,
+        None means unbounded.
+        """
+        if self.op in (ReqOp.Exact, ReqOp.Tilde, ReqOp.Caret):
+            return (self.major, self.major)
+        elif self.op in (ReqOp.Gt, ReqOp.Ge):
+            return (self.major, None)
+        else:
+            return (None, self.major)
+
     def is_exact(self, ver: VersionInfo):
         if self.major != ver.major:
             return False
@@ -480,6 +492,20 @@ class VersionReq(object):
 
         return all_match and any_compatible
 
+    def major_range(self):
+        """
+        return the (min, max) major version, which may match this VersionReq,
+        None means unbounded.
+        """
+        lo, hi = None, None
+        for pred in self.predicates:
+            plo, phi = pred.major_range()
+            if plo is not None:
+                lo = plo if lo is None else max(lo, plo)
+            if phi is not None:
+                hi = phi if hi is None else min(hi, phi)
+        return (lo, hi)
+
     def _vars(self):
         return vars(self)
 
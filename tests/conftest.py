@@ -0,0 +1,148 @@
+"""
+shared helpers of the enzi tests and benchmarks,
+which create git repositories and enzi projects in a given directory
+"""
+
+import os
+import subprocess
+
+# enzi.frontend can only be imported after enzi.project_manager
+import enzi.project_manager
+from enzi.file_manager import IncDirsResolver
+from enzi.git import Git
+from enzi.utils import Launcher
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'enzi',
+    'GIT_AUTHOR_EMAIL': 'enzi@localhost',
+    'GIT_COMMITTER_NAME': 'enzi',
+    'GIT_COMMITTER_EMAIL': 'enzi@localhost',
+}
+
+ENZI_TOML = '''enzi_version = "0.3"
+
+[package]
+name = "{name}"
+version = "{version}"
+authors = ["enzi"]
+{deps}
+[filesets.rtl]
+files = ["src/{name}.sv"]
+'''
+
+ROOT_TOML = '''enzi_version = "0.3"
+
+[package]
+name = "root"
+version = "0.1.0"
+authors = ["enzi"]
+{deps}
+[filesets.rtl]
+files = ["src/root.sv"]
+
+[targets.sim]
+default_tool = "ies"
+toplevel = "root"
+filesets = ["rtl"]
+'''
+
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    # the tests refer to the master branch, whatever the user's default branch is
+    out = subprocess.check_output(('git', '-c', 'init.defaultBranch=master') + args,
+                                  cwd=cwd, env=env,
+                                  stderr=subprocess.DEVNULL)
+    return out.decode('utf-8').strip()
+
+
+def commit_version(path, name, version, deps=''):
+    """commit a new version of an enzi package, tagged with v<version>"""
+    os.makedirs(os.path.join(path, 'src'), exist_ok=True)
+    with open(os.path.join(path, 'Enzi.toml'), 'w') as f:
+        f.write(ENZI_TOML.format(name=name, version=version, deps=deps))
+    with open(os.path.join(path, 'src', name + '.sv'), 'w') as f:
+        f.write('module {}; // {}\nendmodule\n'.format(name, version))
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'v' + version)
+    git(path, 'tag', '-a', 'v' + version, '-m', 'v' + version)
+    return git(path, 'rev-parse', 'HEAD')
+
+
+def make_package(path, name, versions, deps=''):
+    """create an enzi package git repository with the given versions"""
+    os.makedirs(path, exist_ok=True)
+    git(path, 'init', '-q')
+    revs = [commit_version(path, name, v, deps) for v in versions]
+    return revs
+
+
+def dep_section(deps, key='path'):
+    """
+    generate the dependencies sections of Enzi.toml
+    :param deps: list of (name, path, version requirement)
+    :param key: path or url
+    """
+    fmt = '\n[dependencies.{}]\n' + key + ' = "{}"\nversion = "{}"\n'
+    return ''.join(map(lambda x: fmt.format(*x), deps))
+
+
+def make_root(path, deps, key='path'):
+    os.makedirs(os.path.join(path, 'src'), exist_ok=True)
+    with open(os.path.join(path, 'Enzi.toml'), 'w') as f:
+        f.write(ROOT_TOML.format(deps=dep_section(deps, key)))
+    with open(os.path.join(path, 'src', 'root.sv'), 'w') as f:
+        f.write('module root;\nendmodule\n')
+    return path
+
+
+def edit_config(root, old, new):
+    path = os.path.join(root, 'Enzi.toml')
+    with open(path) as f:
+        data = f.read()
+    assert old in data
+    with open(path, 'w') as f:
+        f.write(data.replace(old, new))
+    # make sure the mtime changes on coarse filesystems
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def count_spawns(monkeypatch):
+    """count the Launcher.run calls"""
+    counter = {'run': 0}
+    run = Launcher.run
+
+    def counting_run(self, *args, **kwargs):
+        counter['run'] += 1
+        return run(self, *args, **kwargs)
+
+    monkeypatch.setattr(Launcher, 'run', counting_run)
+    return counter
+
+
+def count_fetches(monkeypatch):
+    """count the Git.fetch calls by the database basename"""
+    counter = {}
+    fetch = Git.fetch
+
+    def counting_fetch(self, *args, **kwargs):
+        name = os.path.basename(self.path)
+        counter[name] = counter.get(name, 0) + 1
+        return fetch(self, *args, **kwargs)
+
+    monkeypatch.setattr(Git, 'fetch', counting_fetch)
+    return counter
+
+
+def count_scans(monkeypatch):
+    """record the files scanned by IncDirsResolver.scan_include_files"""
+    scanned = []
+    scan = IncDirsResolver.scan_include_files
+
+    def counting_scan(self, file):
+        scanned.append(file)
+        return scan(self, file)
+
+    monkeypatch.setattr(IncDirsResolver, 'scan_include_files', counting_scan)
+    return scanned
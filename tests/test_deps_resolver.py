@@ -0,0 +1,283 @@
+"""
+enzi.deps_resolver module test
+resolve dependencies of local git repositories created under pytest's tmp_path
+"""
+
+import os
+import random
+import pytest
+import toml
+
+from enzi.project_manager import ProjectFiles
+from enzi.frontend import Enzi, RESOLVERS
+from enzi.deps_resolver import DependencyResolver, RevisionSet, new_resolver
+from enzi.git import Git
+from enzi.ver import VersionReq
+from conftest import make_package, commit_version, git, make_root, dep_section
+
+@pytest.fixture
+def diamond(tmp_path):
+    """
+    root -> mid, leaf; mid -> leaf
+    """
+    leaf = str(tmp_path / 'leaf')
+    mid = str(tmp_path / 'mid')
+    revs = {}
+    revs['leaf'] = make_package(leaf, 'leaf', ['0.1.0', '0.2.0', '1.0.0'])
+    mid_deps = dep_section([('leaf', leaf, '>=0.1.0, <1.0.0')])
+    revs['mid'] = make_package(mid, 'mid', ['0.1.0', '0.2.0'], mid_deps)
+    root = make_root(str(tmp_path / 'root'),
+                     [('mid', mid, '0.1.0'), ('leaf', leaf, '<0.2.0')])
+    return root, revs
+
+
+@pytest.mark.parametrize('resolver', RESOLVERS)
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_resolve_diamond(diamond, jobs, resolver):
+    root, revs = diamond
+    enzi = Enzi(root, jobs=jobs, resolver=resolver)
+    locked = new_resolver(enzi).resolve()
+
+    assert set(locked.dependencies) == {'mid', 'leaf'}
+    assert locked.dependencies['mid'].revision == revs['mid'][0]
+    assert locked.dependencies['leaf'].revision == revs['leaf'][0]
+    assert locked.dependencies['mid'].dependencies == {'leaf'}
+    # every database is recorded once
+    assert set(enzi.git_db_records) == {'mid', 'leaf'}
+
+
+def test_project_fetch(diamond):
+    root, revs = diamond
+    enzi = Enzi(root)
+    enzi.init()
+    project = ProjectFiles(enzi)
+    project.fetch('sim')
+    filesets = project.get_fileset('sim')
+    assert list(filesets) == ['leaf', 'mid', 'root']
+    leaf_file = os.path.join(root, 'build', 'deps', 'leaf', 'src', 'leaf.sv')
+    assert list(filesets['leaf'].files) == [leaf_file]
+    with open(leaf_file) as f:
+        assert '0.1.0' in f.read()
+
+
+def test_partial_clone_project(tmp_path):
+    leaf = str(tmp_path / 'leaf')
+    revs = make_package(leaf, 'leaf', ['0.1.0', '0.2.0'])
+    git(leaf, 'config', 'uploadpack.allowFilter', 'true')
+    root = make_root(str(tmp_path / 'root'),
+                     [('leaf', 'file://' + leaf, '0.1.0')], 'url')
+
+    enzi = Enzi(root, partial_clone=True)
+    enzi.init()
+    assert enzi.locked.dependencies['leaf'].revision == revs[0]
+    db_path = list(enzi.git_db_records['leaf'])[0]
+    db = Git(db_path)
+    assert db.is_partial()
+    # only Enzi.toml of the inspected revision is fetched
+    assert len(db.missing_objects(revs[0])) == 1
+    assert len(db.missing_objects(revs[1])) == 2
+
+    project = ProjectFiles(enzi)
+    project.fetch('sim')
+    assert not db.missing_objects(revs[0])
+    assert len(db.missing_objects(revs[1])) == 2
+
+
+@pytest.mark.parametrize('commit', [0, 1, 'v0.1.0', 'master'])
+def test_resolve_revision(tmp_path, commit):
+    leaf = str(tmp_path / 'leaf')
+    revs = make_package(leaf, 'leaf', ['0.1.0', '0.2.0'])
+    if type(commit) == int:
+        expected = revs[commit]
+        commit = revs[commit][:10]
+    else:
+        expected = revs[0] if commit == 'v0.1.0' else revs[1]
+    root = str(tmp_path / 'root')
+    make_root(root, [])
+    with open(os.path.join(root, 'Enzi.toml'), 'a') as f:
+        f.write('\n[dependencies.leaf]\npath = "{}"\ncommit = "{}"\n'.format(
+            leaf, commit))
+
+    locked = DependencyResolver(Enzi(root)).resolve()
+    assert locked.dependencies['leaf'].revision == expected
+
+
+def test_revision_set():
+    full = RevisionSet.full(100000)
+    assert len(full) == 100000
+    assert full.min() == 0
+    assert 99999 in full and not 100000 in full and not -1 in full
+
+    ids = RevisionSet.from_indices([70000, 3, 99999, 3])
+    assert len(ids) == 3
+    assert list(ids) == [3, 70000, 99999]
+    narrowed = full.intersection(ids) & RevisionSet.from_indices(range(10, 100000))
+    assert list(narrowed) == [70000, 99999]
+    assert narrowed.min() == 70000
+    assert narrowed == RevisionSet.from_indices([99999, 70000])
+    assert not RevisionSet.full(0)
+    with pytest.raises(ValueError):
+        RevisionSet().min()
+    assert repr(full) == 'RevisionSet(100000 revisions, min 0)'
+
+
+@pytest.fixture
+def conflict(tmp_path):
+    """
+    root -> mid, leaf ^1.0.0; mid 0.2.x -> leaf ^2.0.0, mid 0.1.0 -> leaf ^1.0.0
+    mid 0.2.0 and 0.2.1 have the same Enzi.toml
+    """
+    leaf = str(tmp_path / 'leaf')
+    mid = str(tmp_path / 'mid')
+    revs = {}
+    revs['leaf'] = make_package(leaf, 'leaf', ['1.0.0', '2.0.0'])
+    revs['mid'] = make_package(
+        mid, 'mid', ['0.1.0'], dep_section([('leaf', leaf, '^1.0.0')]))
+    revs['mid'].append(commit_version(
+        mid, 'mid', '0.2.0', dep_section([('leaf', leaf, '^2.0.0')])))
+    with open(os.path.join(mid, 'src', 'mid.sv'), 'a') as f:
+        f.write('// 0.2.1\n')
+    git(mid, 'commit', '-q', '-a', '-m', 'v0.2.1')
+    git(mid, 'tag', 'v0.2.1')
+    revs['mid'].append(git(mid, 'rev-parse', 'HEAD'))
+    return tmp_path, revs
+
+
+def test_backtracking_resolve(conflict):
+    tmp_path, revs = conflict
+    root = make_root(str(tmp_path / 'root'), [
+        ('mid', str(tmp_path / 'mid'), '>=0.1.0'),
+        ('leaf', str(tmp_path / 'leaf'), '^1.0.0')])
+
+    with pytest.raises(RuntimeError):
+        DependencyResolver(Enzi(root)).resolve()
+
+    resolver = new_resolver(Enzi(root, resolver='backtracking'))
+    locked = resolver.resolve()
+    assert locked.dependencies['mid'].revision == revs['mid'][0]
+    assert locked.dependencies['leaf'].revision == revs['leaf'][0]
+    # mid 0.2.0 and 0.2.1 are rejected by a single Enzi.toml load
+    assert resolver.config_loads == 3
+
+
+def test_backtracking_failure(conflict):
+    tmp_path, _ = conflict
+    root = make_root(str(tmp_path / 'root'), [
+        ('mid', str(tmp_path / 'mid'), '>=0.2.0'),
+        ('leaf', str(tmp_path / 'leaf'), '^1.0.0')])
+
+    with pytest.raises(RuntimeError) as excinfo:
+        new_resolver(Enzi(root, resolver='backtracking')).resolve()
+    msg = str(excinfo.value)
+    assert 'mid 0.2.1, 0.2.0 requires leaf ^2.0.0' in msg
+    assert 'package root requires leaf ^1.0.0' in msg
+    assert 'package root requires mid >= 0.2.0' in msg
+
+
+def random_graph(path, seed, size=5):
+    """
+    create packages p0..p<size-1> with random versions and requirements,
+    a package only depends on packages with a larger number.
+    """
+    rng = random.Random(seed)
+    names = ['p{}'.format(i) for i in range(size)]
+    num_versions = {}
+
+    def requirement(name):
+        n = num_versions[name]
+        lo = rng.randint(1, n)
+        hi = rng.randint(lo + 1, n + 1)
+        return (name, os.path.join(path, name), rng.choice([
+            '>=0.{}.0'.format(lo), '<0.{}.0'.format(hi),
+            '>=0.{}.0, <0.{}.0'.format(lo, hi), '0.{}.0'.format(lo)]))
+
+    for i in reversed(range(size)):
+        pkg_path = os.path.join(path, names[i])
+        os.makedirs(pkg_path)
+        git(pkg_path, 'init', '-q')
+        num_versions[names[i]] = rng.randint(1, 4)
+        for minor in range(1, num_versions[names[i]] + 1):
+            deps = [requirement(x) for x in names[i + 1:] if rng.random() < 0.5]
+            commit_version(pkg_path, names[i], '0.{}.0'.format(minor),
+                           dep_section(deps))
+
+    deps = [requirement(x) for x in names if x == 'p0' or rng.random() < 0.3]
+    return make_root(os.path.join(path, 'root'), deps)
+
+
+def try_resolve(root, resolver):
+    try:
+        return new_resolver(Enzi(root, resolver=resolver)).resolve()
+    except RuntimeError:
+        return None
+
+
+def check_locked(root, locked):
+    """the locked packages are exactly the required ones, and satisfy all requirements"""
+    def requirements(data):
+        deps = toml.loads(data).get('dependencies', {})
+        return {k: VersionReq.parse(v['version']) for k, v in deps.items()}
+
+    with open(os.path.join(root, 'Enzi.toml')) as f:
+        reqs = [requirements(f.read())]
+    for dep in locked.dependencies.values():
+        data = git(str(dep.source), 'show', dep.revision + ':Enzi.toml')
+        reqs.append(requirements(data))
+
+    assert set(locked.dependencies) == set().union(*reqs)
+    for req in reqs:
+        for name, ver_req in req.items():
+            assert ver_req.matches(locked.dependencies[name].version)
+
+
+@pytest.mark.parametrize('seed', range(12))
+def test_resolver_differential(tmp_path, seed):
+    root = random_graph(str(tmp_path), seed)
+    fixpoint = try_resolve(root, 'fixpoint')
+    backtracking = try_resolve(root, 'backtracking')
+
+    def revisions(locked):
+        return {k: v.revision for k, v in locked.dependencies.items()}
+
+    # backtracking solves whatever fixpoint solves, with the same picks
+    if fixpoint is not None:
+        assert backtracking is not None
+        assert revisions(backtracking) == revisions(fixpoint)
+    if backtracking is not None:
+        check_locked(root, backtracking)
+
+
+def test_config_cache(diamond, monkeypatch):
+    from enzi.config import RawConfig, CONFIG_CACHE
+    root, revs = diamond
+    enzi = Enzi(root)
+    enzi.init()
+    cache_path = os.path.join(root, 'build', 'database', CONFIG_CACHE)
+    assert os.path.exists(cache_path)
+    # each Enzi.toml is validated once, detect_file reuses the memo
+    hits = enzi.config_cache.hits
+    ProjectFiles(enzi).fetch('sim')
+    assert enzi.config_cache.misses == 2
+    assert enzi.config_cache.hits >= hits + 2
+
+    # a new session loads the validated configs from the cache file
+    validated = []
+    real_validated = RawConfig.validated
+    def counting_validated(self):
+        if self.config_path != os.path.join(root, 'Enzi.toml'):
+            validated.append(self.config_path)
+        return real_validated(self)
+    monkeypatch.setattr(RawConfig, 'validated', counting_validated)
+    enzi = Enzi(root)
+    locked = new_resolver(enzi).resolve()
+    assert locked.dependencies['mid'].revision == revs['mid'][0]
+    assert enzi.config_cache.misses == 0 and not validated
+
+    # outdated schema
+    with open(cache_path) as f:
+        data = f.read()
+    with open(cache_path, 'w') as f:
+        f.write(data.replace('"schema": 1', '"schema": 0'))
+    enzi = Enzi(root)
+    new_resolver(enzi).resolve()
+    assert enzi.config_cache.misses == 2 and len(validated) == 2
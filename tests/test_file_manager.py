@@ -0,0 +1,218 @@
+"""
+enzi.file_manager module test
+all the source files are created locally under pytest's tmp_path
+"""
+
+import os
+import pytest
+
+from enzi.file_manager import IncDirsResolver, IncludeCache, INCLUDE_CACHE
+from enzi.file_manager import LocalFiles, LINK_MODES
+from conftest import count_scans
+
+
+def write_files(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+SOURCES = {
+    'rtl/top.sv': '`include "defs.svh"\n`include "../inc/bus.svh"\nmodule top;\nendmodule\n',
+    'rtl/defs.svh': '`define DEFS\n',
+    'rtl/leaf.v': 'module leaf;\nendmodule\n',
+    'inc/bus.svh': '`define BUS\n',
+}
+
+
+def resolve(root, cache):
+    files = ['rtl/top.sv', 'rtl/leaf.v']
+    resolver = IncDirsResolver(root, files, include_cache=cache)
+    return resolver.resolve()
+
+
+def test_include_cache(tmp_path, monkeypatch):
+    root = str(tmp_path / 'pkg')
+    write_files(root, SOURCES)
+    cache_path = str(tmp_path / 'build' / INCLUDE_CACHE)
+
+    cache = IncludeCache(cache_path)
+    fileset = resolve(root, cache)
+    # the sources and the headers they include
+    assert (cache.hits, cache.misses) == (0, 4)
+    top = os.path.join(root, 'rtl', 'top.sv')
+    inc_dirs = list(map(os.path.normpath, fileset.inc_dirs[top]))
+    assert inc_dirs == [os.path.join(root, 'rtl'), os.path.join(root, 'inc')]
+    cache.dump()
+    assert os.path.exists(cache_path)
+
+    # the unchanged files are never read again
+    cache = IncludeCache(cache_path)
+    scanned = count_scans(monkeypatch)
+    assert resolve(root, cache).inc_dirs == fileset.inc_dirs
+    assert (cache.hits, cache.misses) == (4, 0)
+    assert not scanned
+
+    with open(top, 'a') as f:
+        f.write('`include "leaf.v"\n')
+    cache = IncludeCache(cache_path)
+    fileset = resolve(root, cache)
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert scanned == [top]
+    # an included file is no longer a source file of its own
+    assert fileset.files == {top}
+    cache.dump()
+
+    # rewritten with the same size and mtime, like an export of another commit
+    # made in the same second
+    stat = os.stat(top)
+    with open(top) as f:
+        data = f.read()
+    with open(top, 'w') as f:
+        f.write(data.replace('../inc/bus.svh', '../inc/bux.svh'))
+    os.utime(top, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    scanned.clear()
+    cache = IncludeCache(cache_path)
+    resolve(root, cache)
+    assert scanned == [top]
+
+
+def test_include_graph(tmp_path, monkeypatch):
+    root = str(tmp_path / 'pkg')
+    write_files(root, {
+        'rtl/top.sv': '`include "../inc/a.svh"\nmodule top;\nendmodule\n',
+        'rtl/sub.sv': '`include "../inc/nested/b.svh"\nmodule sub;\nendmodule\n',
+        'rtl/leaf.sv': 'module leaf;\nendmodule\n',
+        'inc/a.svh': '`include "nested/b.svh"\n',
+        # include cycles are guarded by include guards in the sources
+        'inc/nested/b.svh': '`include "../a.svh"\n`include "c.svh"\n',
+        'inc/nested/c.svh': '`define C\n',
+    })
+    scanned = count_scans(monkeypatch)
+    resolver = IncDirsResolver(root, ['rtl/top.sv', 'rtl/sub.sv', 'rtl/leaf.sv'])
+    fileset = resolver.resolve()
+    path = lambda x: os.path.join(root, *x.split('/'))
+    # each file is parsed once
+    assert len(scanned) == len(set(scanned)) == 6
+
+    # the directories of the nested include files are added
+    inc_dirs = list(map(os.path.normpath, fileset.inc_dirs[path('rtl/top.sv')]))
+    assert inc_dirs == [path('rtl'), path('inc'), path('inc/nested')]
+    assert set(fileset.get_includes(path('rtl/top.sv'))) == \
+        {path('inc/a.svh'), path('inc/nested/b.svh'), path('inc/nested/c.svh')}
+
+    # the sources to compile again when a header changes
+    affected = fileset.affected_files(path('inc/nested/c.svh'))
+    assert list(affected) == [path('rtl/top.sv'), path('rtl/sub.sv')]
+
+
+def test_parallel_scan(tmp_path):
+    root = str(tmp_path / 'pkg')
+    files = {}
+    for i in range(64):
+        files['inc{}/defs{}.svh'.format(i % 8, i)] = '`define DEFS{}\n'.format(i)
+        files['rtl/m{}.sv'.format(i)] = '`include "../inc{}/defs{}.svh"\n`include "../inc{}/defs{}.svh"\n'.format(
+            i % 8, i, (i + 3) % 8, (i + 3) % 64)
+    write_files(root, files)
+    sources = ['rtl/m{}.sv'.format(i) for i in range(64)]
+
+    def resolve_with(jobs):
+        resolver = IncDirsResolver(root, sources, jobs=jobs)
+        fileset = resolver.resolve()
+        return list(fileset.files), [(k, list(v)) for k, v in fileset.inc_dirs.items()]
+
+    # the same fileset and include directories in the same order
+    expected = resolve_with(1)
+    assert len(expected[1]) == 64
+    assert resolve_with(8) == expected
+
+
+def test_include_extractor(tmp_path, monkeypatch):
+    data = (
+        b'// caf\xe9, latin-1 vendor source\n'
+        b'  `include "a.svh"\n'
+        b'\t`include"b.svh" // "not a path"\n'
+        b'`include `MACRO\n'
+        b'module m; // `include "c.svh"\n'
+        b'`include "d\xe9.svh"\r\n'
+    )
+    assert IncDirsResolver.match_include_files(data) == ['a.svh', 'b.svh', 'd\udce9.svh']
+    assert IncDirsResolver.match_include_files(b'module m;\nendmodule\n') == []
+
+    # large files are scanned through mmap
+    import enzi.file_manager
+    monkeypatch.setattr(enzi.file_manager, 'MMAP_THRESHOLD', 16)
+    path = tmp_path / 'm.sv'
+    path.write_bytes(data)
+    resolver = IncDirsResolver(str(tmp_path))
+    assert list(resolver.get_include_files(str(path)))[:2] == ['a.svh', 'b.svh']
+    path.write_bytes(b'')
+    assert list(resolver.get_include_files(str(path))) == []
+
+
+@pytest.mark.parametrize('sync_mode', ['stat', 'hash'])
+@pytest.mark.parametrize('link_mode', LINK_MODES)
+def test_local_files_sync(tmp_path, sync_mode, link_mode):
+    root = str(tmp_path / 'pkg')
+    write_files(root, SOURCES)
+    build = str(tmp_path / 'pkg' / 'build' / 'pkg')
+
+    def fetch(files):
+        config = {'fileset': {'files': files}}
+        local = LocalFiles('pkg', config, root, build,
+                           sync_mode=sync_mode, link_mode=link_mode)
+        local.fetch()
+        return local
+
+    files = ['rtl/top.sv', 'rtl/defs.svh', 'rtl/leaf.v', 'inc/bus.svh']
+    assert fetch(files).writes == 4
+    dst = os.path.join(build, 'rtl', 'top.sv')
+    mtime = os.lstat(dst).st_mtime_ns
+    # nothing is written if nothing changes
+    assert fetch(files).writes == 0
+    assert os.lstat(dst).st_mtime_ns == mtime
+
+    src = os.path.join(root, 'rtl', 'top.sv')
+    with open(src, 'a') as f:
+        f.write('// changed\n')
+    assert fetch(files).writes == (0 if link_mode != 'copy' else 1)
+    with open(dst) as f:
+        assert f.read().endswith('// changed\n')
+
+    # a new mtime of the same content is only written by the stat sync
+    os.utime(src, ns=(mtime, mtime))
+    expected = 1 if (link_mode, sync_mode) == ('copy', 'stat') else 0
+    assert fetch(files).writes == expected
+
+    # the files that left the fileset are removed with their empty directories
+    local = fetch(files[:3])
+    assert local.writes == 1
+    assert not os.path.exists(os.path.join(build, 'inc'))
+    assert os.path.exists(dst)
+
+
+def test_local_files_targets(tmp_path):
+    root = str(tmp_path / 'pkg')
+    write_files(root, dict(SOURCES, **{'tb/tb.sv': 'module tb;\nendmodule\n'}))
+    build = str(tmp_path / 'pkg' / 'build' / 'pkg')
+
+    def fetch(target, files):
+        config = {'fileset': {'files': files}}
+        local = LocalFiles('pkg-target-' + target, config, root, build)
+        local.fetch()
+        return local.writes
+
+    # the targets share the build directory of the package
+    sim = ['rtl/top.sv', 'rtl/leaf.v', 'tb/tb.sv']
+    assert fetch('sim', sim) == 3
+    assert fetch('synth', ['rtl/top.sv', 'rtl/leaf.v']) == 0
+    assert os.path.exists(os.path.join(build, 'tb', 'tb.sv'))
+    assert fetch('sim', sim) == 0
+
+    # a file is removed once no target has it
+    assert fetch('sim', sim[:2]) == 1
+    assert not os.path.exists(os.path.join(build, 'tb'))
+    assert fetch('synth', ['rtl/top.sv']) == 0
+    assert os.path.exists(os.path.join(build, 'rtl', 'leaf.v'))
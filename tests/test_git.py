@@ -0,0 +1,578 @@
+"""
+enzi.git module test
+all the git repositories are created locally under pytest's tmp_path
+"""
+
+import os
+import pytest
+
+from enzi.git import Git, GitRepo, GitVersions, CHECKOUT_MODES, PIN_REF_PREFIX
+from conftest import git, commit_version, make_package, count_spawns
+
+
+def test_peel_refs(tmp_path):
+    path = str(tmp_path / 'pkg')
+    revs = make_package(path, 'pkg', ['0.1.0', '0.2.0'])
+    # lightweight tag and a tag of tag
+    git(path, 'tag', 'light', revs[0])
+    git(path, 'tag', '-a', 'nested', '-m', 'nested', 'v0.2.0')
+    # tag points to a tree must be skipped
+    git(path, 'tag', 'tree', 'HEAD^{tree}')
+
+    refs = Git(path).peel_refs()
+    assert refs['refs/tags/v0.1.0'] == revs[0]
+    assert refs['refs/tags/v0.2.0'] == revs[1]
+    assert refs['refs/tags/light'] == revs[0]
+    assert refs['refs/tags/nested'] == revs[1]
+    assert refs['refs/heads/master'] == revs[1]
+    assert 'refs/tags/tree' not in refs
+
+    tags = Git(path).list_tags(with_rev=True)
+    assert (revs[0], 'refs/tags/v0.1.0') in tags
+    assert not any(map(lambda x: x[1].endswith('^{}'), tags))
+
+
+@pytest.mark.parametrize('ntags', [4, 64])
+def test_list_tags_spawn_count(tmp_path, monkeypatch, ntags):
+    path = str(tmp_path / 'pkg')
+    make_package(path, 'pkg', ['0.1.0'])
+    for i in range(ntags):
+        git(path, 'tag', 'v1.0.{}'.format(i))
+
+    counter = count_spawns(monkeypatch)
+    tags = Git(path).list_tags()
+    refs = Git(path).list_refs()
+    assert len(tags) == ntags + 1
+    assert len(refs) == ntags + 2
+    # one for-each-ref for each call, no matter how many tags
+    assert counter['run'] == 2
+
+
+def test_object_reader(tmp_path, monkeypatch):
+    path = str(tmp_path / 'pkg')
+    revs = make_package(path, 'pkg', ['0.1.0', '0.2.0'])
+
+    counter = count_spawns(monkeypatch)
+    db = Git(path)
+    for rev, ver in zip(revs, ['0.1.0', '0.2.0']):
+        data = db.read_file(rev, 'Enzi.toml')
+        assert 'version = "{}"'.format(ver) in data
+    assert db.read_file(revs[0], 'NoSuchFile.toml') is None
+    assert db.read_file(revs[0], 'no such.toml') is None
+    assert db.read_file('0' * 40, 'Enzi.toml') is None
+
+    reader = db.object_reader()
+    obj_hash, obj_type, _ = reader.info(revs[0])
+    assert (obj_hash, obj_type) == (revs[0], 'commit')
+    assert reader.info('{}:src'.format(revs[0]))[1] == 'tree'
+    assert reader.info('{}:no dir'.format(revs[0])) is None
+    assert reader.requests == 8
+    # all reads are served by the coprocesses
+    assert counter['run'] == 0
+
+    db.close()
+    assert db.reader is None
+    # the reader restarts lazily after close
+    assert db.read_file(revs[1], 'Enzi.toml')
+
+    # offline, only a partial clone checks its missing blobs before reading
+    monkeypatch.setattr(Git, 'offline', True)
+    counter['run'] = 0
+    for rev in revs:
+        assert db.read_file(rev, 'Enzi.toml')
+    assert counter['run'] == 1
+    db.close()
+
+
+@pytest.mark.parametrize('object_format', ['sha1', 'sha256'])
+def test_entry_hash(tmp_path, object_format):
+    path = str(tmp_path / 'pkg')
+    os.makedirs(path)
+    git(path, 'init', '-q', '--object-format=' + object_format)
+    rev = commit_version(path, 'pkg', '0.1.0')
+    db = Git(path)
+    for name in ['Enzi.toml', 'src']:
+        assert db.entry_hash(rev, name) == git(path, 'rev-parse', rev + ':' + name)
+    assert db.entry_hash(rev, 'pkg.sv') is None
+    db.close()
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_fetch(tmp_path, monkeypatch, single_pass):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', ['0.1.0', '0.2.0'])
+    git(upstream, 'branch', 'dev', revs[0])
+
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg(upstream))
+
+    assert db.remote_url() == upstream
+    assert db.remote_url('upstream') is None
+
+    counter = count_spawns(monkeypatch)
+    db.fetch('origin', single_pass=single_pass)
+    assert counter['run'] == (1 if single_pass else 2)
+    assert db.fetch_count == 1
+
+    refs = db.peel_refs()
+    assert refs['refs/remotes/origin/master'] == revs[1]
+    assert refs['refs/remotes/origin/dev'] == revs[0]
+    assert refs['refs/tags/v0.1.0'] == revs[0]
+
+    # deleted branches are pruned, so are tags with the explicit refspec
+    git(upstream, 'branch', '-D', 'dev')
+    git(upstream, 'tag', '-d', 'v0.1.0')
+    db.fetch('origin', single_pass=single_pass)
+    refs = db.peel_refs()
+    assert 'refs/remotes/origin/dev' not in refs
+    if single_pass:
+        assert 'refs/tags/v0.1.0' not in refs
+    assert db.fetch_count == 2
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_fetch_keeps_pins(tmp_path, single_pass):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', ['0.1.0', '0.2.0'])
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg(upstream))
+    db.fetch('origin', single_pass=single_pass)
+
+    repo = GitRepo('pkg', str(tmp_path), Git(str(tmp_path / 'deps' / 'pkg')),
+                   db_path, revs[0])
+    tag = repo.tag_revision(db)
+    db.fetch('origin', single_pass=single_pass)
+    refs = db.peel_refs()
+    # the tags missing in the remote are pruned, the pins are kept
+    if single_pass:
+        assert 'refs/tags/' + tag not in refs
+    assert refs[PIN_REF_PREFIX + revs[0]] == revs[0]
+
+
+def make_partial_db(tmp_path):
+    """a blob-less database of an upstream with large blobs"""
+    upstream = str(tmp_path / 'upstream')
+    os.makedirs(upstream)
+    git(upstream, 'init', '-q')
+    git(upstream, 'config', 'uploadpack.allowFilter', 'true')
+    revs = []
+    for i, ver in enumerate(['0.1.0', '0.2.0']):
+        with open(os.path.join(upstream, 'netlist{}.v'.format(i)), 'wb') as f:
+            f.write(os.urandom(1 << 16))
+        revs.append(commit_version(upstream, 'pkg', ver))
+
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg('file://' + upstream))
+    db.fetch('origin', filter_spec='blob:none')
+    return db, revs
+
+
+def test_partial_clone_db(tmp_path):
+    db, revs = make_partial_db(tmp_path)
+    assert db.is_partial()
+    # Enzi.toml, src/pkg.sv and the netlists
+    assert len(db.missing_objects(revs[1])) == 4
+    assert len(db.missing_objects(revs[0])) == 3
+
+    # lazily fetch Enzi.toml only
+    assert 'version = "0.1.0"' in db.read_file(revs[0], 'Enzi.toml')
+    db.close()
+    assert len(db.missing_objects(revs[0])) == 2
+    assert len(db.missing_objects(revs[1])) == 4
+
+    db.prefetch(revs[0])
+    assert not db.missing_objects(revs[0])
+    # netlist0.v is shared by both revisions
+    assert len(db.missing_objects(revs[1])) == 3
+
+
+def test_partial_clone_checkout(tmp_path):
+    db, revs = make_partial_db(tmp_path)
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db.path, revs[0])
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[0]
+    assert os.path.exists(os.path.join(repo.path, 'netlist0.v'))
+    # only the blobs of the checked out revision are fetched
+    assert len(db.missing_objects(revs[1])) == 3
+
+    # checkout another revision in the existing repository
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db.path, revs[1])
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[1]
+    assert os.path.exists(os.path.join(repo.path, 'netlist1.v'))
+    assert not db.missing_objects(revs[1])
+
+
+@pytest.mark.parametrize('mode', ['clone', 'export'])
+def test_partial_clone_offline(tmp_path, monkeypatch, mode):
+    db, revs = make_partial_db(tmp_path)
+    monkeypatch.setattr(Git, 'offline', True)
+    assert db.env['GIT_NO_LAZY_FETCH'] == '1'
+    # the missing blobs are never fetched
+    with pytest.raises(RuntimeError, match='offline'):
+        db.read_file(revs[0], 'Enzi.toml')
+    assert db.read_file(revs[0], 'missing.v') is None
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db.path, revs[0],
+                   checkout_mode=mode)
+    with pytest.raises(RuntimeError, match='offline'):
+        repo.fetch()
+    assert len(db.missing_objects(revs[0])) == 3
+
+    # the blobs fetched before are checked out offline
+    monkeypatch.setattr(Git, 'offline', False)
+    db.prefetch(revs[0])
+    monkeypatch.setattr(Git, 'offline', True)
+    assert 'pkg' in db.read_file(revs[0], 'Enzi.toml')
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db.path, revs[0],
+                   checkout_mode=mode)
+    repo.fetch()
+    assert os.path.exists(os.path.join(repo.path, 'netlist0.v'))
+
+
+def test_git_versions_index():
+    from semver import VersionInfo
+    from enzi.ver import VersionReq
+    from hashlib import sha1
+    revs = [sha1(str(i).encode('utf-8')).hexdigest() for i in range(200)]
+    tags = ['0.1.0', '0.2.0-alpha', '0.2.0', '1.0.0', '1.2.0', '2.0.0']
+    versions = list(map(lambda x: (VersionInfo.parse(x[1]), revs[x[0] * 10]),
+                        enumerate(tags)))
+    versions.reverse()
+    gv = GitVersions(versions, {'master': revs[0]}, revs)
+
+    assert list(map(str, gv.version_keys)) == tags
+    assert gv.index_of(revs[42]) == 42
+    assert gv.index_of('f' * 40) is None
+    assert gv.find_revisions(revs[5][:12]) == [5]
+    assert gv.find_revisions(revs[0][:7]) == [0]
+    assert sorted(gv.find_revisions('')) == list(range(len(revs)))
+    assert gv.find_revisions('xyz') == []
+    assert gv.find_version(revs[30]) == VersionInfo.parse('1.0.0')
+    assert gv.find_version(revs[31]) is None
+
+    def matched(req):
+        req = VersionReq.parse(req)
+        ret = list(map(lambda x: str(x[0]), gv.matching_versions(req)))
+        expected = list(filter(lambda x: req.matches(VersionInfo.parse(x)), tags))
+        assert ret == expected
+        return ret
+
+    assert matched('^1.0.0') == ['1.0.0', '1.2.0']
+    assert matched('<1.0.0') == ['0.1.0', '0.2.0']
+    assert matched('>=0.2.0-alpha, <1.0.0') == ['0.2.0-alpha', '0.2.0']
+    assert matched('>1.0.0') == ['1.2.0', '2.0.0']
+    assert matched('~0.2') == ['0.2.0']
+    assert matched('>=2.0.0, <1.0.0') == []
+
+
+def test_normalize_git_url(tmp_path):
+    from enzi.git import normalize_git_url
+    urls = ['git@GitHub.com:enzi/pkg.git', 'ssh://git@github.com/enzi/pkg/',
+            'git@github.com:/enzi/pkg']
+    assert set(map(normalize_git_url, urls)) == {'ssh://git@github.com/enzi/pkg'}
+    urls = ['https://GitHub.com/enzi/pkg.git/', 'https://github.com/enzi/pkg']
+    assert set(map(normalize_git_url, urls)) == {'https://github.com/enzi/pkg'}
+    assert normalize_git_url('https://github.com/Enzi/pkg') != normalize_git_url(urls[1])
+    path = str(tmp_path)
+    assert normalize_git_url(path + '/') == normalize_git_url('file://' + path)
+
+
+def object_files(git_dir):
+    """the loose and packed object files of a git directory"""
+    ret = []
+    for root, _, files in os.walk(os.path.join(git_dir, 'objects')):
+        ret.extend(f for f in files if not f.startswith('alternates'))
+    return ret
+
+
+@pytest.mark.parametrize('mode', [m for m in CHECKOUT_MODES if m != 'export'])
+def test_checkout_mode(tmp_path, mode):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', ['0.1.0', '0.2.0'])
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg(upstream))
+    db.fetch('origin')
+
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db_path, revs[0],
+                   checkout_mode=mode)
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[0]
+    src = os.path.join(repo.path, 'src', 'pkg.sv')
+    with open(src) as f:
+        assert '0.1.0' in f.read()
+
+    git_dir = git(repo.path, 'rev-parse', '--absolute-git-dir')
+    if mode == 'clone':
+        assert object_files(git_dir)
+    else:
+        # all the objects are kept by the database only
+        assert not object_files(git_dir)
+    if mode == 'worktree':
+        assert git_dir.startswith(db_path)
+
+    # update the existing checkout to another revision
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db_path, revs[1],
+                   checkout_mode=mode)
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[1]
+    with open(src) as f:
+        assert '0.2.0' in f.read()
+
+    # a removed worktree can be checked out again
+    import shutil
+    shutil.rmtree(repo.path)
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db_path, revs[0],
+                   checkout_mode=mode)
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[0]
+
+    # another mode checks out the same revision again
+    other = 'clone' if mode != 'clone' else 'worktree'
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db_path, revs[0],
+                   checkout_mode=other)
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[0]
+    git_dir = git(repo.path, 'rev-parse', '--absolute-git-dir')
+    assert git_dir.startswith(db_path) == (other == 'worktree')
+    assert repo.read_stamp()['checkout_mode'] == other
+
+
+@pytest.mark.parametrize('mode', ['clone', 'worktree'])
+def test_checkout_stamp(tmp_path, monkeypatch, mode):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', ['0.1.0', '0.2.0'])
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[0],
+                   checkout_mode=mode)
+    repo.fetch()
+    stamp = repo.read_stamp()
+    assert stamp['revision'] == revs[0]
+    assert stamp['files'] == [os.path.join('src', 'pkg.sv')]
+    # the stamp is not an untracked file of the checkout
+    assert git(repo.path, 'status', '--porcelain') == ''
+
+    # an up-to-date checkout is verified without spawning git
+    counter = count_spawns(monkeypatch)
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[0],
+                   checkout_mode=mode)
+    repo.fetch()
+    files = repo.cached_fileset().files
+    assert counter['run'] == 0
+    assert os.path.join(repo.path, 'src', 'pkg.sv') in files
+
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[1],
+                   checkout_mode=mode)
+    repo.fetch()
+    assert counter['run'] > 0
+    assert repo.git.current_checkout() == revs[1]
+    assert repo.read_stamp()['revision'] == revs[1]
+
+
+def test_export(tmp_path, monkeypatch):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', ['0.1.0', '0.2.0'])
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[0],
+                   checkout_mode='export')
+    repo.fetch()
+    src = os.path.join(repo.path, 'src', 'pkg.sv')
+    with open(src) as f:
+        assert '0.1.0' in f.read()
+    # no working tree, only the files and the stamp of the revision
+    assert not os.path.exists(os.path.join(repo.path, '.git'))
+    assert repo.read_stamp()['revision'] == revs[0]
+
+    # an exported revision is up to date without spawning git
+    counter = count_spawns(monkeypatch)
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[0],
+                   checkout_mode='export')
+    repo.fetch()
+    assert counter['run'] == 0
+    assert repo.cached_fileset().files
+
+    # another revision replaces the exported files
+    with open(os.path.join(repo.path, 'stale.v'), 'w') as f:
+        f.write('stale\n')
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[1],
+                   checkout_mode='export')
+    repo.fetch()
+    with open(src) as f:
+        assert '0.2.0' in f.read()
+    assert not os.path.exists(os.path.join(repo.path, 'stale.v'))
+
+    # a clone replaces the exported files
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, revs[1])
+    repo.fetch()
+    assert repo.git.current_checkout() == revs[1]
+
+
+def test_export_submodules(tmp_path, monkeypatch):
+    # submodules of local paths need the file protocol
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', 'protocol.file.allow')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', 'always')
+    sub = str(tmp_path / 'sub')
+    make_package(sub, 'sub', ['0.1.0'])
+    upstream = str(tmp_path / 'upstream')
+    make_package(upstream, 'pkg', ['0.1.0'])
+    git(upstream, 'submodule', 'add', '-q', sub, 'sub')
+    rev = commit_version(upstream, 'pkg', '0.2.0')
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+
+    def fetch():
+        repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, rev,
+                       checkout_mode='export')
+        repo.fetch()
+        return repo
+
+    repo = fetch()
+    assert repo.git.current_checkout() == rev
+    assert os.path.exists(os.path.join(repo.path, 'sub', 'src', 'sub.sv'))
+
+    # the fallback clone is up to date, it is not cloned again
+    counter = count_spawns(monkeypatch)
+    for _ in range(2):
+        repo = fetch()
+        assert repo.cached_fileset().files
+    assert counter['run'] == 0
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_shared_checkout_pinned(tmp_path, single_pass):
+    upstream = str(tmp_path / 'upstream')
+    make_package(upstream, 'pkg', ['0.1.0'])
+    git(upstream, 'checkout', '-q', '-b', 'dev')
+    rev = commit_version(upstream, 'pkg', '0.2.0')
+    git(upstream, 'tag', '-d', 'v0.2.0')
+    git(upstream, 'checkout', '-q', 'master')
+
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg(upstream))
+    db.fetch('origin', single_pass=single_pass)
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, db_path, rev,
+                   checkout_mode='shared')
+    repo.fetch()
+
+    # the revision is only reachable from the pin after the branch is gone
+    git(upstream, 'branch', '-D', 'dev')
+    db.fetch('origin', single_pass=single_pass)
+    assert 'refs/remotes/origin/dev' not in db.peel_refs()
+    assert db.peel_refs()[PIN_REF_PREFIX + rev] == rev
+    git(db_path, 'gc', '-q', '--prune=now')
+    # the shared checkout still finds its objects in the database
+    assert 'version = "0.2.0"' in git(repo.path, 'show', rev + ':Enzi.toml')
+    git(repo.path, 'fsck', '--connectivity-only')
+
+
+SPARSE_TOML = '''enzi_version = "0.3"
+
+[package]
+name = "pkg"
+version = "0.1.0"
+authors = ["enzi"]
+
+[filesets.rtl]
+files = ["rtl/top.sv"]
+'''
+
+
+def make_sparse_package(path, include):
+    files = {
+        'Enzi.toml': SPARSE_TOML,
+        'rtl/top.sv': '`include "local.svh"\n`include "{}"\nmodule top;\nendmodule\n'.format(include),
+        'rtl/local.svh': '`include "../inc/nested/deep.svh"\n',
+        'inc/defs.svh': '`define DEFS\n',
+        'inc/nested/deep.svh': '`define DEEP\n',
+        'docs/manual.txt': 'manual\n',
+    }
+    for name, data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(data)
+    git(path, 'init', '-q')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'v0.1.0')
+    return git(path, 'rev-parse', 'HEAD')
+
+
+@pytest.mark.parametrize('mode', ['clone', 'worktree', 'export'])
+def test_sparse_checkout(tmp_path, mode):
+    upstream = str(tmp_path / 'upstream')
+    rev = make_sparse_package(upstream, '../inc/defs.svh')
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, rev,
+                   checkout_mode=mode, sparse=True)
+    repo.fetch()
+    exists = lambda x: os.path.exists(os.path.join(repo.path, x))
+    assert exists('Enzi.toml') and exists('rtl/top.sv')
+    # the include directories are added to the sparse checkout
+    assert exists('rtl/local.svh')
+    assert exists('inc/defs.svh') and exists('inc/nested/deep.svh')
+    assert not exists('docs/manual.txt')
+    if mode != 'export':
+        assert repo.is_sparse()
+    fileset = repo.cached_fileset()
+    inc_dirs = set(map(os.path.normpath, fileset.get_flat_incdirs()))
+    assert os.path.join(repo.path, 'inc') in inc_dirs
+
+
+@pytest.mark.parametrize('mode', ['clone', 'worktree'])
+def test_sparse_checkout_toggle(tmp_path, mode):
+    upstream = str(tmp_path / 'upstream')
+    rev = make_sparse_package(upstream, '../inc/defs.svh')
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+
+    def fetch(sparse):
+        repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, rev,
+                       checkout_mode=mode, sparse=sparse)
+        repo.fetch()
+        return repo
+
+    manual = os.path.join(repo_git.path, 'docs', 'manual.txt')
+    repo = fetch(True)
+    assert not os.path.exists(manual)
+    # turned off and on at the same revision
+    repo = fetch(False)
+    assert os.path.exists(manual)
+    assert not repo.is_sparse() and not repo.read_stamp()['sparse']
+    assert fetch(False).is_stamped()
+    repo = fetch(True)
+    assert not os.path.exists(manual)
+    assert repo.is_sparse() and repo.read_stamp()['sparse']
+
+
+@pytest.mark.parametrize('mode', ['clone', 'export'])
+def test_sparse_checkout_fallback(tmp_path, mode):
+    upstream = str(tmp_path / 'upstream')
+    rev = make_sparse_package(upstream, '../missing/defs.svh')
+    repo_git = Git(str(tmp_path / 'deps' / 'pkg'))
+    repo = GitRepo('pkg', str(tmp_path), repo_git, upstream, rev,
+                   checkout_mode=mode, sparse=True)
+    repo.fetch()
+    assert os.path.exists(os.path.join(repo.path, 'docs', 'manual.txt'))
+    if mode != 'export':
+        assert not repo.is_sparse()
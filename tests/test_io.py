@@ -0,0 +1,158 @@
+"""
+enzi.io module test
+"""
+
+import os
+import pytest
+
+# enzi.io can only be imported after enzi.project_manager
+import enzi.project_manager
+from enzi.git import Git
+from enzi.io import EnziIO, VERSIONS_CACHE
+from conftest import make_package, commit_version, count_spawns, git
+from conftest import make_root, edit_config, count_fetches
+
+
+def make_db(tmp_path, versions):
+    upstream = str(tmp_path / 'upstream')
+    revs = make_package(upstream, 'pkg', versions)
+    db_path = str(tmp_path / 'db')
+    os.makedirs(db_path)
+    db = Git(db_path)
+    db.spawn_with(lambda x: x.arg('init').arg('--bare'))
+    db.spawn_with(lambda x: x.arg('remote').arg('add')
+                  .arg('origin').arg(upstream))
+    db.fetch('origin')
+    return db, upstream, revs
+
+
+def test_git_versions_cache(tmp_path, monkeypatch):
+    db, upstream, revs = make_db(tmp_path, ['0.1.0', '0.2.0'])
+    enzi_io = EnziIO(None)
+
+    versions = enzi_io.git_versions(db)
+    assert os.path.exists(os.path.join(db.path, VERSIONS_CACHE))
+    assert versions.revisions == [revs[1], revs[0]]
+    assert versions.refs['v0.1.0'] == revs[0]
+    assert versions.refs['master'] == revs[1]
+
+    # unchanged database, load from the cache without spawning git
+    counter = count_spawns(monkeypatch)
+    cached = enzi_io.git_versions(db)
+    assert counter['run'] == 0
+    assert cached.versions == versions.versions
+    assert cached.refs == versions.refs
+    assert cached.revisions == versions.revisions
+
+    # fetching a new version invalidates the cache
+    revs.append(commit_version(upstream, 'pkg', '0.3.0'))
+    db.fetch('origin')
+    counter['run'] = 0
+    updated = enzi_io.git_versions(db)
+    assert counter['run'] == 2
+    assert updated.revisions[0] == revs[2]
+    assert str(updated.versions[-1][0]) == '0.3.0'
+
+    # a new loose ref also invalidates the cache
+    git(db.path, 'tag', 'extra', revs[0])
+    assert 'extra' in enzi_io.git_versions(db).refs
+
+
+def test_git_versions_invalid_cache(tmp_path):
+    db, _, revs = make_db(tmp_path, ['0.1.0'])
+    with open(os.path.join(db.path, VERSIONS_CACHE), 'w') as f:
+        f.write('{ not json')
+    versions = EnziIO(None).git_versions(db)
+    assert versions.revisions == revs
+
+
+def test_offline(tmp_path, monkeypatch):
+    from enzi.frontend import Enzi
+
+    leaf = str(tmp_path / 'leaf')
+    make_package(leaf, 'leaf', ['0.1.0'])
+    root = make_root(str(tmp_path / 'root'), [('leaf', leaf, '0.1.0')])
+    with pytest.raises(RuntimeError):
+        Enzi(root, offline=True).init()
+
+    Enzi(root).init()
+    commit_version(leaf, 'leaf', '0.1.1')
+    commit_version(leaf, 'leaf', '0.2.0')
+    fetches = count_fetches(monkeypatch)
+    enzi = Enzi(root, offline=True)
+    enzi.init(update=True)
+    assert not fetches
+    assert str(enzi.locked.dependencies['leaf'].version) == '0.1.0'
+
+    # the database has no 0.2.0 yet
+    edit_config(root, 'version = "0.1.0"\n', 'version = "0.2.0"\n')
+    with pytest.raises(RuntimeError):
+        Enzi(root, offline=True).init()
+    assert not fetches
+
+
+def test_fetch_ttl(tmp_path, monkeypatch):
+    from enzi.frontend import Enzi
+
+    leaf = str(tmp_path / 'leaf')
+    make_package(leaf, 'leaf', ['0.1.0'])
+    root = make_root(str(tmp_path / 'root'), [('leaf', leaf, '0.1.0')])
+    Enzi(root).init()
+    # Enzi.toml is newer than the last fetch
+    edit_config(root, 'authors', 'authors')
+    fetches = count_fetches(monkeypatch)
+
+    def update(**kwargs):
+        enzi = Enzi(root, **kwargs)
+        git_url = enzi.config.dependencies['leaf'].git_url
+        db = EnziIO(enzi).git_database('leaf', git_url)
+        return os.path.join(db.path, 'FETCH_HEAD')
+
+    fetch_head = update(fetch_ttl=3600)
+    assert not fetches
+    # the last fetch is out of the window
+    stat = os.stat(fetch_head)
+    os.utime(fetch_head, ns=(stat.st_atime_ns, stat.st_mtime_ns - 7200 * 10**9))
+    update(fetch_ttl=3600)
+    assert fetches == {'leaf': 1}
+    update(fetch_ttl=3600)
+    assert fetches == {'leaf': 1}
+
+    with pytest.raises(ValueError):
+        Enzi(root, fetch_ttl=-1)
+
+
+def test_shared_cache(tmp_path, monkeypatch):
+    from enzi.frontend import Enzi
+
+    leaf = str(tmp_path / 'leaf')
+    make_package(leaf, 'leaf', ['0.1.0'])
+    shared = str(tmp_path / 'shared')
+    db_root = os.path.join(shared, 'git', 'db')
+    projects = []
+    # the same repository with different spellings of its url
+    spellings = [('p1', 'path', leaf), ('p2', 'path', leaf + '/'),
+                 ('p3', 'url', 'file://' + leaf)]
+    for name, key, url in spellings:
+        root = make_root(str(tmp_path / name), [('leaf', url, '0.1.0')], key)
+        enzi = Enzi(root, shared_cache=shared)
+        enzi.init()
+        projects.append(root)
+        assert len(os.listdir(db_root)) == 1
+        db_path = os.path.join(db_root, os.listdir(db_root)[0])
+        assert enzi.locked.cache['git'] == {'leaf': {db_path}}
+        assert not os.path.exists(os.path.join(root, 'build', 'database'))
+
+    # back to the private database of the project, the lock is kept
+    revision = enzi.locked.dependencies['leaf'].revision
+    commit_version(leaf, 'leaf', '0.1.1')
+    enzi = Enzi(projects[0])
+    enzi.init()
+    private = os.path.join(projects[0], 'build', 'database', 'git', 'db', 'leaf')
+    assert enzi.locked.cache['git'] == {'leaf': {private}}
+    assert enzi.locked.dependencies['leaf'].revision == revision
+
+    monkeypatch.setenv('ENZI_SHARED_CACHE', shared)
+    enzi = Enzi(projects[0])
+    enzi.init()
+    assert enzi.locked.cache['git'] == {'leaf': {db_path}}
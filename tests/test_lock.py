@@ -0,0 +1,249 @@
+"""
+enzi.lock module test
+"""
+
+import os
+import pytest
+
+# enzi.frontend can only be imported after enzi.project_manager
+import enzi.project_manager
+from enzi.frontend import Enzi, RESOLVERS
+from enzi.config import Locked, RawConfig
+from enzi.deps_resolver import DependencyResolver
+from enzi.project_manager import ProjectFiles
+from conftest import make_package, commit_version, make_root, dep_section
+from conftest import edit_config, count_fetches
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    leaf = str(tmp_path / 'leaf')
+    make_package(leaf, 'leaf', ['0.1.0', '0.2.0'])
+    root = make_root(str(tmp_path / 'root'), [('leaf', leaf, '0.1.0')])
+    Enzi(root).init()
+
+    # a file stands for the compiled libraries in the build directory
+    marker = os.path.join(root, 'build', 'marker')
+    with open(marker, 'w') as f:
+        f.write('compiled')
+
+    counter = {'resolve': 0}
+    resolve = DependencyResolver.resolve
+
+    def counting_resolve(self):
+        counter['resolve'] += 1
+        return resolve(self)
+
+    monkeypatch.setattr(DependencyResolver, 'resolve', counting_resolve)
+    return root, marker, counter
+
+
+def lock_meta(root):
+    return Locked.load(os.path.join(root, 'Enzi.lock'))
+
+
+def test_lock_touch(project):
+    root, marker, counter = project
+    edit_config(root, 'authors', 'authors')
+    enzi = Enzi(root)
+    enzi.init()
+    assert counter['resolve'] == 0
+    assert os.path.exists(marker)
+    assert not enzi.non_lazy_configure
+    assert lock_meta(root).config_mtime == enzi.config_mtime
+
+
+def test_lock_target_change(project):
+    root, marker, counter = project
+    # formatting and key order do not matter
+    edit_config(root, 'toplevel = "root"\n', '\n\ntoplevel="root"\n')
+    enzi = Enzi(root)
+    enzi.init()
+    assert not enzi.non_lazy_configure
+
+    edit_config(root, 'toplevel="root"', 'toplevel = "root_tb"')
+    enzi = Enzi(root)
+    enzi.init()
+    assert counter['resolve'] == 0
+    assert os.path.exists(marker)
+    # the backend configuration must be regenerated
+    assert enzi.non_lazy_configure
+    assert lock_meta(root).config_hash == enzi.config_hash
+
+
+def test_lock_deps_change(project):
+    root, marker, counter = project
+    edit_config(root, 'version = "0.1.0"\n', 'version = "0.2.0"\n')
+    enzi = Enzi(root)
+    enzi.init()
+    assert counter['resolve'] == 1
+    assert str(enzi.locked.dependencies['leaf'].version) == '0.2.0'
+    # the build directory is kept on relock
+    assert os.path.exists(marker)
+    assert lock_meta(root).deps_hash == enzi.deps_hash
+
+
+def test_lock_without_hashes(project):
+    root, marker, counter = project
+    lock_file = os.path.join(root, 'Enzi.lock')
+    with open(lock_file) as f:
+        lines = f.readlines()
+    with open(lock_file, 'w') as f:
+        f.writelines(filter(lambda x: not x.split('=')[0].strip().endswith('hash'), lines))
+    assert lock_meta(root).deps_hash is None
+
+    enzi = Enzi(root)
+    enzi.init()
+    assert counter['resolve'] == 0
+    assert os.path.exists(marker)
+    assert lock_meta(root).deps_hash == enzi.deps_hash
+
+
+def test_relock_invalidation(tmp_path):
+    leaf = str(tmp_path / 'leaf')
+    other = str(tmp_path / 'other')
+    make_package(leaf, 'leaf', ['0.1.0'])
+    make_package(other, 'other', ['0.1.0'])
+    root = make_root(str(tmp_path / 'root'),
+                     [('leaf', leaf, '0.1.0'), ('other', other, '0.1.0')])
+    enzi = Enzi(root)
+    enzi.init()
+    ProjectFiles(enzi).fetch('sim')
+
+    deps_dir = os.path.join(root, 'build', 'deps')
+    leaf_file = os.path.join(deps_dir, 'leaf', 'src', 'leaf.sv')
+    # a marker stands for the state kept in the leaf checkout
+    leaf_marker = os.path.join(deps_dir, 'leaf', '.git', 'enzi-marker')
+    open(leaf_marker, 'w').close()
+    databases = os.listdir(os.path.join(root, 'build', 'database', 'git', 'db'))
+
+    # a new version released after the checkout, and other is dropped
+    commit_version(leaf, 'leaf', '0.2.0')
+    make_root(root, [('leaf', leaf, '0.2.0')])
+
+    enzi = Enzi(root)
+    enzi.init()
+    assert set(enzi.locked.dependencies) == {'leaf'}
+    assert not os.path.exists(os.path.join(deps_dir, 'other'))
+    assert os.path.exists(leaf_marker)
+    assert os.listdir(os.path.join(root, 'build', 'database', 'git', 'db')) == databases
+
+    # the kept checkout is updated in place
+    ProjectFiles(enzi).fetch('sim')
+    with open(leaf_file) as f:
+        assert '0.2.0' in f.read()
+    assert os.path.exists(leaf_marker)
+
+
+@pytest.mark.parametrize('resolver', RESOLVERS)
+def test_lock_keeps_picks(tmp_path, monkeypatch, resolver):
+    leaf = str(tmp_path / 'leaf')
+    other = str(tmp_path / 'other')
+    make_package(leaf, 'leaf', ['0.1.0'])
+    make_package(other, 'other', ['0.1.0'])
+    root = make_root(str(tmp_path / 'root'), [('leaf', leaf, '0.1.0')])
+    Enzi(root, resolver=resolver).init()
+
+    # a compatible release and a new dependency
+    commit_version(leaf, 'leaf', '0.1.1')
+    make_root(root, [('leaf', leaf, '0.1.0'), ('other', other, '0.1.0')])
+    fetches = count_fetches(monkeypatch)
+    enzi = Enzi(root, resolver=resolver)
+    enzi.init()
+    assert str(enzi.locked.dependencies['leaf'].version) == '0.1.0'
+    assert str(enzi.locked.dependencies['other'].version) == '0.1.0'
+    if resolver == 'fixpoint':
+        # the database of leaf has the locked revision
+        assert fetches == {'other': 1}
+
+    # only the given dependencies are updated
+    commit_version(other, 'other', '0.1.1')
+    enzi = Enzi(root, resolver=resolver)
+    enzi.init(update=True, deps=['leaf'])
+    assert str(enzi.locked.dependencies['leaf'].version) == '0.1.1'
+    assert str(enzi.locked.dependencies['other'].version) == '0.1.0'
+
+    enzi = Enzi(root, resolver=resolver)
+    with pytest.raises(ValueError):
+        enzi.init(update=True, deps=['unknown'])
+
+    enzi = Enzi(root, resolver=resolver)
+    enzi.init(update=True)
+    assert str(enzi.locked.dependencies['other'].version) == '0.1.1'
+
+
+def test_lock_outdated_pick(tmp_path):
+    leaf = str(tmp_path / 'leaf')
+    mid = str(tmp_path / 'mid')
+    make_package(leaf, 'leaf', ['1.0.0'])
+    mid_dep = dep_section([('leaf', leaf, '1.0.0')])
+    make_package(mid, 'mid', ['0.1.0'], mid_dep)
+    root = make_root(str(tmp_path / 'root'), [('mid', mid, '0.1.0')])
+    Enzi(root).init()
+
+    # the new mid requires a leaf release the database has not seen yet
+    commit_version(leaf, 'leaf', '2.0.0')
+    commit_version(mid, 'mid', '0.2.0',
+                   dep_section([('leaf', leaf, '2.0.0')]))
+    make_root(root, [('mid', mid, '0.2.0')])
+    enzi = Enzi(root)
+    enzi.init()
+    assert str(enzi.locked.dependencies['mid'].version) == '0.2.0'
+    assert str(enzi.locked.dependencies['leaf'].version) == '2.0.0'
+
+
+@pytest.mark.parametrize('resolver', RESOLVERS)
+def test_lock_transitive_outdated(tmp_path, resolver):
+    a, b, c = (str(tmp_path / x) for x in 'abc')
+    make_package(c, 'c', ['1.0.0'])
+    make_package(b, 'b', ['1.0.0'], dep_section([('c', c, '1.0.0')]))
+    make_package(a, 'a', ['1.0.0'], dep_section([('b', b, '1.0.0')]))
+    root = make_root(str(tmp_path / 'root'), [('a', a, '1.0.0'), ('b', b, '1.0.0')])
+    Enzi(root, resolver=resolver).init()
+
+    # the newest b is picked first, then dropped for the b that a requires,
+    # which requires a c release the locked database of c has not seen yet
+    commit_version(c, 'c', '2.0.0')
+    commit_version(b, 'b', '2.0.0', dep_section([('c', c, '2.0.0')]))
+    commit_version(b, 'b', '2.1.0', dep_section([('c', c, '>=1.0.0')]))
+    commit_version(a, 'a', '2.0.0', dep_section([('b', b, '>=2.0.0, <2.1.0')]))
+    make_root(root, [('a', a, '2.0.0'), ('b', b, '2.0.0')])
+    enzi = Enzi(root, resolver=resolver)
+    enzi.init()
+    assert str(enzi.locked.dependencies['b'].version) == '2.0.0'
+    assert str(enzi.locked.dependencies['c'].version) == '2.0.0'
+
+
+def test_sidecar(project, monkeypatch):
+    root, marker, counter = project
+    lock_file = os.path.join(root, 'Enzi.lock')
+    validated = {'count': 0}
+    raw_validated = RawConfig.validated
+
+    def counting_validated(self):
+        validated['count'] += 1
+        return raw_validated(self)
+
+    monkeypatch.setattr(RawConfig, 'validated', counting_validated)
+
+    enzi = Enzi(root)
+    enzi.init()
+    assert (enzi.sidecar.hits, enzi.sidecar.misses) == (2, 0)
+    assert validated['count'] == 0
+    assert enzi.config_hash == lock_meta(root).config_hash
+    assert enzi.locked.dumps() == Locked.load(lock_file).dumps()
+
+    # a changed Enzi.toml is validated again, the refreshed lock is recorded
+    edit_config(root, 'toplevel = "root"', 'toplevel = "root_tb"')
+    enzi = Enzi(root)
+    enzi.init()
+    assert validated['count'] == 1
+    assert enzi.sidecar.misses == 1
+
+    enzi = Enzi(root)
+    enzi.init()
+    assert validated['count'] == 1
+    assert enzi.sidecar.hits == 2
+    assert enzi.config.targets == Enzi(root).config.targets
+    assert enzi.locked.dumps() == Locked.load(lock_file).dumps()
+    assert counter['resolve'] == 0
@@ -241,3 +241,12 @@ def test_from_str():
 def test_eq_hash():
     assert req("^1") == req("^1")
     assert calculate_hash(req("^1")) == calculate_hash(req("^1"))
+
+def test_major_range():
+    assert req("^1.2.3").major_range() == (1, 1)
+    assert req("~0.2").major_range() == (0, 0)
+    assert req("=2.0.0").major_range() == (2, 2)
+    assert req(">=1.0.0, <3.0.0").major_range() == (1, 3)
+    assert req("> 1.0.0").major_range() == (1, None)
+    assert req("<= 2.0.0").major_range() == (None, 2)
+    assert VersionReq.any().major_range() == (None, None)